@@ -0,0 +1,112 @@
+# Cold start benchmark for the handler package
+#
+# Compares the handler package in the working tree with the one at a git revision. Each sample
+# runs in a fresh interpreter, which times importing eq_monitor_nagios.handlers and then the first
+# read and the first create invocation against the in-process fake from fake_aws. The revision is
+# taken from git archive, so nothing outside this repository is needed, and nothing uses the network.
+# The worker only relies on what handlers has had since the first layout, where every setting and
+# the server record's parameters lived in handlers itself, so any revision can be the baseline.
+#
+#   python -m benchmarks.cold_start --baseline-ref HEAD~1 --samples 20
+import argparse
+import dataclasses
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+default_samples = 15
+measurements = ['import_ms', 'first_read_ms', 'first_create_ms', 'process_ms']
+
+
+def worker(src_path):
+    # runs in the fresh interpreter: the handlers are imported before anything else loads botocore
+    import logging
+    logging.disable(logging.CRITICAL)
+    sys.path.insert(0, src_path)
+
+    started = time.perf_counter()
+    from eq_monitor_nagios import handlers
+    imported = time.perf_counter()
+
+    sys.path.insert(0, repo_root)
+    from benchmarks.fake_aws import FakeAWS, VirtualClock
+
+    def make_request(desired):
+        # only what the handlers read, so the harness doesn't load any handler modules itself
+        fields = {field.name: None for field in dataclasses.fields(handlers.ResourceHandlerRequest)}
+        fields['desiredResourceState'] = handlers.ResourceModel._deserialize(desired)
+        return handlers.ResourceHandlerRequest(**fields)
+
+    aws = FakeAWS()
+    # the first layout slept through IAM propagation on the real clock
+    handlers.time = VirtualClock(aws)
+    aws.parameters[handlers.default_ssm_ami_parameter] = {'Value': 'ami-0base', 'Type': 'String'}
+    # the server record, both as one document and as the parameter per key the first layout read
+    record = {'instance_id': 'i-0cold', 'server_name': 'cold', 'IP': '10.0.0.1', 'URL': 'http://10.0.0.1/nagios'}
+    aws.seed_record(handlers.default_ssm_path, 'i-0cold', record)
+    for key, value in record.items():
+        aws.parameters[f"{handlers.default_ssm_path}/{key}/i-0cold"] = {'Value': value, 'Type': 'String'}
+
+    read_started = time.perf_counter()
+    handlers.read_handler(aws.session(), make_request({'Id': 'i-0cold'}), {})
+    read_done = time.perf_counter()
+    handlers.create_handler(aws.session(), make_request({'Name': 'cold', 'SubnetId': 'subnet-0', 'SecurityGroupId': 'sg-0'}), {})
+    create_done = time.perf_counter()
+
+    print(json.dumps({
+        'import_ms': (imported - started) * 1000,
+        'first_read_ms': (read_done - read_started) * 1000,
+        'first_create_ms': (create_done - read_done) * 1000,
+    }))
+
+
+def sample(src_path):
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.cold_start', '--worker', src_path],
+                            cwd=repo_root, check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['process_ms'] = (time.perf_counter() - started) * 1000
+    return result
+
+
+def measure(src_path, samples):
+    results = [sample(src_path) for _ in range(samples)]
+    return {name: statistics.median(result[name] for result in results) for name in measurements}
+
+
+def export_revision(ref, target):
+    archive = subprocess.run(['git', 'archive', ref, 'src'], cwd=repo_root, check=True, capture_output=True).stdout
+    subprocess.run(['tar', '-x', '-C', target], input=archive, check=True)
+    return os.path.join(target, 'src')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare handler cold starts with a git revision')
+    parser.add_argument('--baseline-ref', default='HEAD', help='git revision to compare against')
+    parser.add_argument('--samples', type=int, default=default_samples, help='fresh interpreters per side')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        worker(args.worker)
+        return 0
+
+    with tempfile.TemporaryDirectory() as target:
+        baseline = measure(export_revision(args.baseline_ref, target), args.samples)
+        current = measure(os.path.join(repo_root, 'src'), args.samples)
+
+    print(f"median of {args.samples} fresh interpreters, {args.baseline_ref} -> working tree")
+    for name in measurements:
+        change = (current[name] - baseline[name]) / baseline[name] * 100 if baseline[name] else 0.0
+        print(f"{name:16} {baseline[name]:9.2f} {current[name]:9.2f} {change:+7.1f}%")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,731 @@
+# In-process stand-in for the EC2, IAM and SSM APIs the handlers use
+#
+# FakeAWS keeps all state in memory and never touches the network. Every API call is counted per
+# service and operation, can be given a fixed latency (a real sleep, so it shows up in wall time),
+# and can be throttled with a per-operation token bucket. Throttled calls are retried with backoff
+# the way a boto3 client would, and fail with ThrottlingException once the retries run out. Clients
+# fire the botocore events the handlers hook into (before-call, before-send, needs-retry, after-call
+# and after-call-error), so the metrics and rate limiter run as they would against AWS. Scenarios
+# can queue faults per operation: each of its next calls fails with the queued error code (or code
+# and message), or goes through for a None. Queued lost responses make a call take effect and then fail, the way a
+# response that times out on the way back does. Instances
+# follow a simulated timeline driven by a virtual clock: they
+# leave pending, run their user data milestones, and terminate, as CloudFormation callbacks
+# advance the clock, so a create can be driven to SUCCESS without waiting in real time. SSM
+# rejects values longer than their tier holds, as SSM does.
+import base64
+import bisect
+import fnmatch
+import io
+import itertools
+import json
+import random
+import tarfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+from botocore.exceptions import ClientError
+
+# seconds an instance spends in each simulated phase
+default_timeline = {
+    'pending': 30,
+    'stopping': 15,
+    'status_checks': 60,
+    'shutting-down': 20,
+    'image': 60,
+    'command': 5,
+}
+
+# the most characters a parameter value may have in each SSM tier; intelligent tiering picks
+# advanced only for values a standard parameter can't hold, and an advanced parameter stays advanced
+parameter_tier_max_chars = {
+    'Standard': 4096,
+    'Advanced': 8192,
+}
+
+# status milestones the simulated user data writes once the instance is running, with their durations
+default_status_schedule = [
+    ('Starting', 2),
+    ('StartingYumUpdates', 60),
+    ('DeployingNagios', 100),
+    ('DeployingPlugins', 20),
+    ('StartingServices', 5),
+]
+
+# a server launched from a baked image only starts its services
+default_cached_status_schedule = [
+    ('Starting', 2),
+    ('StartingServices', 5),
+]
+
+# sustained TPS of the throttled operations, when throttling is turned on
+default_tps = {
+    'ssm:PutParameter': 3,
+    'ssm:GetParameter': 40,
+    'ssm:GetParameters': 40,
+    'ssm:GetParametersByPath': 40,
+    'ssm:DeleteParameter': 10,
+    'ssm:DeleteParameters': 10,
+    'ec2:RunInstances': 2,
+    'ec2:DescribeInstances': 20,
+    'iam:CreateRole': 5,
+    'iam:CreatePolicy': 5,
+    'iam:AttachRolePolicy': 5,
+    'iam:DetachRolePolicy': 5,
+    'iam:CreateInstanceProfile': 5,
+    'iam:AddRoleToInstanceProfile': 5,
+}
+
+
+class ParameterStore(dict):
+    # SSM parameters by name, with a sorted name index for path queries rebuilt only after writes
+
+    def __init__(self):
+        super().__init__()
+        self._sorted = None
+
+    def __setitem__(self, name, value):
+        if name not in self:
+            self._sorted = None
+        super().__setitem__(name, value)
+
+    def __delitem__(self, name):
+        self._sorted = None
+        super().__delitem__(name)
+
+    def pop(self, name, *default):
+        if name in self:
+            self._sorted = None
+        return super().pop(name, *default)
+
+    def names_under(self, prefix):
+        if self._sorted is None:
+            self._sorted = sorted(self)
+        start = bisect.bisect_left(self._sorted, prefix)
+        end = bisect.bisect_left(self._sorted, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+        return self._sorted[start:end]
+
+
+# the fault EC2 gives a launch whose instance profile it can't see yet
+instance_profile_not_ready_fault = ('InvalidParameterValue', 'Value (nagios_instance_profile) for parameter iamInstanceProfile.name is invalid. Invalid IAM Instance Profile name')
+
+# boto3's legacy retry mode makes up to 5 attempts, backing off from this many seconds
+default_max_attempts = 5
+retry_base_delay = 0.05
+
+
+def client_error(code, operation, message=''):
+    return ClientError({'Error': {'Code': code, 'Message': message}, 'ResponseMetadata': {'HTTPStatusCode': 400}}, operation)
+
+
+class VirtualClock:
+    # stands in for the time module inside the handlers: sleeping advances the clock instead of blocking
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    def time(self):
+        return self.aws.clock
+
+    def sleep(self, seconds):
+        self.aws.advance(seconds)
+
+
+class FakeAWS:
+
+    def __init__(self, region='us-east-1', latency=0.0, tps=None, timeline=None, status_schedule=None, status_path=None, stats_path=None):
+        self.region = region
+        self.account = '123456789012'
+        self.latency = latency
+        self.max_attempts = default_max_attempts
+        self.tps = dict(tps or {})
+        self.timeline = dict(default_timeline, **(timeline or {}))
+        self.status_schedule = list(status_schedule or default_status_schedule)
+        self.cached_status_schedule = list(default_cached_status_schedule)
+        self.clock = 1600000000.0
+        self.calls = Counter()
+        self.throttled = Counter()
+        # 'service:Operation' -> error codes (or None to let a call through) for its next calls
+        self.faults = {}
+        # 'service:Operation' -> error codes raised after its next calls have taken effect
+        self.lost_responses = {}
+        # run_instances ClientToken -> the instances it launched
+        self.client_tokens = {}
+        self.parameters = ParameterStore()
+        self.instances = {}
+        self.images = {}
+        self.commands = {}
+        # host config files each server has, as applied by Run Command
+        self.nagios_configs = {}
+        self.iam = {'roles': {}, 'policies': {}, 'profiles': {}}
+        # where the simulated user data writes its status milestones, and Nagios its statistics once built
+        self.status_path = status_path
+        self.stats_path = stats_path
+        self.measuring_since = time.perf_counter()
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        # unique credentials, so cached clients from another FakeAWS are never reused
+        self.credentials = (uuid.uuid4().hex, uuid.uuid4().hex, uuid.uuid4().hex)
+        # the other regions of the same account, by name
+        self.regions = {region: self}
+
+    # --- plumbing ---------------------------------------------------------------------------
+
+    def session(self):
+        return FakeSessionProxy(self)
+
+    def call(self, service, operation, events=None):
+        # like a boto3 client in legacy retry mode, throttled calls are retried with backoff
+        name = f"{service}:{operation}"
+        events = events or FakeEvents()
+        model = FakeOperationModel(service, operation)
+        context = {}
+        events.emit(f"before-call.{service}.{operation}", model=model, params={}, request_signer=None, context=context)
+        for attempt in range(self.max_attempts):
+            events.emit(f"before-send.{service}.{operation}", request=None)
+            with self._lock:
+                # retries are counted as throttles, not as calls the handler made
+                if attempt == 0:
+                    self.calls[name] += 1
+                throttled = name in self.tps and not self._take_token(name)
+                if throttled:
+                    self.throttled[name] += 1
+            if self.latency:
+                time.sleep(self.latency)
+            if not throttled:
+                fault = self.faults[name].pop(0) if self.faults.get(name) else None
+                if fault is not None:
+                    code, message = fault if isinstance(fault, tuple) else (fault, 'injected fault')
+                    error = client_error(code, operation, message)
+                    events.emit(f"after-call-error.{service}.{operation}", exception=error, context=context)
+                    raise error
+                events.emit(f"after-call.{service}.{operation}", http_response=None, model=model, context=context,
+                            parsed={'ResponseMetadata': {'RetryAttempts': attempt}})
+                return
+            events.emit(f"needs-retry.{service}.{operation}", response=(None, {'Error': {'Code': 'ThrottlingException'}}),
+                        endpoint=None, operation=model, attempts=attempt + 1, caught_exception=None, request_dict={})
+            if attempt + 1 < self.max_attempts:
+                time.sleep(random.uniform(0, retry_base_delay * 2 ** attempt))
+        error = client_error('ThrottlingException', operation, 'Rate exceeded')
+        events.emit(f"after-call-error.{service}.{operation}", exception=error, context=context)
+        raise error
+
+    def _take_token(self, name):
+        now = time.monotonic()
+        rate = self.tps[name]
+        tokens, last = self._buckets.get(name, (rate, now))
+        tokens = min(rate, tokens + (now - last) * rate)
+        if tokens < 1:
+            self._buckets[name] = (tokens, now)
+            return False
+        self._buckets[name] = (tokens - 1, now)
+        return True
+
+    def in_region(self, region):
+        # another region of the account: its own resources, but the clock, credentials and call counts are shared
+        if region not in self.regions:
+            other = FakeAWS(region, self.latency, self.tps, self.timeline, self.status_schedule, self.status_path, self.stats_path)
+            other.clock = self.clock
+            other.calls, other.throttled, other.faults, other.lost_responses = self.calls, self.throttled, self.faults, self.lost_responses
+            other._lock = self._lock
+            other.credentials, other.regions = self.credentials, self.regions
+            self.regions[region] = other
+        return self.regions[region]
+
+    def reset_counters(self):
+        # scenarios reset after their setup, so only the measured part counts
+        self.calls.clear()
+        self.throttled.clear()
+        self.measuring_since = time.perf_counter()
+
+    def next_id(self, prefix):
+        return f"{prefix}-{next(self._ids):08x}"
+
+    # --- simulated instance timeline --------------------------------------------------------
+
+    def advance(self, seconds):
+        self.clock += seconds
+        for instance in self.instances.values():
+            self._advance_instance(instance)
+        for image in self.images.values():
+            if image['State'] == 'pending' and self.clock >= image['created'] + self.timeline['image']:
+                image['State'] = 'available'
+
+    def _advance_instance(self, instance):
+        state = instance['State']['Name']
+        if state == 'pending' and self.clock >= instance['since'] + self.timeline['pending']:
+            self._set_state(instance, 'running', 16)
+            address = int(instance['InstanceId'].split('-')[1], 16)
+            # every start gets a new public IP
+            instance['PublicIpAddress'] = f"10.{instance.get('starts', 0)}.{address // 250}.{address % 250}"
+        if instance['State']['Name'] == 'running' and not instance.get('built'):
+            elapsed = self.clock - instance['since']
+            status = 'Done'
+            schedule = self.cached_status_schedule if instance.get('built_from_image') else self.status_schedule
+            for milestone, seconds in schedule:
+                if elapsed < seconds:
+                    status = milestone
+                    break
+                elapsed -= seconds
+            if self.status_path:
+                self.parameters[f"{self.status_path}/{instance['InstanceId']}"] = {'Value': status, 'Type': 'String'}
+            if status == 'Done':
+                instance['built'] = True
+                if self.stats_path:
+                    # services, checks in the last 5 minutes, then average and worst latency, execution and host latency in ms
+                    self.parameters[f"{self.stats_path}/{instance['InstanceId']}"] = {'Value': f"{int(self.clock)},120,600,85,410,230,40", 'Type': 'String'}
+                if instance.get('stop_when_built'):
+                    self._set_state(instance, 'stopped', 80)
+                    instance.pop('PublicIpAddress', None)
+        if state == 'stopping' and self.clock >= instance['since'] + self.timeline['stopping']:
+            self._set_state(instance, 'stopped', 80)
+            instance.pop('PublicIpAddress', None)
+        if state == 'shutting-down' and self.clock >= instance['since'] + self.timeline['shutting-down']:
+            self._set_state(instance, 'terminated', 48)
+
+    def _set_state(self, instance, name, code):
+        instance['State'] = {'Name': name, 'Code': code}
+        instance['since'] = self.clock
+
+    def seed_instance(self, tags, state='running'):
+        # adds an instance without counting a call, to set up large sets of monitoring targets
+        instance_id = self.next_id('i')
+        address = int(instance_id.split('-')[1], 16)
+        self.instances[instance_id] = {'InstanceId': instance_id, 'State': {'Name': state, 'Code': 16}, 'since': self.clock, 'built': True,
+                                        'Tags': [{'Key': key, 'Value': value} for key, value in tags.items()],
+                                        'PrivateIpAddress': f"172.16.{address // 250 % 250}.{address % 250}"}
+        return instance_id
+
+    def seed_record(self, path, instance_id, record):
+        # writes straight to the store without counting a call, to set up large lists
+        self.parameters[f"{path}/record/{instance_id}"] = {'Value': json.dumps(record), 'Type': 'String'}
+
+
+class FakeSessionProxy:
+    # the subset of SessionProxy the handlers use, plus the boto3 session the client cache keys on
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.session = FakeBotoSession(aws)
+
+    def client(self, service, region_name=None, **kwargs):
+        aws = self.aws.in_region(region_name) if region_name else self.aws
+        return {'ssm': FakeSSM, 'ec2': FakeEC2, 'iam': FakeIAM}[service](aws)
+
+
+class FakeBotoSession:
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.region_name = aws.region
+
+    def get_credentials(self):
+        return self
+
+    def get_frozen_credentials(self):
+        access_key, secret_key, token = self.aws.credentials
+        return FrozenCredentials(access_key, secret_key, token)
+
+
+class FrozenCredentials:
+
+    def __init__(self, access_key, secret_key, token):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.token = token
+
+
+class FakeMeta:
+
+    def __init__(self, region_name, service):
+        self.region_name = region_name
+        self.service_model = type('ServiceModel', (), {'service_name': service})()
+        self.events = FakeEvents()
+
+
+class FakeEvents:
+    # fires registered handlers the way botocore does, matching wildcards in the registered name
+
+    def __init__(self):
+        self.handlers = []
+
+    def register(self, event_name, handler, **kwargs):
+        self.handlers.append((event_name, handler))
+
+    def emit(self, event_name, **kwargs):
+        for pattern, handler in self.handlers:
+            if fnmatch.fnmatchcase(event_name, pattern):
+                handler(event_name=event_name, **kwargs)
+
+
+class FakeOperationModel:
+
+    def __init__(self, service, operation):
+        self.name = operation
+        self.service_model = type('ServiceModel', (), {'service_name': service})()
+
+
+class FakeClient:
+    service = None
+
+    def __init__(self, aws):
+        self.aws = aws
+        self.meta = FakeMeta(aws.region, self.service)
+
+    def _call(self, operation):
+        self.aws.call(self.service, operation, self.meta.events)
+
+    def _respond(self, operation, response):
+        lost = self.aws.lost_responses.get(f"{self.service}:{operation}")
+        if lost:
+            raise client_error(lost.pop(0), operation, 'response lost')
+        return response
+
+
+class FakeSSM(FakeClient):
+    service = 'ssm'
+
+    def _parameter(self, name):
+        parameter = self.aws.parameters[name]
+        return {'Name': name, 'Value': parameter['Value'], 'Type': parameter['Type'], 'Version': 1}
+
+    def get_parameter(self, Name, **kwargs):
+        self._call('GetParameter')
+        if Name not in self.aws.parameters:
+            raise client_error('ParameterNotFound', 'GetParameter')
+        return {'Parameter': self._parameter(Name)}
+
+    def get_parameters(self, Names, **kwargs):
+        self._call('GetParameters')
+        if len(Names) > 10:
+            raise client_error('ValidationException', 'GetParameters', 'at most 10 names')
+        found = [self._parameter(name) for name in Names if name in self.aws.parameters]
+        return {'Parameters': found, 'InvalidParameters': [name for name in Names if name not in self.aws.parameters]}
+
+    def put_parameter(self, Name, Value, Type='String', Overwrite=False, Tier='Standard', **kwargs):
+        self._call('PutParameter')
+        existing = self.aws.parameters.get(Name)
+        if existing is not None and not Overwrite:
+            raise client_error('ParameterAlreadyExists', 'PutParameter')
+        current_tier = (existing or {}).get('Tier', 'Standard')
+        if Tier == 'Intelligent-Tiering':
+            Tier = 'Advanced' if current_tier == 'Advanced' or len(Value) > parameter_tier_max_chars['Standard'] else 'Standard'
+        if len(Value) > parameter_tier_max_chars[Tier]:
+            raise client_error('ValidationException', 'PutParameter',
+                                f"{Tier} tier parameters support a maximum parameter value of {parameter_tier_max_chars[Tier]} characters")
+        if current_tier == 'Advanced' and Tier == 'Standard':
+            raise client_error('ValidationException', 'PutParameter', 'an advanced parameter cannot be downgraded to standard')
+        self.aws.parameters[Name] = {'Value': Value, 'Type': Type, 'Tier': Tier}
+        return {'Version': 1, 'Tier': Tier}
+
+    def delete_parameter(self, Name):
+        self._call('DeleteParameter')
+        if self.aws.parameters.pop(Name, None) is None:
+            raise client_error('ParameterNotFound', 'DeleteParameter')
+        return {}
+
+    def delete_parameters(self, Names):
+        self._call('DeleteParameters')
+        deleted = [name for name in Names if self.aws.parameters.pop(name, None) is not None]
+        return {'DeletedParameters': deleted, 'InvalidParameters': [name for name in Names if name not in deleted]}
+
+    def get_parameters_by_path(self, Path, Recursive=False, MaxResults=10, NextToken=None, **kwargs):
+        self._call('GetParametersByPath')
+        prefix = Path.rstrip('/') + '/'
+        names = [name for name in self.aws.parameters.names_under(prefix) if Recursive or '/' not in name[len(prefix):]]
+        start = int(NextToken or 0)
+        response = {'Parameters': [self._parameter(name) for name in names[start:start + MaxResults]]}
+        if start + MaxResults < len(names):
+            response['NextToken'] = str(start + MaxResults)
+        return response
+
+    def send_command(self, InstanceIds, DocumentName, Parameters, **kwargs):
+        self._call('SendCommand')
+        command_id = self.aws.next_id('cmd')
+        self.aws.commands[command_id] = {'InstanceIds': list(InstanceIds), 'sent': self.aws.clock}
+        # the script is applied right away, its invocations report success once the command time has passed
+        for instance_id in InstanceIds:
+            configs = self.aws.nagios_configs.setdefault(instance_id, set())
+            for line in Parameters['commands']:
+                if line.startswith('echo ') and '| tar xz' in line:
+                    data = base64.b64decode(line.split()[1])
+                    with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+                        configs.update(name[:-len('.cfg')] for name in tar.getnames())
+                elif line.startswith('rm -f '):
+                    configs.discard(line.rsplit('/', 1)[1][:-len('.cfg')])
+        return {'Command': {'CommandId': command_id}}
+
+    def list_command_invocations(self, CommandId, **kwargs):
+        self._call('ListCommandInvocations')
+        command = self.aws.commands[CommandId]
+        status = 'Success' if self.aws.clock >= command['sent'] + self.aws.timeline['command'] else 'InProgress'
+        return {'CommandInvocations': [{'CommandId': CommandId, 'InstanceId': instance_id, 'Status': status}
+                                        for instance_id in command['InstanceIds']]}
+
+
+class FakeEC2(FakeClient):
+    service = 'ec2'
+
+    def run_instances(self, MinCount, MaxCount, **kwargs):
+        self._call('RunInstances')
+        token = kwargs.get('ClientToken')
+        if token in self.aws.client_tokens:
+            return self._respond('RunInstances', {'Instances': [self._public(self.aws.instances[instance_id])
+                                                                for instance_id in self.aws.client_tokens[token]]})
+        instances = []
+        for _ in range(MaxCount):
+            instance_id = self.aws.next_id('i')
+            tags = [tag for spec in kwargs.get('TagSpecifications', []) for tag in spec['Tags']]
+            instance = {'InstanceId': instance_id, 'InstanceType': kwargs.get('InstanceType'), 'ImageId': kwargs.get('ImageId'),
+                        'SubnetId': kwargs.get('SubnetId'), 'Tags': tags, 'since': self.aws.clock,
+                        'State': {'Name': 'pending', 'Code': 0},
+                        'stop_when_built': 'shutdown -h now' in kwargs.get('UserData', ''),
+                        'user_data': kwargs.get('UserData', '')}
+            if kwargs.get('ImageId') in self.aws.images:
+                instance['built_from_image'] = True
+            self.aws.instances[instance_id] = instance
+            instances.append(self._public(instance))
+        if token:
+            self.aws.client_tokens[token] = [instance['InstanceId'] for instance in instances]
+        return self._respond('RunInstances', {'Instances': instances})
+
+    def _public(self, instance):
+        return {key: value for key, value in instance.items() if key[0].isupper()}
+
+    def _matches(self, instance, filters):
+        for item in filters or []:
+            name, values = item['Name'], item['Values']
+            if name == 'instance-state-name':
+                if instance['State']['Name'] not in values:
+                    return False
+            elif name == 'instance-id':
+                if instance['InstanceId'] not in values:
+                    return False
+            elif name.startswith('tag:'):
+                tags = {tag['Key']: tag['Value'] for tag in instance['Tags']}
+                if tags.get(name[4:]) not in values:
+                    return False
+        return True
+
+    def describe_instances(self, InstanceIds=None, Filters=None, MaxResults=None, NextToken=None, **kwargs):
+        self._call('DescribeInstances')
+        if InstanceIds:
+            missing = [instance_id for instance_id in InstanceIds if instance_id not in self.aws.instances]
+            if missing:
+                raise client_error('InvalidInstanceID.NotFound', 'DescribeInstances', f"{missing} not found")
+            instances = [self.aws.instances[instance_id] for instance_id in InstanceIds]
+        else:
+            instances = list(self.aws.instances.values())
+        matched = [self._public(instance) for instance in instances if self._matches(instance, Filters)]
+        start = int(NextToken or 0)
+        end = start + MaxResults if MaxResults else len(matched)
+        response = {'Reservations': [{'Instances': matched[start:end]}] if matched[start:end] else []}
+        if end < len(matched):
+            response['NextToken'] = str(end)
+        return response
+
+    def get_paginator(self, operation):
+        return FakePaginator(getattr(self, operation))
+
+    def terminate_instances(self, InstanceIds):
+        self._call('TerminateInstances')
+        # like EC2, one unknown id fails the whole call
+        missing = [instance_id for instance_id in InstanceIds if instance_id not in self.aws.instances]
+        if missing:
+            raise client_error('InvalidInstanceID.NotFound', 'TerminateInstances', f"{missing} not found")
+        for instance_id in InstanceIds:
+            instance = self.aws.instances[instance_id]
+            if instance['State']['Name'] != 'terminated':
+                self.aws._set_state(instance, 'shutting-down', 32)
+        return {}
+
+    def start_instances(self, InstanceIds):
+        self._call('StartInstances')
+        for instance_id in InstanceIds:
+            instance = self.aws.instances[instance_id]
+            if instance['State']['Name'] != 'stopped':
+                raise client_error('IncorrectInstanceState', 'StartInstances', f"{instance_id} is {instance['State']['Name']}")
+            instance['starts'] = instance.get('starts', 0) + 1
+            self.aws._set_state(instance, 'pending', 0)
+        return {}
+
+    def stop_instances(self, InstanceIds):
+        self._call('StopInstances')
+        for instance_id in InstanceIds:
+            instance = self.aws.instances[instance_id]
+            if instance['State']['Name'] in ('pending', 'running'):
+                self.aws._set_state(instance, 'stopping', 64)
+        return {}
+
+    def modify_instance_attribute(self, InstanceId, **kwargs):
+        self._call('ModifyInstanceAttribute')
+        if 'InstanceType' in kwargs:
+            if self.aws.instances[InstanceId]['State']['Name'] != 'stopped':
+                raise client_error('IncorrectInstanceState', 'ModifyInstanceAttribute', f"{InstanceId} is not stopped")
+            self.aws.instances[InstanceId]['InstanceType'] = kwargs['InstanceType']['Value']
+        return {}
+
+    def describe_instance_status(self, InstanceIds):
+        # running instances only, their status checks pass a while after they start
+        self._call('DescribeInstanceStatus')
+        statuses = []
+        for instance_id in InstanceIds:
+            instance = self.aws.instances[instance_id]
+            if instance['State']['Name'] != 'running':
+                continue
+            check = 'ok' if self.aws.clock >= instance['since'] + self.aws.timeline['status_checks'] else 'initializing'
+            statuses.append({'InstanceId': instance_id, 'InstanceState': dict(instance['State']),
+                                'InstanceStatus': {'Status': check}, 'SystemStatus': {'Status': check}})
+        return {'InstanceStatuses': statuses}
+
+    def create_tags(self, Resources, Tags):
+        self._call('CreateTags')
+        for instance_id in Resources:
+            instance = self.aws.instances[instance_id]
+            keys = {tag['Key'] for tag in Tags}
+            instance['Tags'] = [tag for tag in instance['Tags'] if tag['Key'] not in keys] + list(Tags)
+        return {}
+
+    def delete_tags(self, Resources, Tags):
+        self._call('DeleteTags')
+        keys = {tag['Key'] for tag in Tags}
+        for instance_id in Resources:
+            instance = self.aws.instances[instance_id]
+            instance['Tags'] = [tag for tag in instance['Tags'] if tag['Key'] not in keys]
+        return {}
+
+    def describe_images(self, ImageIds):
+        self._call('DescribeImages')
+        missing = [image_id for image_id in ImageIds if image_id not in self.aws.images]
+        if missing:
+            raise client_error('InvalidAMIID.NotFound', 'DescribeImages')
+        return {'Images': [{'ImageId': image_id, 'State': self.aws.images[image_id]['State']} for image_id in ImageIds]}
+
+    def create_image(self, InstanceId, Name, **kwargs):
+        self._call('CreateImage')
+        image_id = self.aws.next_id('ami')
+        self.aws.images[image_id] = {'State': 'pending', 'created': self.aws.clock, 'Name': Name}
+        return {'ImageId': image_id}
+
+
+class FakePaginator:
+
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, PaginationConfig=None, **kwargs):
+        page_size = (PaginationConfig or {}).get('PageSize')
+        if page_size:
+            kwargs['MaxResults'] = page_size
+        while True:
+            page = self.method(**kwargs)
+            yield page
+            if not page.get('NextToken'):
+                return
+            kwargs['NextToken'] = page['NextToken']
+
+
+class FakeIAM(FakeClient):
+    service = 'iam'
+
+    def _arn(self, kind, name):
+        return f"arn:aws:iam::{self.aws.account}:{kind}/{name}"
+
+    def _create(self, kind, name, operation):
+        self._call(operation)
+        if name in self.aws.iam[kind]:
+            raise client_error('EntityAlreadyExists', operation)
+
+    def _require(self, kind, name, operation):
+        if name not in self.aws.iam[kind]:
+            raise client_error('NoSuchEntity', operation)
+        return self.aws.iam[kind][name]
+
+    def create_role(self, RoleName, **kwargs):
+        self._create('roles', RoleName, 'CreateRole')
+        self.aws.iam['roles'][RoleName] = {'policies': set()}
+        return {'Role': {'RoleName': RoleName, 'Arn': self._arn('role', RoleName)}}
+
+    def get_role(self, RoleName):
+        self._call('GetRole')
+        self._require('roles', RoleName, 'GetRole')
+        return {'Role': {'RoleName': RoleName, 'Arn': self._arn('role', RoleName)}}
+
+    def create_policy(self, PolicyName, **kwargs):
+        arn = self._arn('policy', PolicyName)
+        self._create('policies', arn, 'CreatePolicy')
+        self.aws.iam['policies'][arn] = {}
+        return self._respond('CreatePolicy', {'Policy': {'PolicyName': PolicyName, 'Arn': arn}})
+
+    def list_policies(self, Scope='All', **kwargs):
+        self._call('ListPolicies')
+        return {'Policies': [{'PolicyName': arn.split('/')[-1], 'Arn': arn} for arn in self.aws.iam['policies']],
+                'IsTruncated': False}
+
+    def get_paginator(self, operation):
+        return FakePaginator(getattr(self, operation))
+
+    def attach_role_policy(self, RoleName, PolicyArn):
+        self._call('AttachRolePolicy')
+        self._require('roles', RoleName, 'AttachRolePolicy')['policies'].add(PolicyArn)
+        return {}
+
+    def detach_role_policy(self, RoleName, PolicyArn):
+        self._call('DetachRolePolicy')
+        policies = self._require('roles', RoleName, 'DetachRolePolicy')['policies']
+        if PolicyArn not in policies:
+            raise client_error('NoSuchEntity', 'DetachRolePolicy')
+        policies.discard(PolicyArn)
+        return {}
+
+    def create_instance_profile(self, InstanceProfileName):
+        self._create('profiles', InstanceProfileName, 'CreateInstanceProfile')
+        self.aws.iam['profiles'][InstanceProfileName] = {'roles': []}
+        return {'InstanceProfile': {'InstanceProfileName': InstanceProfileName}}
+
+    def get_instance_profile(self, InstanceProfileName):
+        self._call('GetInstanceProfile')
+        profile = self._require('profiles', InstanceProfileName, 'GetInstanceProfile')
+        return {'InstanceProfile': {'InstanceProfileName': InstanceProfileName,
+                                    'Arn': self._arn('instance-profile', InstanceProfileName),
+                                    'Roles': [{'RoleName': role} for role in profile['roles']]}}
+
+    def add_role_to_instance_profile(self, InstanceProfileName, RoleName):
+        self._call('AddRoleToInstanceProfile')
+        profile = self._require('profiles', InstanceProfileName, 'AddRoleToInstanceProfile')
+        if profile['roles']:
+            raise client_error('LimitExceeded', 'AddRoleToInstanceProfile')
+        profile['roles'].append(RoleName)
+        return {}
+
+    def remove_role_from_instance_profile(self, InstanceProfileName, RoleName):
+        self._call('RemoveRoleFromInstanceProfile')
+        profile = self._require('profiles', InstanceProfileName, 'RemoveRoleFromInstanceProfile')
+        if RoleName not in profile['roles']:
+            raise client_error('NoSuchEntity', 'RemoveRoleFromInstanceProfile')
+        profile['roles'].remove(RoleName)
+        return {}
+
+    def delete_instance_profile(self, InstanceProfileName):
+        self._call('DeleteInstanceProfile')
+        self._require('profiles', InstanceProfileName, 'DeleteInstanceProfile')
+        del self.aws.iam['profiles'][InstanceProfileName]
+        return {}
+
+    def delete_policy(self, PolicyArn):
+        self._call('DeletePolicy')
+        self._require('policies', PolicyArn, 'DeletePolicy')
+        del self.aws.iam['policies'][PolicyArn]
+        return {}
+
+    def delete_role(self, RoleName):
+        self._call('DeleteRole')
+        role = self._require('roles', RoleName, 'DeleteRole')
+        if role['policies']:
+            raise client_error('DeleteConflict', 'DeleteRole', 'role has attached policies')
+        del self.aws.iam['roles'][RoleName]
+        return {}
+
@@ -0,0 +1,619 @@
+# Offline benchmarks for the resource handlers
+#
+# Drives every handler against the in-process fake in fake_aws, the way CloudFormation would:
+# IN_PROGRESS events are re-invoked with their callback context (round-tripped through JSON) and
+# resource model, after advancing the fake's clock by callbackDelaySeconds. Each scenario reports
+# wall time, AWS calls and callbacks, and is checked against budgets.json; any scenario over
+# budget makes the run exit with status 1. Nothing here uses the network.
+#
+#   python -m benchmarks.handler_bench                    # run and check against the budgets
+#   python -m benchmarks.handler_bench --latency 0.02     # add 20ms to every AWS call (default 2ms)
+#   python -m benchmarks.handler_bench --throttle         # enforce the fake's per-operation TPS limits
+#   python -m benchmarks.handler_bench --write-budgets    # record the current numbers as the budgets
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from cloudformation_cli_python_lib import HandlerErrorCode, OperationStatus  # noqa: E402
+
+from eq_monitor_nagios import handlers, perfdata_exporter, polling  # noqa: E402
+from eq_monitor_nagios.clients import clear_client_cache  # noqa: E402
+from eq_monitor_nagios.constants import (  # noqa: E402
+    const_key_nagios_stats,
+    const_key_status,
+    const_tag_warm_pool_claim,
+    default_api_tps,
+    default_ssm_ami_parameter,
+    default_ssm_path,
+)
+from eq_monitor_nagios.models import ResourceHandlerRequest, ResourceModel, TypeConfigurationModel  # noqa: E402
+from eq_monitor_nagios.rate_limit import set_rate_limits  # noqa: E402
+
+from .fake_aws import FakeAWS, VirtualClock, default_tps, instance_profile_not_ready_fault  # noqa: E402
+
+budgets_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'budgets.json')
+
+# seconds added to every AWS call unless --latency says otherwise
+default_latency = 0.002
+
+# wall time may exceed its budget by this fraction, or by the floor for very fast scenarios
+wall_time_tolerance = 0.5
+wall_time_floor = 0.25
+
+# the most invocations one scenario may take before it is treated as hung
+max_invocations = 500
+
+list_server_count = 10000
+list_region_server_count = 2000
+
+# monitoring targets for the sync scenario, and how many of them come and go before the measured update
+sync_target_count = 2000
+sync_churn = 20
+sync_targets = [{'Key': 'monitor', 'Values': ['nagios']}]
+
+# the largest fleet one create makes, and the monitoring targets of the large sync scenario
+large_fleet_count = 40
+large_sync_target_count = 5000
+
+# servers already in the shard group before the measured create adds one more
+shard_group_size = 3
+
+# services whose checks Nagios writes to the perfdata file a few times in each of a few intervals,
+# moving the file aside after each
+perfdata_host_count = 2000
+perfdata_service_count = 5
+perfdata_checks_per_interval = 2
+perfdata_intervals = 3
+
+base_model = {
+    'Name': 'bench-nagios',
+    'SubnetId': 'subnet-0bench',
+    'SecurityGroupId': 'sg-0bench',
+}
+
+
+def make_request(desired=None, previous=None, next_token=None, type_configuration=None):
+    return ResourceHandlerRequest(
+        clientRequestToken='bench',
+        desiredResourceState=ResourceModel._deserialize(desired) if desired else None,
+        previousResourceState=ResourceModel._deserialize(previous) if previous else None,
+        desiredResourceTags=None,
+        previousResourceTags=None,
+        systemTags=None,
+        previousSystemTags=None,
+        awsAccountId='123456789012',
+        logicalResourceIdentifier='NagiosServer',
+        typeConfiguration=TypeConfigurationModel._deserialize(type_configuration),
+        nextToken=next_token,
+        region='us-east-1',
+        awsPartition='aws',
+        stackId=None,
+    )
+
+
+def drive(aws, handler, desired=None, previous=None):
+    # Invokes the handler until it returns a terminal event, returning the event and the callback count
+    callback_context = {}
+    callbacks = 0
+    while True:
+        progress = handler(aws.session(), make_request(desired, previous), callback_context)
+        if progress.status != OperationStatus.IN_PROGRESS:
+            return progress, callbacks
+        if callbacks >= max_invocations:
+            raise RuntimeError(f"{handler.__name__} still in progress after {callbacks} callbacks")
+        callbacks += 1
+        # CloudFormation stores the context and model as JSON between invocations
+        callback_context = json.loads(json.dumps(progress.callbackContext or {}))
+        if progress.resourceModel is not None:
+            desired = json.loads(json.dumps(progress.resourceModel._serialize()))
+        aws.advance(progress.callbackDelaySeconds)
+
+
+def create_server(aws, **properties):
+    progress, callbacks = drive(aws, handlers.create_handler, dict(base_model, **properties))
+    if progress.status != OperationStatus.SUCCESS:
+        raise RuntimeError(f"create failed: {progress.message}")
+    return progress.resourceModel._serialize(), callbacks
+
+
+def scenario_create(aws):
+    return create_server(aws)[1]
+
+
+def scenario_create_shared_role(aws):
+    create_server(aws, SharedRole=True)
+    aws.reset_counters()
+    return create_server(aws, SharedRole=True)[1]
+
+
+def scenario_create_image_cache(aws):
+    create_server(aws, ImageCache=True)
+    aws.advance(aws.timeline['image'])
+    aws.reset_counters()
+    return create_server(aws, ImageCache=True)[1]
+
+
+def scenario_create_warm_pool(aws):
+    # the first create fills the pool, the measured one starts a pool instance once they are built
+    create_server(aws, WarmPoolSize=1)
+    aws.advance(sum(seconds for _, seconds in aws.status_schedule) + aws.timeline['pending'])
+    aws.reset_counters()
+    return create_server(aws, WarmPoolSize=1)[1]
+
+
+def scenario_create_warm_pool_retry(aws):
+    # a claim whose start is throttled starts the same pool instance again rather than claiming another
+    create_server(aws, WarmPoolSize=2)
+    aws.advance(sum(seconds for _, seconds in aws.status_schedule) + aws.timeline['pending'])
+    aws.reset_counters()
+    aws.faults['ec2:CreateTags'] = ['ThrottlingException']
+    model, callbacks = create_server(aws, WarmPoolSize=2)
+    claimed = [instance_id for instance_id, instance in aws.instances.items()
+                if any(tag['Key'] == const_tag_warm_pool_claim for tag in instance['Tags'])]
+    if claimed != [model['Id']] or aws.instances[model['Id']]['State']['Name'] != 'running':
+        raise RuntimeError(f"retried claim took {claimed}, server is {model['Id']}")
+    return callbacks
+
+
+def scenario_create_high_volume(aws):
+    # the tuned profile picks its own instance type
+    model, callbacks = create_server(aws, PerformanceProfile='HighVolume')
+    if aws.instances[model['Id']]['InstanceType'] != 'c5.xlarge':
+        raise RuntimeError(f"HighVolume server launched as {aws.instances[model['Id']]['InstanceType']}")
+    return callbacks
+
+
+def scenario_create_iam_retry(aws):
+    # a launch EC2 rejects while the new instance profile propagates is retried in the same invocation
+    aws.faults['ec2:RunInstances'] = [instance_profile_not_ready_fault] * 2
+    model, callbacks = create_server(aws)
+    if aws.calls['ec2:RunInstances'] != 3 or len(aws.instances) != 1:
+        raise RuntimeError(f"launch made {aws.calls['ec2:RunInstances']} calls for {len(aws.instances)} instances")
+    return callbacks
+
+
+def scenario_create_resume(aws):
+    # a create throttled past its retries halfway through its IAM steps carries on from that step
+    aws.faults['iam:CreateInstanceProfile'] = ['ThrottlingException']
+    model, callbacks = create_server(aws)
+    if aws.calls['iam:CreateRole'] != 1 or aws.calls['iam:CreatePolicy'] != 1 or len(aws.iam['roles']) != 1:
+        raise RuntimeError(f"resumed create repeated finished steps: {dict(aws.calls)}")
+    if aws.instances[model['Id']]['State']['Name'] != 'running':
+        raise RuntimeError('resumed create left no running server')
+    return callbacks
+
+
+def scenario_create_lost_launch(aws):
+    # a launch whose response is lost is repeated with the same client token, launching nothing twice
+    aws.lost_responses['ec2:RunInstances'] = ['ThrottlingException']
+    model, callbacks = create_server(aws)
+    if len(aws.instances) != 1 or model['Id'] not in aws.instances:
+        raise RuntimeError(f"repeated launch left instances {sorted(aws.instances)}")
+    return callbacks
+
+
+def scenario_create_lost_policy(aws):
+    # a policy whose response is lost is looked up by name when the repeated create finds it exists
+    aws.lost_responses['iam:CreatePolicy'] = ['ThrottlingException']
+    _, callbacks = create_server(aws)
+    attached = set().union(*(role['policies'] for role in aws.iam['roles'].values()))
+    if len(aws.iam['policies']) != 1 or not set(aws.iam['policies']) <= attached:
+        raise RuntimeError(f"role has policies {sorted(attached)}, IAM has {sorted(aws.iam['policies'])}")
+    return callbacks
+
+
+def scenario_create_rollback(aws):
+    # a fleet whose second launch fails removes the instances and IAM objects the create had made
+    aws.faults['ec2:RunInstances'] = [None, 'InsufficientInstanceCapacity']
+    progress, callbacks = drive(aws, handlers.create_handler, dict(base_model, Count=4, SubnetIds=['subnet-0a', 'subnet-0b']))
+    if progress.status != OperationStatus.FAILED or 'rolled back' not in (progress.message or ''):
+        raise RuntimeError(f"create finished with {progress.status}: {progress.message}")
+    if not aws.instances or any(instance['State']['Name'] != 'terminated' for instance in aws.instances.values()):
+        raise RuntimeError('rollback left instances running')
+    if any(aws.iam.values()):
+        raise RuntimeError(f"rollback left IAM objects {aws.iam}")
+    return callbacks
+
+
+def scenario_create_fleet(aws):
+    model, callbacks = create_server(aws, Count=6, SubnetIds=['subnet-0a', 'subnet-0b', 'subnet-0c'])
+    if len(model.get('Members') or []) != 6 or not all(member.get('IP') for member in model['Members']):
+        raise RuntimeError(f"fleet create returned members {model.get('Members')}")
+    return callbacks
+
+
+def scenario_create_fleet_large(aws):
+    # the largest fleet's record only fits in an advanced parameter
+    model, callbacks = create_server(aws, Count=large_fleet_count, SubnetIds=['subnet-0a', 'subnet-0b', 'subnet-0c'])
+    if len(model.get('Members') or []) != large_fleet_count or not all(member.get('IP') for member in model['Members']):
+        raise RuntimeError(f"fleet create returned {len(model.get('Members') or [])} members")
+    return callbacks
+
+
+def scenario_delete_fleet(aws):
+    model, _ = create_server(aws, Count=6, SubnetIds=['subnet-0a', 'subnet-0b', 'subnet-0c'])
+    aws.reset_counters()
+    progress, callbacks = drive(aws, handlers.delete_handler, model)
+    expect_success('delete', progress)
+    if any(instance['State']['Name'] != 'terminated' for instance in aws.instances.values()):
+        raise RuntimeError('fleet delete left instances running')
+    return callbacks
+
+
+def scenario_delete_fleet_purged(aws):
+    # a member that was terminated by hand and purged doesn't stop the rest of the fleet being terminated
+    model, _ = create_server(aws, Count=6, SubnetIds=['subnet-0a', 'subnet-0b', 'subnet-0c'])
+    del aws.instances[model['Members'][2]['Id']]
+    aws.reset_counters()
+    progress, callbacks = drive(aws, handlers.delete_handler, model)
+    expect_success('delete', progress)
+    if len(aws.instances) != 5 or any(instance['State']['Name'] != 'terminated' for instance in aws.instances.values()):
+        raise RuntimeError('fleet delete left instances running')
+    return callbacks
+
+
+def scenario_read(aws):
+    model, _ = create_server(aws)
+    aws.reset_counters()
+    progress, callbacks = drive(aws, handlers.read_handler, {'Id': model['Id']})
+    expect_success('read', progress)
+    if progress.resourceModel.NagiosStats is None:
+        raise RuntimeError('read returned no Nagios statistics')
+    return callbacks
+
+
+def scenario_update(aws):
+    model, _ = create_server(aws)
+    aws.reset_counters()
+    progress, callbacks = drive(aws, handlers.update_handler, dict(model, Name='bench-nagios-renamed'), model)
+    expect_success('update', progress)
+    return callbacks
+
+
+def scenario_resize(aws):
+    # resizing a fleet in place keeps its instances and refreshes their IPs
+    model, _ = create_server(aws, Count=2)
+    aws.reset_counters()
+    progress, callbacks = drive(aws, handlers.update_handler, dict(model, InstanceType='m5.large'), model)
+    expect_success('resize', progress)
+    resized = progress.resourceModel._serialize()
+    members = resized['Members']
+    if [member['Id'] for member in members] != [member['Id'] for member in model['Members']] \
+            or any(aws.instances[member['Id']]['InstanceType'] != 'm5.large' for member in members):
+        raise RuntimeError('fleet instances were replaced or not resized')
+    if any(member['IP'] != aws.instances[member['Id']]['PublicIpAddress'] for member in members) or resized['IP'] == model['IP']:
+        raise RuntimeError('IPs not refreshed after the resize')
+    return callbacks
+
+
+def scenario_resize_rollback(aws):
+    # a resize that fails keeps the old type in the record, and the rollback update brings the server back
+    model, _ = create_server(aws)
+    original_type = aws.instances[model['Id']]['InstanceType']
+    resized = dict(model, InstanceType='m5.large')
+    aws.faults['ec2:StopInstances'] = ['IncorrectInstanceState']
+    progress, _ = drive(aws, handlers.update_handler, resized, model)
+    if progress.status != OperationStatus.FAILED or progress.errorCode != HandlerErrorCode.InternalFailure or 'IncorrectInstanceState' not in progress.message:
+        raise RuntimeError(f"failed stop reported as {progress.errorCode}: {progress.message}")
+    aws.faults['ec2:ModifyInstanceAttribute'] = ['UnsupportedOperation']
+    progress, _ = drive(aws, handlers.update_handler, resized, model)
+    if progress.status != OperationStatus.FAILED:
+        raise RuntimeError(f"failed resize finished with {progress.status}")
+    aws.reset_counters()
+    progress, callbacks = drive(aws, handlers.update_handler, model, resized)
+    expect_success('rollback update', progress)
+    instance = aws.instances[model['Id']]
+    if instance['State']['Name'] != 'running' or instance['InstanceType'] != original_type:
+        raise RuntimeError(f"rolled back server is {instance['State']['Name']} on {instance['InstanceType']}")
+    return callbacks
+
+
+def scenario_delete(aws):
+    model, _ = create_server(aws)
+    aws.reset_counters()
+    progress, callbacks = drive(aws, handlers.delete_handler, model)
+    expect_success('delete', progress)
+    return callbacks
+
+
+def scenario_delete_warm_pool(aws):
+    # deleting the last server using a warm pool terminates the pool and removes the shared role with it
+    first, _ = create_server(aws, WarmPoolSize=1)
+    aws.advance(sum(seconds for _, seconds in aws.status_schedule) + aws.timeline['pending'])
+    second, _ = create_server(aws, WarmPoolSize=1)
+    expect_success('delete', drive(aws, handlers.delete_handler, first)[0])
+    if not aws.iam['roles'] or all(instance['State']['Name'] == 'terminated' for instance_id, instance in aws.instances.items()
+                                    if instance_id != first['Id']):
+        raise RuntimeError('deleting a server drained a warm pool another server still uses')
+    aws.reset_counters()
+    progress, callbacks = drive(aws, handlers.delete_handler, second)
+    expect_success('delete', progress)
+    if any(instance['State']['Name'] != 'terminated' for instance in aws.instances.values()) or any(aws.iam.values()):
+        raise RuntimeError(f"last delete left instances {sorted(aws.instances)} or IAM objects {aws.iam}")
+    return callbacks
+
+
+def scenario_sync_targets(aws):
+    # the create syncs every target, the measured update only the instances that came and went since
+    for _ in range(sync_target_count):
+        aws.seed_instance({'monitor': 'nagios'})
+    model, _ = create_server(aws, Targets=sync_targets)
+    for instance_id in list(aws.instances)[:sync_churn]:
+        aws.instances[instance_id]['State'] = {'Name': 'terminated', 'Code': 48}
+    for _ in range(sync_churn):
+        aws.seed_instance({'monitor': 'nagios'})
+    aws.reset_counters()
+    progress, callbacks = drive(aws, handlers.update_handler, model, model)
+    expect_success('update', progress)
+    expected = {instance_id for instance_id, instance in aws.instances.items()
+                if instance['State']['Name'] == 'running' and any(tag['Key'] == 'monitor' for tag in instance['Tags'])}
+    if aws.nagios_configs.get(model['Id']) != expected:
+        raise RuntimeError(f"server has {len(aws.nagios_configs.get(model['Id']) or ())} host configs, expected {len(expected)}")
+    return callbacks
+
+
+def scenario_sync_targets_large(aws):
+    # a create syncing thousands of targets keeps every bucket of its state within a standard parameter
+    for _ in range(large_sync_target_count):
+        aws.seed_instance({'monitor': 'nagios'})
+    model, callbacks = create_server(aws, Targets=sync_targets)
+    if len(aws.nagios_configs.get(model['Id']) or ()) != large_sync_target_count:
+        raise RuntimeError(f"server has {len(aws.nagios_configs.get(model['Id']) or ())} host configs, expected {large_sync_target_count}")
+    return callbacks
+
+
+def scenario_shard_rebalance(aws):
+    # a server joining a group of three takes about a quarter of the hosts, and only those move
+    for _ in range(sync_target_count):
+        aws.seed_instance({'monitor': 'nagios'})
+    servers = [create_server(aws, Targets=sync_targets, ShardGroup='bench')[0]['Id'] for _ in range(shard_group_size)]
+    before = {server_id: set(aws.nagios_configs[server_id]) for server_id in servers}
+    aws.reset_counters()
+    model, callbacks = create_server(aws, Targets=sync_targets, ShardGroup='bench')
+    servers.append(model['Id'])
+    after = {server_id: aws.nagios_configs.get(server_id, set()) for server_id in servers}
+    if sorted(host for hosts in after.values() for host in hosts) != sorted(set().union(*after.values())) \
+            or len(set().union(*after.values())) != sync_target_count:
+        raise RuntimeError('shard group hosts overlap or are missing after the rebalance')
+    moved = sum(len(before[server_id] - after[server_id]) for server_id in before)
+    if moved != len(after[model['Id']]) or moved > sync_target_count / 2:
+        raise RuntimeError(f"{moved} hosts moved, the new server has {len(after[model['Id']])}")
+    return callbacks
+
+
+def scenario_list(aws):
+    for index in range(list_server_count):
+        instance_id = f"i-{index:017x}"
+        aws.seed_record(default_ssm_path, instance_id, {'instance_id': instance_id, 'name': f"nagios-{index}",
+                                                        'ip': f"10.1.{index // 250}.{index % 250}"})
+    listed = 0
+    pages = 0
+    next_token = None
+    while True:
+        progress = handlers.list_handler(aws.session(), make_request(next_token=next_token), {})
+        expect_success('list', progress)
+        listed += len(progress.resourceModels or [])
+        pages += 1
+        next_token = progress.nextToken
+        if not next_token:
+            break
+    if listed != list_server_count:
+        raise RuntimeError(f"list returned {listed} of {list_server_count} servers")
+    # every page after the first is a separate invocation, driven by nextToken
+    return pages - 1
+
+
+def scenario_list_regions(aws):
+    # one inventory of the three regions in the type configuration, each swept on its own thread
+    regions = [aws.region, 'eu-west-1', 'ap-southeast-2']
+    for region in regions:
+        for index in range(list_region_server_count):
+            instance_id = f"i-{regions.index(region):02x}{index:015x}"
+            aws.in_region(region).seed_record(default_ssm_path, instance_id, {'instance_id': instance_id, 'name': f"nagios-{index}"})
+    listed = []
+    pages = 0
+    next_token = None
+    while True:
+        request = make_request(next_token=next_token, type_configuration={'ListRegions': regions})
+        progress = handlers.list_handler(aws.session(), request, {})
+        expect_success('list_regions', progress)
+        listed.extend((model.Region, model.Id) for model in progress.resourceModels or [])
+        pages += 1
+        next_token = progress.nextToken
+        if not next_token:
+            break
+    if len(set(listed)) != len(listed) or sorted(Counter(region for region, _ in listed).values()) != [list_region_server_count] * len(regions):
+        raise RuntimeError(f"list returned {Counter(region for region, _ in listed)} servers per region")
+    return pages - 1
+
+
+def scenario_perfdata_export(aws):
+    # the exporter folds each interval's checks into one statistic set per series, in full batches
+    model, callbacks = create_server(aws, MetricsExport=True)
+    if 'nagios-perfdata-exporter' not in aws.instances[model['Id']]['user_data']:
+        raise RuntimeError('server was launched without the perfdata exporter')
+
+    batches = []
+
+    def send(datums):
+        aws.call('cloudwatch', 'PutMetricData')
+        batches.append(datums)
+
+    aggregator = perfdata_exporter.Aggregator(send, clock=lambda: aws.clock)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'service-perfdata')
+        open(path, 'w').close()
+        tail = perfdata_exporter.FileTail(path)
+        list(tail.read_lines())
+        for interval in range(perfdata_intervals):
+            with open(path, 'a') as perfdata:
+                for check in range(perfdata_checks_per_interval):
+                    for host in range(perfdata_host_count):
+                        for service in range(perfdata_service_count):
+                            perfdata.write(f"{1700000000 + interval * 60 + check}\thost-{host}\tservice-{service}\t0.{check}01\t0.05\t"
+                                            f"'time'={check}.5ms;100;200;0 size=1{check}B\n")
+            os.rename(path, f"{path}.rotated")
+            open(path, 'w').close()
+            for line in tail.read_lines():
+                parsed = perfdata_exporter.parse_line(line)
+                if parsed is not None:
+                    aggregator.add(*parsed)
+            aggregator.flush()
+
+    # latency, execution time and two perfdata values per service
+    series = perfdata_host_count * perfdata_service_count * 4
+    datums = [datum for batch in batches for datum in batch]
+    if len(batches) != perfdata_intervals * -(-series // perfdata_exporter.max_batch_datums) \
+            or max(len(batch) for batch in batches) > perfdata_exporter.max_batch_datums:
+        raise RuntimeError(f"{series} series a minute sent in {len(batches)} batches of up to {max(len(batch) for batch in batches)}")
+    if len(datums) != series * perfdata_intervals \
+            or any(datum['StatisticValues']['SampleCount'] != perfdata_checks_per_interval for datum in datums):
+        raise RuntimeError('perfdata samples were lost or counted twice')
+    return callbacks
+
+
+def expect_success(name, progress):
+    if progress.status != OperationStatus.SUCCESS:
+        raise RuntimeError(f"{name} finished with {progress.status}: {progress.message}")
+
+
+scenarios = {
+    'create': scenario_create,
+    'create_shared_role': scenario_create_shared_role,
+    'create_image_cache': scenario_create_image_cache,
+    'create_warm_pool': scenario_create_warm_pool,
+    'create_warm_pool_retry': scenario_create_warm_pool_retry,
+    'create_high_volume': scenario_create_high_volume,
+    'create_iam_retry': scenario_create_iam_retry,
+    'create_resume': scenario_create_resume,
+    'create_lost_launch': scenario_create_lost_launch,
+    'create_lost_policy': scenario_create_lost_policy,
+    'create_rollback': scenario_create_rollback,
+    'create_fleet': scenario_create_fleet,
+    'create_fleet_large': scenario_create_fleet_large,
+    'read': scenario_read,
+    'update': scenario_update,
+    'resize': scenario_resize,
+    'resize_rollback': scenario_resize_rollback,
+    'delete': scenario_delete,
+    'delete_fleet': scenario_delete_fleet,
+    'delete_fleet_purged': scenario_delete_fleet_purged,
+    'delete_warm_pool': scenario_delete_warm_pool,
+    'sync_targets': scenario_sync_targets,
+    'sync_targets_large': scenario_sync_targets_large,
+    'shard_rebalance': scenario_shard_rebalance,
+    'list_10k': scenario_list,
+    'list_regions': scenario_list_regions,
+    'perfdata_export': scenario_perfdata_export,
+}
+
+
+def run_scenario(name, latency, throttle):
+    aws = FakeAWS(latency=latency, tps=default_tps if throttle else None,
+                  status_path=f"{default_ssm_path}/{const_key_status}", stats_path=f"{default_ssm_path}/{const_key_nagios_stats}")
+    aws.parameters[default_ssm_ami_parameter] = {'Value': 'ami-0base', 'Type': 'String'}
+    clock = VirtualClock(aws)
+    handlers.time = clock
+    polling.time = clock
+    clear_client_cache()
+    # the unthrottled fake has no limits to stay under, so the client-side rate limiter only runs with --throttle
+    set_rate_limits(default_api_tps if throttle else {})
+
+    try:
+        callbacks = scenarios[name](aws)
+        error = None
+    except Exception as err:
+        callbacks = None
+        error = f"{type(err).__name__}: {err}"
+    wall = time.perf_counter() - aws.measuring_since
+
+    return {
+        'wall_seconds': round(wall, 3),
+        'callbacks': callbacks,
+        'calls': sum(aws.calls.values()),
+        'calls_by_operation': dict(sorted(aws.calls.items())),
+        'throttled': sum(aws.throttled.values()),
+        'error': error,
+    }
+
+
+def check_budget(result, budget, check_wall):
+    problems = []
+    if result['calls'] > budget['calls']:
+        problems.append(f"{result['calls']} AWS calls, budget {budget['calls']}")
+    for operation, count in result['calls_by_operation'].items():
+        allowed = budget['calls_by_operation'].get(operation, 0)
+        if count > allowed:
+            problems.append(f"{count} {operation} calls, budget {allowed}")
+    if result['callbacks'] > budget['callbacks']:
+        problems.append(f"{result['callbacks']} callbacks, budget {budget['callbacks']}")
+    if check_wall:
+        allowed = max(budget['wall_seconds'] * (1 + wall_time_tolerance), budget['wall_seconds'] + wall_time_floor)
+        if result['wall_seconds'] > allowed:
+            problems.append(f"{result['wall_seconds']}s wall time, budget {round(allowed, 3)}s")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the resource handlers against a fake AWS backend')
+    parser.add_argument('--latency', type=float, default=default_latency, help='seconds added to every AWS call')
+    parser.add_argument('--throttle', action='store_true', help="throttle calls over the fake's per-operation TPS")
+    parser.add_argument('--scenario', action='append', choices=sorted(scenarios), help='run only this scenario (repeatable)')
+    parser.add_argument('--write-budgets', action='store_true', help='store the results as the new budgets')
+    parser.add_argument('--verbose', action='store_true', help='show handler logging')
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.NOTSET if args.verbose else logging.CRITICAL)
+    settings = {'latency': args.latency, 'throttle': args.throttle}
+    budgets = {}
+    if os.path.exists(budgets_path):
+        with open(budgets_path) as f:
+            budgets = json.load(f)
+    # wall time only compares with budgets measured under the same settings
+    check_wall = budgets.get('settings') == settings
+
+    results = {}
+    failed = []
+    for name in args.scenario or scenarios:
+        result = run_scenario(name, args.latency, args.throttle)
+        results[name] = result
+        budget = budgets.get('scenarios', {}).get(name)
+        if result['error'] or not budget or args.write_budgets:
+            problems = [result['error']] if result['error'] else []
+        else:
+            problems = check_budget(result, budget, check_wall)
+        if problems:
+            failed.append(name)
+        status = 'FAIL' if problems else ('new' if budget is None else 'ok')
+        print(f"{name:20} {status:4} {result['wall_seconds']:8.3f}s {result['calls']:6} calls "
+              f"{result['callbacks'] if result['callbacks'] is not None else '-':>4} callbacks "
+              f"{result['throttled']:4} throttled")
+        for problem in problems:
+            print(f"{'':20}      {problem}")
+        top = Counter(result['calls_by_operation']).most_common(4)
+        print(f"{'':20}      " + ', '.join(f"{operation} {count}" for operation, count in top))
+
+    if args.write_budgets and not failed:
+        budgets = {'settings': settings, 'scenarios': dict(budgets.get('scenarios', {}))}
+        for name, result in results.items():
+            budgets['scenarios'][name] = {key: result[key] for key in ('wall_seconds', 'callbacks', 'calls', 'calls_by_operation')}
+        with open(budgets_path, 'w') as f:
+            json.dump(budgets, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"Budgets written to {budgets_path}")
+
+    if failed:
+        print(f"Over budget or failed: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+# Cache of boto3 clients
+#
+# Building a client resolves endpoints and loads the service model, which costs more than most
+# of the calls the handlers make with it. Clients are kept at module level so they are reused
+# within an invocation and across warm Lambda invocations. Entries are keyed by service, region
+# and the credentials of the session; when the credentials rotate (CloudFormation hands each
+# invocation its own temporary credentials), the client built with the old ones is replaced.
+# A client for another region than the session's, as multi-region listing uses, is cached under
+# that region.
+# Each new client uses botocore's adaptive retry mode, is instrumented for the per-call metrics
+# in metrics.py, and waits for the shared rate limits in rate_limit.py.
+import hashlib
+import logging
+import threading
+from typing import Optional
+
+from botocore.config import Config
+
+from .constants import default_retry_max_attempts, default_retry_mode
+from .metrics import instrument_client
+from .rate_limit import rate_limit_client
+
+LOG = logging.getLogger(__name__)
+
+client_cache_max_size = 32
+client_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+client_config = Config(retries={'mode': default_retry_mode, 'max_attempts': default_retry_max_attempts})
+
+_client_cache = {}
+_client_cache_lock = threading.Lock()
+
+
+def get_client(session, service: str, region: Optional[str] = None):
+    return _get_cached(session, service, region)
+
+
+def clear_client_cache() -> None:
+    with _client_cache_lock:
+        _client_cache.clear()
+
+
+def client_cache_summary() -> str:
+    return (f"Client cache: {client_cache_stats['hits']} hits, {client_cache_stats['misses']} misses, "
+            f"{client_cache_stats['evictions']} evictions, {len(_client_cache)} cached")
+
+
+def _session_identity(session):
+    # SessionProxy keeps the boto3 session it was built from
+    boto_session = getattr(session, 'session', None)
+    if boto_session is None:
+        return None
+    credentials = boto_session.get_credentials()
+    if credentials is None:
+        return None
+    frozen = credentials.get_frozen_credentials()
+    secret = f"{frozen.access_key}:{frozen.secret_key}:{frozen.token}".encode('utf-8')
+    return boto_session.region_name, hashlib.sha256(secret).hexdigest()
+
+
+def _get_cached(session, service: str, region: Optional[str] = None):
+    factory = session.client
+    identity = _session_identity(session)
+    if identity is None:
+        # nothing stable to key on, so don't cache
+        client_cache_stats['misses'] += 1
+        return _build(factory, service, region)
+
+    session_region, fingerprint = identity
+    region = region or session_region
+    slot = (service, region)
+    with _client_cache_lock:
+        cached = _client_cache.get(slot)
+        if cached is not None and cached[0] == fingerprint:
+            client_cache_stats['hits'] += 1
+            return cached[1]
+
+        if cached is not None:
+            LOG.info(f"...Credentials rotated, evicting cached {service} client for {region}")
+            client_cache_stats['evictions'] += 1
+        elif len(_client_cache) >= client_cache_max_size:
+            _client_cache.pop(next(iter(_client_cache)))
+            client_cache_stats['evictions'] += 1
+
+        client_cache_stats['misses'] += 1
+        client = _build(factory, service, None if region == session_region else region)
+        _client_cache[slot] = (fingerprint, client)
+
+    return client
+
+
+def _build(factory, service: str, region: Optional[str] = None):
+    client = factory(service, region_name=region, config=client_config) if region else factory(service, config=client_config)
+    instrument_client(client)
+    rate_limit_client(client)
+    return client
@@ -0,0 +1,205 @@
+# Shared defaults and SSM key names used by the handlers and their helpers
+
+default_server_name = 'Nagios Server'
+default_warm_pool_name = 'Nagios Server (warm pool)'
+default_instance_type = 't2.small'
+default_ssm_ami_parameter = '/aws/service/ami-amazon-linux-latest/amzn2-ami-hvm-x86_64-gp2'
+default_ssm_path = '/Eq/Nagios/Monitor/Stack'
+ssm_managed_instance_policy_arn = 'arn:aws:iam::aws:policy/AmazonSSMManagedInstanceCore'
+default_nagios_version = '4.4.5'
+default_plugins_version = '2.2.1'
+default_image_bake_timeout = 3600
+default_list_page_size = 50
+
+# get_parameters, get_parameters_by_path and delete_parameters take at most 10 names per call, and
+# a standard parameter holds at most 4096 characters
+ssm_batch_size = 10
+ssm_parameter_max_chars = 4096
+
+# bounds on the callback delay picked by the create polling scheduler, in seconds, and how many
+# durations per phase its history keeps
+default_poll_min_delay = 5
+default_poll_max_delay = 60
+default_poll_overrun_fraction = 0.2
+default_poll_history_size = 20
+
+# run_instances retries while a new instance profile propagates: seconds of backoff spent in one
+# invocation, before handing back to CloudFormation, and in total, before failing the create
+default_iam_retry_base_delay = 1
+default_iam_retry_max_delay = 8
+default_iam_retry_budget = 20
+default_iam_retry_callback_period = 10
+default_iam_propagation_timeout = 300
+
+const_key_instance_id = 'instance_id'
+const_key_name = 'server_name'
+const_key_policy_arn = 'policy_arn'
+const_key_role = 'role'
+const_key_instance_profile = 'instance_profile'
+const_key_IP = 'IP'
+const_key_URL = 'URL'
+const_key_status = 'status'
+const_key_subnet = 'subnet_id'
+const_key_sg = 'security_groups'
+model_key_list = [const_key_instance_id, const_key_name,
+                    const_key_policy_arn, const_key_role, const_key_instance_profile,
+                    const_key_IP, const_key_URL,
+                    const_key_status,
+                    const_key_subnet, const_key_sg]
+
+# delete runs its teardown steps on this many threads, retries failed steps on up to
+# default_delete_max_attempts invocations, and polls for termination with a backoff
+# starting at default_delete_poll_delay seconds, for at most default_delete_max_polls callbacks
+default_teardown_workers = 4
+default_delete_max_attempts = 3
+default_delete_poll_delay = 5
+default_delete_max_polls = 20
+
+# create runs its independent steps on this many threads
+default_create_workers = 4
+
+# record keys beyond the legacy per-key layout; a fleet's record lists every member
+# with its instance_id, subnet_id, IP and URL
+const_key_shared_member = 'shared_role_member'
+const_key_members = 'members'
+const_key_subnet_ids = 'subnet_ids'
+const_key_targets = 'targets'
+const_key_shard_group = 'shard_group'
+const_key_instance_type = 'instance_type'
+const_key_performance_profile = 'performance_profile'
+const_key_metrics_export = 'metrics_export'
+const_key_warm_pool = 'warm_pool'
+record_key_list = model_key_list + [const_key_shared_member, const_key_members, const_key_subnet_ids, const_key_targets,
+                                    const_key_shard_group, const_key_instance_type, const_key_performance_profile,
+                                    const_key_metrics_export, const_key_warm_pool]
+# set by update when a resize failed partway, so the next update resizes whatever the types say
+const_key_resize_incomplete = 'resize_incomplete'
+
+# callback context keys that are not part of the server record
+const_key_iam_created = 'iam_created_at'
+const_key_iam_propagation = 'iam_propagation_seconds'
+const_key_image_base = 'image_base'
+const_key_poll_phase = 'poll_phase'
+const_key_poll_since = 'poll_phase_since'
+const_key_poll_durations = 'poll_durations'
+const_key_delete_record = 'delete_record'
+const_key_delete_done = 'delete_done'
+const_key_delete_attempts = 'delete_attempts'
+const_key_delete_polls = 'delete_polls'
+const_key_fleet_launched = 'fleet_launched'
+const_key_target_sync = 'target_sync'
+const_key_resize = 'resize'
+# set in the delete record when the server is the last user of its warm pool, see drain_warm_pool
+const_key_warm_pool_member = 'warm_pool_member'
+
+# create checkpoints: the finished create steps and how long each took in ms, the suffix of the IAM
+# names the server's own role, policy and instance profile get, the image it launches from and
+# whether that is a baked one, the instance taken from a warm pool, and the failure a rollback is undoing
+const_key_create_done = 'create_done'
+const_key_create_timings = 'create_timings'
+const_key_create_suffix = 'create_suffix'
+const_key_image_id = 'image_id'
+const_key_image_cached = 'image_cached'
+const_key_warm_pool_claimed = 'warm_pool_claimed'
+const_key_create_rollback = 'create_rollback'
+
+# keys in a server's SSM record document
+const_key_record = 'record'
+const_key_record_version = 'version'
+record_version = 1
+
+# subtree of default_ssm_path holding baked image ids, and the parameter holding poll phase history
+const_key_image_cache = 'image_cache'
+const_key_poll_history = 'poll_history'
+
+# subtree of default_ssm_path with one parameter per server using the shared role
+const_key_shared_role_members = 'shared_role_members'
+
+# subtrees of default_ssm_path with the claim on each instance taken from a warm pool and one
+# parameter per server using each pool, and the tags marking warm pool members and the create that
+# claimed one
+const_key_warm_pool_claims = 'warm_pool_claims'
+const_key_warm_pool_users = 'warm_pool_users'
+const_tag_warm_pool = 'eq:nagios:warm-pool'
+const_tag_warm_pool_claim = 'eq:nagios:warm-pool-claim'
+
+# subtree of default_ssm_path where the user data script records each stage's start and end time,
+# and the attempts the AWS CLI on the instance makes at each call, in adaptive retry mode, since
+# servers launched together share the account's SSM request rate
+const_key_stage_timing = 'stage_timing'
+default_instance_cli_max_attempts = 10
+
+# subtree of default_ssm_path with the digest of every host config last synced to each server, and
+# where the synced configs live on the server
+const_key_target_state = 'target_state'
+nagios_target_config_dir = '/usr/local/nagios/etc/objects/eq_targets'
+nagios_config_file = '/usr/local/nagios/etc/nagios.cfg'
+
+# subtree of default_ssm_path where every server publishes its nagiostats every few minutes, the
+# profile a server gets without PerformanceProfile, and the tmpfs mount a tuned server keeps its
+# status and check results on
+const_key_nagios_stats = 'nagios_stats'
+default_performance_profile = 'Default'
+default_stats_interval_minutes = 5
+nagios_ramdisk_dir = '/var/nagios-ramdisk'
+nagios_ramdisk_size = '256m'
+
+# with MetricsExport, Nagios writes check results to the perfdata file and moves it aside every so
+# many seconds, and the exporter sends them to this CloudWatch namespace; the instance policy in
+# handlers.py only allows PutMetricData to it
+default_perfdata_namespace = 'EQ/Nagios/Perfdata'
+default_perfdata_rotate_seconds = 60
+nagios_perfdata_file = '/usr/local/nagios/var/service-perfdata'
+
+# subtree of default_ssm_path with one parameter per server in each shard group, and the points
+# each server gets on the group's hash ring
+const_key_shard_groups = 'shard_groups'
+default_shard_ring_points = 100
+
+# a target sync keeps at most this many hosts on average in each SSM parameter of its state, well
+# under what one holds since the hosts hash unevenly, sends at most this many bytes of script in one
+# Run Command, and checks on the commands every so many seconds
+default_sync_state_chunk_entries = 40
+default_sync_command_max_bytes = 40000
+default_sync_poll_delay = 10
+
+# list_handler lists the servers of every region in the type configuration's ListRegions, or in
+# the comma separated env var, or in default_list_regions without either, sweeping the regions
+# concurrently on at most so many threads; with no regions configured it lists the session's region only
+default_list_regions = []
+default_list_region_workers = 8
+list_regions_env = 'NAGIOS_LIST_REGIONS'
+
+# an in-place resize checks on the instances every so many seconds while they stop, start and pass
+# their EC2 status checks, for at most so many callbacks
+default_resize_poll_delay = 15
+default_resize_max_polls = 80
+
+# AWS call and handler timings are logged as CloudWatch embedded metric format records under this
+# namespace, for the fraction of invocations set by the type configuration's MetricsSampleRate or
+# else the env var (0 turns them off)
+default_metrics_namespace = 'EQ/Monitor/Nagios'
+default_metrics_sample_rate = 1.0
+metrics_sample_rate_env = 'NAGIOS_METRICS_SAMPLE_RATE'
+
+# client-side rate limits, in calls per second, for the APIs the handlers call; an operation that
+# isn't listed uses its service's entry. A limit is halved when the API throttles and recovers over
+# the next default_rate_limit_recovery_calls successful calls, but never drops below default_rate_limit_min_tps.
+# Clients also use botocore's adaptive retry mode with this many retries per call, and a handler
+# that is still throttled after that asks for a callback this many seconds later.
+default_api_tps = {
+    'ssm': 40,
+    'ssm:PutParameter': 3,
+    'ssm:DeleteParameter': 10,
+    'ssm:DeleteParameters': 10,
+    'ec2': 5,
+    'ec2:RunInstances': 2,
+    'ec2:DescribeInstances': 20,
+    'ec2:DescribeImages': 20,
+    'iam': 5,
+}
+default_rate_limit_min_tps = 0.5
+default_rate_limit_recovery_calls = 10
+default_retry_mode = 'adaptive'
+default_retry_max_attempts = 8
+default_throttle_callback_period = 30
@@ -0,0 +1,40 @@
+# Fleets of Nagios servers
+#
+# With Count above 1 or SubnetIds set, one resource is several servers. They are spread as evenly
+# as possible over the subnets and launched with one run_instances call per subnet, since EC2 takes
+# a single subnet per call. Polling covers the whole fleet at once with probe_instances, and
+# schedules the next poll from the member furthest behind. The first member's instance id is the
+# resource Id, and the record lists every member.
+from typing import Any, List, Mapping, Optional, Sequence, Tuple
+
+from .polling import poll_phase_not_started, poll_phase_pending, poll_phases
+
+
+def is_fleet(model) -> bool:
+    return (model.Count or 1) > 1 or bool(model.SubnetIds)
+
+
+def fleet_subnets(model) -> List[str]:
+    return list(model.SubnetIds) if model.SubnetIds else [model.SubnetId]
+
+
+def fleet_layout(count: int, subnet_ids: Sequence[str]) -> List[Tuple[str, int]]:
+    # how many servers go in each subnet, leaving out subnets that get none
+    per_subnet = [count // len(subnet_ids) + (1 if index < count % len(subnet_ids) else 0)
+                    for index in range(len(subnet_ids))]
+    return [(subnet_id, servers) for subnet_id, servers in zip(subnet_ids, per_subnet) if servers]
+
+
+def fleet_phase(probes: Mapping[str, Mapping[str, Any]]) -> Optional[str]:
+    # the poll phase of the member furthest behind, or None once every member is done
+    phases = []
+    for probe in probes.values():
+        if probe['state'] == 'pending':
+            phases.append(poll_phase_pending)
+        elif probe['status'] is None:
+            phases.append(poll_phase_not_started)
+        elif probe['status'] != 'Done':
+            phases.append(probe['status'])
+    if not phases:
+        return None
+    return min(phases, key=lambda phase: poll_phases.index(phase) if phase in poll_phases else 0)
@@ -1,13 +1,13 @@
 # imports
 import logging
-import os
-import boto3
+import random
 import uuid
 import time
 
-import logging
 from typing import Any, MutableMapping, Optional
 
+from botocore.exceptions import ClientError
+
 from cloudformation_cli_python_lib import (
     Action,
     HandlerErrorCode,
@@ -19,12 +19,77 @@ from cloudformation_cli_python_lib import (
     identifier_utils,
 )
 
-from .models import ResourceHandlerRequest, ResourceModel
+from .clients import client_cache_summary, get_client
+from .constants import (
+    const_key_create_rollback,
+    const_key_create_suffix,
+    const_key_delete_attempts,
+    const_key_delete_done,
+    const_key_delete_polls,
+    const_key_delete_record,
+    const_key_fleet_launched,
+    const_key_iam_created,
+    const_key_iam_propagation,
+    const_key_image_base,
+    const_key_image_cached,
+    const_key_image_id,
+    const_key_instance_id,
+    const_key_instance_profile,
+    const_key_instance_type,
+    const_key_IP,
+    const_key_members,
+    const_key_metrics_export,
+    const_key_name,
+    const_key_performance_profile,
+    const_key_policy_arn,
+    const_key_resize,
+    const_key_resize_incomplete,
+    const_key_role,
+    const_key_sg,
+    const_key_shard_group,
+    const_key_shared_member,
+    const_key_subnet,
+    const_key_subnet_ids,
+    const_key_target_sync,
+    const_key_targets,
+    const_key_URL,
+    const_key_warm_pool,
+    const_key_warm_pool_claimed,
+    const_key_warm_pool_member,
+    default_delete_max_attempts,
+    default_delete_max_polls,
+    default_delete_poll_delay,
+    default_iam_propagation_timeout,
+    default_iam_retry_base_delay,
+    default_iam_retry_budget,
+    default_iam_retry_callback_period,
+    default_iam_retry_max_delay,
+    default_poll_max_delay,
+    default_resize_max_polls,
+    default_resize_poll_delay,
+    default_server_name,
+    default_throttle_callback_period,
+    default_ssm_ami_parameter,
+    default_ssm_path,
+    default_sync_poll_delay,
+    record_key_list,
+    ssm_managed_instance_policy_arn,
+)
+from .metrics import instrument_handler
+from .performance import nagios_stats_parameter_name, parse_nagios_stats, performance_profile
+from .rate_limit import is_throttling_error
+from . import models
+from .models import Member, ResourceHandlerRequest, ResourceModel, TypeConfigurationModel
+from .model_cache import cache_model_registry
+from .storage import RecordNotFound, delete_record, get_record, get_record_with_parameters, get_records, list_records, put_record
+
+# The helpers only create and delete use (image cache, polling, provisioning, shared role, teardown, warm pool
+# and user data), and the resize and multi-region list helpers, are imported inside the functions
+# that call them, so the other handlers' cold starts don't load them.
 
 # Use this logger to forward log messages to CloudWatch Logs.
 LOG = logging.getLogger(__name__)
 LOG.setLevel(logging.INFO)
-logging.basicConfig(level=logging.INFO)
 
 # LOG.info("Waiting for debug process to attach")
 # import ptvsd
@@ -33,80 +98,9 @@ logging.basicConfig(level=logging.INFO)
 
 # Set resource and test_entrypoint
 TYPE_NAME = "EQ::MONITOR::NAGIOS"
-resource = Resource(TYPE_NAME, ResourceModel)
+resource = Resource(TYPE_NAME, ResourceModel, TypeConfigurationModel)
 test_entrypoint = resource.test_entrypoint
-
-default_server_name = 'Nagios Server'
-default_instance_type = 't2.small'
-default_ssm_ami_parameter = '/aws/service/ami-amazon-linux-latest/amzn2-ami-hvm-x86_64-gp2'
-default_callback_period = 60
-default_ssm_path = '/Eq/Nagios/Monitor/Stack'
-
-const_key_instance_id = 'instance_id'
-const_key_name = 'server_name'
-const_key_policy_arn = 'policy_arn'
-const_key_role = 'role'
-const_key_instance_profile = 'instance_profile'
-const_key_IP = 'IP'
-const_key_URL = 'URL'
-const_key_status = 'status'
-const_key_subnet = 'subnet_id'
-const_key_sg = 'security_groups'
-model_key_list = [const_key_instance_id, const_key_name, 
-                    const_key_policy_arn, const_key_role, const_key_instance_profile, 
-                    const_key_IP, const_key_URL, 
-                    const_key_status, 
-                    const_key_subnet, const_key_sg]
-
-ssm_action_put = 0
-ssm_action_get = 1
-ssm_action_delete = 2
-
-ec2_user_data = """#!/bin/bash -xe
-region=$(curl -k http://169.254.169.254/latest/meta-data/placement/region)
-instance_id=$(curl -k http://169.254.169.254/latest/meta-data/instance-id)
-
-aws ssm put-parameter --name $default_ssm_path/$key/$instance_id --region $region --type String --value Starting --overwrite
-aws ssm put-parameter --name $default_ssm_path/$key/$instance_id --region $region --type String --value StartingYumUpdates --overwrite
-yum install -y gcc glibc glibc-common wget unzip httpd php gd gd-devel perl postfix
-cd /tmp
-aws ssm put-parameter --name $default_ssm_path/$key/$instance_id --region $region --type String --value DownloadingNagios --overwrite
-wget -O nagioscore.tar.gz https://github.com/NagiosEnterprises/nagioscore/archive/nagios-4.4.5.tar.gz
-tar xzf nagioscore.tar.gz
-cd /tmp/nagioscore-nagios-4.4.5/
-aws ssm put-parameter --name $default_ssm_path/$key/$instance_id --region $region --type String --value DeployingNagios --overwrite
-./configure
-make all
-make install-groups-users
-usermod -a -G nagios apache
-make install
-make install-daemoninit
-chkconfig --level 2345 httpd on
-systemctl enable httpd.service
-make install-commandmode
-make install-config
-make install-webconf
-htpasswd -c -b /usr/local/nagios/etc/htpasswd.users nagiosadmin nagiosadmin
-cd /tmp
-aws ssm put-parameter --name $default_ssm_path/$key/$instance_id --region $region --type String --value DownloadingPlugins --overwrite
-wget https://dl.fedoraproject.org/pub/epel/epel-release-latest-7.noarch.rpm
-rpm -ihv epel-release-latest-7.noarch.rpm
-yum install -y gcc glibc glibc-common make gettext automake autoconf wget openssl-devel net-snmp net-snmp-utils
-yum install -y perl-Net-SNMP
-cd /tmp
-wget --no-check-certificate -O nagios-plugins.tar.gz https://github.com/nagios-plugins/nagios-plugins/archive/release-2.2.1.tar.gz
-tar zxf nagios-plugins.tar.gz
-cd /tmp/nagios-plugins-release-2.2.1/
-aws ssm put-parameter --name $default_ssm_path/$key/$instance_id --region $region --type String --value DeployingPlugins --overwrite
-./tools/setup
-./configure
-make
-make install
-aws ssm put-parameter --name $default_ssm_path/$key/$instance_id --region $region --type String --value StartingServices --overwrite
-systemctl restart httpd.service
-systemctl restart nagios.service
-aws ssm put-parameter --name $default_ssm_path/$key/$instance_id --region $region --type String --value Done --overwrite
-"""
+cache_model_registry(models)
 
 ec2_assume_role_document = """{
   "Version": "2012-10-17",
@@ -137,6 +131,17 @@ ec2_policy_document = """{
                 "ssm:DeleteParameters"
             ],
             "Resource": "*"
+        },
+        {
+            "Sid": "PublishPerfdata",
+            "Effect": "Allow",
+            "Action": "cloudwatch:PutMetricData",
+            "Resource": "*",
+            "Condition": {
+                "StringEquals": {
+                    "cloudwatch:namespace": "EQ/Nagios/Perfdata"
+                }
+            }
         }
     ]
 }"""
@@ -145,109 +150,300 @@ ec2_policy_document = """{
 # =====================================
 # Helper functions
 # =====================================
-def build_instance(model:ResourceModel, session, callback_context:MutableMapping[str, any]):
-
-    ssm_client = session.client('ssm')
-    ec2_client = session.client('ec2')
-    iam_client = session.client('iam')
-
-    try:
-        # initialize parameters
-        LOG.info(f"...Initializing resource parameters (instance name, type)")
-        model.Id = None
-        instance_name = model.Name if model.Name != '' else default_server_name
-        instance_type = default_instance_type
-        sg_id = model.SecurityGroupId
-        subnet_id = model.SubnetId
-
+def build_instance(model:ResourceModel, session, callback_context:MutableMapping[str, any], partition:str):
+    from .fleet import fleet_layout, fleet_subnets, is_fleet
+    from .image_cache import find_cached_image
+    from .polling import poll_phase_pending, schedule_next_poll
+    from .provisioning import CreateStep, run_create_steps
+    from .shared_role import add_role_once, ensure_shared_role, find_local_policy_arn, ignore_exists, register_shared_role_member
+    from .user_data import nagios_build_stages, nagios_cached_stages, render_user_data
+    from .warm_pool import refill_warm_pool, register_warm_pool_user, start_pool_instance, take_pool_instance, warm_pool_key
+
+    ssm_client = get_client(session, 'ssm')
+    ec2_client = get_client(session, 'ec2')
+    iam_client = get_client(session, 'iam')
+
+    # a warm pool hands out one server at a time
+    if model.WarmPoolSize and is_fleet(model):
+        msg = "WarmPoolSize can't be combined with Count or SubnetIds"
+        LOG.info(f"...{msg}")
+        return ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.InvalidRequest, message=msg)
+
+    # Every invocation sets up the same steps and runs those a previous one didn't finish, see provisioning.py
+    LOG.info(f"...Initializing resource parameters (instance name, type)")
+    model.Id = None
+    instance_name = model.Name if model.Name != '' else default_server_name
+    profile = performance_profile(model.PerformanceProfile)
+    instance_type = model.InstanceType or profile.instance_type
+    sg_id = model.SecurityGroupId
+    subnet_id = model.SubnetId
+    subnet_ids = fleet_subnets(model)
+    rnd = callback_context.setdefault(const_key_create_suffix, str(uuid.uuid4()).replace('-','_'))
+    role_name = f"nagios_role_{rnd}"
+    policy_name = f"nagios_policy_{rnd}"
+    instance_profile_name = f"nagios_instance_profile_{rnd}"
+
+    callback_context[const_key_subnet] = subnet_id
+    callback_context[const_key_sg] = sg_id
+    callback_context[const_key_name] = instance_name
+    if model.InstanceType:
+        callback_context[const_key_instance_type] = model.InstanceType
+    if model.PerformanceProfile:
+        callback_context[const_key_performance_profile] = model.PerformanceProfile
+    if model.MetricsExport:
+        callback_context[const_key_metrics_export] = True
+    if model.Targets:
+        callback_context[const_key_targets] = model_targets(model)
+    if model.ShardGroup:
+        callback_context[const_key_shard_group] = model.ShardGroup
+    if model.WarmPoolSize:
+        callback_context[const_key_warm_pool] = warm_pool_key(subnet_id, sg_id, model.PerformanceProfile, bool(model.MetricsExport))
+
+    def stages():
+        if callback_context.get(const_key_image_cached):
+            return nagios_cached_stages(profile, bool(model.MetricsExport))
+        return nagios_build_stages(profile, bool(model.MetricsExport))
+
+    def launch_args():
+        return dict(ImageId=callback_context[const_key_image_id],
+                    InstanceType=instance_type,
+                    SecurityGroupIds=[sg_id],
+                    SubnetId=subnet_id,
+                    IamInstanceProfile={'Name': callback_context[const_key_instance_profile]})
+
+    def lookup_image():
         # image_id comes from AWS SSM paramters that stores latest ami ids
         ssm_response = ssm_client.get_parameter(Name=default_ssm_ami_parameter)
         image_id = ssm_response['Parameter']['Value']
 
-        # create instance profile
-        rnd = str(uuid.uuid4()).replace('-','_')
-        role_name = f"nagios_role_{rnd}"
-        instance_profile_name = f"nagios_instance_profile_{rnd}"
+        # with the image cache, launch from a baked image or bake one once this server is running
+        if model.ImageCache:
+            cached_image_id = find_cached_image(session, image_id)
+            if cached_image_id:
+                LOG.info(f"...Using cached image {cached_image_id} for base image {image_id}")
+                callback_context[const_key_image_cached] = True
+                image_id = cached_image_id
+            else:
+                LOG.info(f"...No cached image for base image {image_id}, building from source")
+                callback_context[const_key_image_base] = image_id
+        callback_context[const_key_image_id] = image_id
+
+    def register_shared_member():
+        # take a reference first, so a concurrent delete of the last other server keeps the shared role,
+        # and the warm pool when there is one
+        register_shared_role_member(session, callback_context.setdefault(const_key_shared_member, str(uuid.uuid4())))
+        if model.WarmPoolSize:
+            register_warm_pool_user(session, callback_context[const_key_warm_pool], callback_context[const_key_shared_member])
+
+    def ensure_shared():
+        callback_context[const_key_role], callback_context[const_key_instance_profile], callback_context[const_key_policy_arn], _ = \
+            ensure_shared_role(session, ec2_assume_role_document, ec2_policy_document, partition)
+        callback_context[const_key_iam_created] = time.time()
+
+    def create_role():
         LOG.info(f"...Creating role {role_name}")
-        iam_response = iam_client.create_role(RoleName=role_name, AssumeRolePolicyDocument=ec2_assume_role_document, Description='Role for nagios server')
-        LOG.info(f"...Creating custom policy")
-        iam_response = iam_client.create_policy(PolicyName=f"nagios_policy_{rnd}", PolicyDocument=ec2_policy_document, Description='Custom Policy for Nagios Server')
-        policy_arn = iam_response['Policy']['Arn']
-        LOG.info(f"...Attaching policies to role")
-        iam_client.attach_role_policy(RoleName=role_name, PolicyArn='arn:aws:iam::aws:policy/AmazonSSMManagedInstanceCore')
-        iam_client.attach_role_policy(RoleName=role_name, PolicyArn=policy_arn)
-        LOG.info(f"...Creating instance profile {instance_profile_name}")
-        iam_response = iam_client.create_instance_profile(InstanceProfileName=instance_profile_name)
-        iam_client.add_role_to_instance_profile(InstanceProfileName=instance_profile_name, RoleName=role_name)
-        time.sleep(30)      # need to do this, iam waiter not working properly
-
-        # start EC2 instance
-        LOG.info(f"...Starting EC2 instance {instance_name} with {image_id} on {instance_type} instance, subnet {subnet_id} and security groups {sg_id}")
-        user_data = ec2_user_data.replace('$default_ssm_path', default_ssm_path).replace('$key', const_key_status)
-        
-        ec2_response = ec2_client.run_instances(
-                                    ImageId=image_id,
-                                    InstanceType=instance_type,
-                                    SecurityGroupIds=[sg_id],
-                                    SubnetId=subnet_id,
-                                    MinCount=1,
-                                    MaxCount=1,
-                                    UserData=user_data,
-                                    IamInstanceProfile={'Name': instance_profile_name},
-                                    TagSpecifications=[{'ResourceType':'instance', 'Tags': [{'Key': 'Name', 'Value': instance_name}]}]
-                                    )
-
-        # capture and store instance id so it can be terminated
-        instance_id = ec2_response['Instances'][0]['InstanceId']
-        model.Id = instance_id
+        ignore_exists(lambda: iam_client.create_role(RoleName=role_name, AssumeRolePolicyDocument=ec2_assume_role_document, Description='Role for nagios server'))
         callback_context[const_key_role] = role_name
+
+    def create_policy():
+        LOG.info(f"...Creating custom policy")
+        try:
+            iam_response = iam_client.create_policy(PolicyName=policy_name, PolicyDocument=ec2_policy_document, Description='Custom Policy for Nagios Server')
+            policy_arn = iam_response['Policy']['Arn']
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'EntityAlreadyExists':
+                raise
+            # made by an invocation that didn't get to checkpoint it
+            policy_arn = find_local_policy_arn(iam_client, policy_name)
+            if policy_arn is None:
+                raise RuntimeError(f"policy {policy_name} exists but is not listed") from err
         callback_context[const_key_policy_arn] = policy_arn
+
+    def attach_ssm_policy():
+        LOG.info(f"...Attaching SSM policy to role")
+        iam_client.attach_role_policy(RoleName=role_name, PolicyArn=ssm_managed_instance_policy_arn)
+
+    def attach_policy():
+        LOG.info(f"...Attaching custom policy to role")
+        iam_client.attach_role_policy(RoleName=role_name, PolicyArn=callback_context[const_key_policy_arn])
+
+    def create_instance_profile():
+        LOG.info(f"...Creating instance profile {instance_profile_name}")
+        ignore_exists(lambda: iam_client.create_instance_profile(InstanceProfileName=instance_profile_name))
         callback_context[const_key_instance_profile] = instance_profile_name
-        callback_context[const_key_subnet] = subnet_id
-        callback_context[const_key_sg] = sg_id
-        callback_context[const_key_name] = instance_name
 
-        LOG.info(f"...New instance {instance_id} created successfully")
+    def add_role_to_instance_profile():
+        add_role_once(iam_client, instance_profile_name, role_name)
+        callback_context[const_key_iam_created] = time.time()
+
+    def claim_warm_pool():
+        # with a warm pool, start an already built instance and top the pool back up in the background;
+        # the claimed instance is checkpointed first, so a failed start is retried on the same one
+        current_type = None
+        if const_key_warm_pool_claimed not in callback_context:
+            taken = take_pool_instance(session, subnet_id, sg_id, model.PerformanceProfile,
+                                        callback_context[const_key_shared_member], bool(model.MetricsExport))
+            callback_context[const_key_warm_pool_claimed], current_type = taken or (None, None)
+        if callback_context[const_key_warm_pool_claimed]:
+            start_pool_instance(session, callback_context[const_key_warm_pool_claimed], instance_name,
+                                callback_context[const_key_shared_member], instance_type, current_type)
+
+    def refill_pool():
+        try:
+            refill_warm_pool(session, model.WarmPoolSize, subnet_id, sg_id, model.PerformanceProfile, launch_args(),
+                                render_user_data(stages(), after_done=['shutdown -h now']), bool(model.MetricsExport))
+        except ClientError as err:
+            if is_throttling_error(err):
+                raise
+            LOG.exception(f"...Unable to refill warm pool: {err}")
+
+    def launch_instances():
+        # start EC2 instances, one run_instances call per subnet; a single server is a fleet of one
+        if callback_context.get(const_key_warm_pool_claimed):
+            return None
+        user_data = render_user_data(stages())
+        layout = fleet_layout(model.Count or 1, subnet_ids)
+        launched = callback_context.setdefault(const_key_fleet_launched, {})
+        for launch_subnet_id, launch_count in layout:
+            if launch_subnet_id in launched:
+                continue
+            LOG.info(f"...Starting {launch_count} EC2 instance(s) {instance_name} with {callback_context[const_key_image_id]} on {instance_type} instance, subnet {launch_subnet_id} and security groups {sg_id}")
+            ec2_response = launch_instance(ec2_client, callback_context[const_key_iam_created],
+                                            **dict(launch_args(), SubnetId=launch_subnet_id),
+                                            MinCount=launch_count,
+                                            MaxCount=launch_count,
+                                            UserData=user_data,
+                                            TagSpecifications=[{'ResourceType':'instance', 'Tags': [{'Key': 'Name', 'Value': instance_name}]}],
+                                            # a launch repeated after its response was lost gets the same instances back
+                                            ClientToken=f"{rnd}-{launch_subnet_id}"[:64]
+                                            )
+            if ec2_response is None:
+                break
+            launched[launch_subnet_id] = [instance['InstanceId'] for instance in ec2_response['Instances']]
+
+        if len(launched) < len(layout):
+            waited = int(time.time() - callback_context[const_key_iam_created])
+            if waited > default_iam_propagation_timeout:
+                raise TimeoutError(f"instance profile {callback_context[const_key_instance_profile]} not usable after {waited} seconds")
+            return f"Waiting for instance profile {callback_context[const_key_instance_profile]} to propagate ({waited}s so far)"
+
+        # record how long IAM took to propagate
+        callback_context[const_key_iam_propagation] = round(time.time() - callback_context[const_key_iam_created], 1)
+        LOG.info(f"...Instance profile usable after {callback_context[const_key_iam_propagation]} seconds")
+
+        # capture and store instance ids so they can be terminated, the first one is the resource id
+        members = [{const_key_instance_id: instance_id, const_key_subnet: launch_subnet_id}
+                    for launch_subnet_id, _ in layout for instance_id in launched[launch_subnet_id]]
+        if is_fleet(model):
+            callback_context[const_key_members] = members
+        else:
+            callback_context[const_key_instance_id] = members[0][const_key_instance_id]
+        if model.SubnetIds:
+            callback_context[const_key_subnet_ids] = subnet_ids
+        callback_context.pop(const_key_fleet_launched)
+        LOG.info(f"...New instances {', '.join(member[const_key_instance_id] for member in members)} created successfully")
+        return None
+
+    # Each step only waits for the steps it needs, and the rest run alongside it. Warm pool members
+    # outlive any one server, so they always use the shared role.
+    steps = [CreateStep('lookup_image', lookup_image)]
+    if model.SharedRole or model.WarmPoolSize:
+        iam_steps = ['ensure_shared_role']
+        steps.extend([CreateStep('register_shared_role_member', register_shared_member),
+                        CreateStep('ensure_shared_role', ensure_shared, ['register_shared_role_member'])])
+    else:
+        iam_steps = ['attach_ssm_policy', 'attach_policy', 'add_role_to_instance_profile']
+        steps.extend([CreateStep('create_role', create_role),
+                        CreateStep('create_policy', create_policy),
+                        CreateStep('create_instance_profile', create_instance_profile),
+                        CreateStep('attach_ssm_policy', attach_ssm_policy, ['create_role']),
+                        CreateStep('attach_policy', attach_policy, ['create_role', 'create_policy']),
+                        CreateStep('add_role_to_instance_profile', add_role_to_instance_profile, ['create_role', 'create_instance_profile'])])
+    launch_steps = ['lookup_image', *iam_steps]
+    if model.WarmPoolSize:
+        # the pool is topped up once the claimed member has left it
+        steps.extend([CreateStep('claim_warm_pool', claim_warm_pool, ['register_shared_role_member']),
+                        CreateStep('refill_warm_pool', refill_pool, ['lookup_image', 'ensure_shared_role', 'claim_warm_pool'])])
+        launch_steps.append('claim_warm_pool')
+    steps.append(CreateStep('launch_instances', launch_instances, launch_steps))
 
-        # get success progress event
-        progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_callback_period, resourceModel=model, callbackContext=callback_context)
+    try:
+        waiting = run_create_steps(steps, callback_context)
+        if waiting is not None:
+            progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_iam_retry_callback_period, resourceModel=model, callbackContext=callback_context, message=waiting)
+        else:
+            # the first instance is the resource id; get success progress event, polling first when the instance should be out of pending
+            model.Id = callback_context.get(const_key_warm_pool_claimed) or callback_context.get(const_key_instance_id) or callback_context[const_key_members][0][const_key_instance_id]
+            delay = schedule_next_poll(session, callback_context, poll_phase_pending)
+            progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=delay, resourceModel=model, callbackContext=callback_context)
 
     except Exception as err:
-        # get failed progress event
-        msg = f"Unexpected error creating nagios server: {type(err).__name__}: {str(err)}"
-        progress = ProgressEvent(status=OperationStatus.FAILED, resourceModel=model, message=msg)
-        LOG.exception(msg)
+        if is_throttling_error(err):
+            # the finished steps are checkpointed, so a throttled create carries on from the step that was throttled
+            msg = f"Throttled creating nagios server, retrying in {default_throttle_callback_period} seconds"
+            LOG.info(f"...{msg}")
+            progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_throttle_callback_period, resourceModel=model, callbackContext=callback_context, message=msg)
+        else:
+            # get failed progress event
+            msg = f"Unexpected error creating nagios server: {type(err).__name__}: {str(err)}"
+            progress = ProgressEvent(status=OperationStatus.FAILED, resourceModel=model, message=msg)
+            LOG.exception(msg)
 
     return progress
 
 
+def launch_instance(ec2_client, iam_created:float, **launch_args):
+
+    # A new instance profile can take a few seconds to become usable by EC2. Retry with jittered
+    # exponential backoff while that is the only problem, and give up for this invocation once
+    # the retry budget is spent, returning None so the caller can ask for a callback instead.
+    deadline = time.time() + default_iam_retry_budget
+    attempt = 0
+    while True:
+        try:
+            return ec2_client.run_instances(**launch_args)
+        except ClientError as err:
+            if not is_instance_profile_not_ready(err):
+                raise
+            delay = random.uniform(0, min(default_iam_retry_max_delay, default_iam_retry_base_delay * 2 ** attempt))
+            if time.time() + delay > deadline:
+                return None
+            LOG.info(f"...Instance profile not yet usable {round(time.time() - iam_created, 1)}s after creation, retrying in {round(delay, 1)}s")
+            time.sleep(delay)
+            attempt += 1
+
+
+def is_instance_profile_not_ready(err:ClientError) -> bool:
+
+    error = err.response.get('Error', {})
+    return error.get('Code') == 'InvalidParameterValue' and 'instance profile' in error.get('Message', '').lower()
+
 
 def check_instance_state(model:ResourceModel, session, callback_context:MutableMapping[str, any]):
+    from .polling import poll_phase_not_started, poll_phase_pending, schedule_next_poll
+    from .probe import probe_instances
 
     try:
-        # use ec2 resource to get the current state
+        # one describe_instances call for the state and IP, and one get_parameters call for the status once running
         instance_id = model.Id
         LOG.info(f"...Checking state for instance {instance_id}")
-        ec2_client = session.resource('ec2')
-        instance = ec2_client.Instance(instance_id)
-        state = instance.state
-        state_code = state['Code']
-        state_name = state['Name']
+        probe = probe_instances(session, [instance_id])[instance_id]
+        state_name = probe['state']
 
         # return progress event based on state
-        if state_code == 16:
+        if state_name == 'running':
             LOG.info(f"...Instance is {state_name}, checking status of user_data")
-            status = 'Not started'
-            try:
-                # when first initializing, the ssm parameter may not be available
-                status = ssm_parameter_action(ssm_action_get, session, model.Id, const_key_status)
-            except:
-                pass
-            if status == 'Done':
+            # when first initializing, the script may not have written its status yet
+            status = probe['status'] or 'Not started'
+            if status == 'Failed':
+                msg = f"User data script failed on instance {instance_id}, see its stage timings under {default_ssm_path}"
+                LOG.info(f"...{msg}")
+                progress = ProgressEvent(status=OperationStatus.FAILED, resourceModel=model, message=msg)
+            elif status == 'Done':
                 # we're done
                 LOG.info("...User data script complete")
                 # get and update IP and URL
-                model.IP = instance.public_ip_address
+                model.IP = probe['ip']
                 LOG.info(f"...IP is {model.IP}")
                 model.URL = f"http://{model.IP}/nagios"
                 LOG.info(f"...URL is {model.URL}")
@@ -255,12 +451,15 @@ def check_instance_state(model:ResourceModel, session, callback_context:MutableM
             else:
                 msg = f"Waiting for user data script to complete, status is {status}"
                 LOG.info(f"...{msg}")
-                progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_callback_period, callbackContext=callback_context, resourceModel=model, message=msg)
-        elif state_code == 0:
+                phase = poll_phase_not_started if probe['status'] is None else status
+                delay = schedule_next_poll(session, callback_context, phase)
+                progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=delay, callbackContext=callback_context, resourceModel=model, message=msg)
+        elif state_name == 'pending':
             # still in pending state
             LOG.info(f"...Instance is {state_name}")
             msg = "Waiting for EC2 instance to stabilize"
-            progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_callback_period, resourceModel=model, message=msg, callbackContext=callback_context)
+            delay = schedule_next_poll(session, callback_context, poll_phase_pending)
+            progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=delay, resourceModel=model, message=msg, callbackContext=callback_context)
         else:
             # something went wrong - EC2 is stopping, stopped or terminated
             LOG.info(f"...Instance is {state_name}")
@@ -268,44 +467,388 @@ def check_instance_state(model:ResourceModel, session, callback_context:MutableM
             progress = ProgressEvent(status=OperationStatus.FAILED, resourceModel=model, message=msg)
 
     except Exception as err:
-        # get failed progress event
-        msg = f"Unexpected error checking state: {type(err).__name__}: {str(err)}"
-        progress = ProgressEvent(status=OperationStatus.FAILED, resourceModel=model, message=msg)
-        LOG.exception(msg)
+        if is_throttling_error(err):
+            # a throttled check costs one more callback, not the server
+            msg = f"Throttled checking instance state, checking again in {default_throttle_callback_period} seconds"
+            LOG.info(f"...{msg}")
+            progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_throttle_callback_period, callbackContext=callback_context, resourceModel=model, message=msg)
+        else:
+            # get failed progress event
+            msg = f"Unexpected error checking state: {type(err).__name__}: {str(err)}"
+            progress = ProgressEvent(status=OperationStatus.FAILED, resourceModel=model, message=msg)
+            LOG.exception(msg)
 
     return progress
 
 
-def ssm_parameter_action(action, session, id, key, value=None):
-
-    ssm_client = session.client('ssm')
-    # ssm_name = f"{default_ssm_path}/{id}/{key}"
-    ssm_name = f"{default_ssm_path}/{key}/{id}"
-    
-    if action == ssm_action_put:
-        ssm_value = value
-        ssm_type = 'String'
-        if isinstance(ssm_value, list):
-            ssm_value = ','.join(ssm_value)
-            ssm_type = 'StringList'
-        ssm_client.put_parameter(Name=ssm_name, Value=ssm_value, Type=ssm_type, Overwrite=True)
-    elif action == ssm_action_get:
-        ssm_response = ssm_client.get_parameter(Name=ssm_name)
-        if ssm_response['Parameter']['Type'] == 'String':
-            ssm_value = ssm_response['Parameter']['Value']
+def check_fleet_state(model:ResourceModel, session, callback_context:MutableMapping[str, any]):
+    from .fleet import fleet_phase
+    from .polling import schedule_next_poll
+    from .probe import probe_instances
+
+    try:
+        members = callback_context[const_key_members]
+        LOG.info(f"...Checking state for {len(members)} fleet instances")
+        probes = probe_instances(session, [member[const_key_instance_id] for member in members])
+
+        failed = [instance_id for instance_id, probe in probes.items()
+                    if probe['state'] not in ('pending', 'running') or probe['status'] == 'Failed']
+        phase = fleet_phase(probes)
+        if failed:
+            msg = "Fleet instances failed: " + ', '.join(f"{instance_id} ({probes[instance_id]['state']}, status {probes[instance_id]['status']})" for instance_id in failed)
+            LOG.info(f"...{msg}")
+            progress = ProgressEvent(status=OperationStatus.FAILED, resourceModel=model, message=msg)
+        elif phase is None:
+            LOG.info("...User data script complete on every fleet instance")
+            for member in members:
+                member[const_key_IP] = probes[member[const_key_instance_id]]['ip']
+                member[const_key_URL] = f"http://{member[const_key_IP]}/nagios"
+            model.IP = members[0][const_key_IP]
+            model.URL = members[0][const_key_URL]
+            model.Members = [Member(Id=member[const_key_instance_id], IP=member[const_key_IP], URL=member[const_key_URL], SubnetId=member[const_key_subnet])
+                                for member in members]
+            progress = ProgressEvent(status=OperationStatus.SUCCESS, resourceModel=model)
+        else:
+            done = sum(1 for probe in probes.values() if probe['status'] == 'Done')
+            msg = f"Waiting for fleet, {done} of {len(members)} servers done, slowest is in {phase}"
+            LOG.info(f"...{msg}")
+            delay = schedule_next_poll(session, callback_context, phase)
+            progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=delay, callbackContext=callback_context, resourceModel=model, message=msg)
+
+    except Exception as err:
+        if is_throttling_error(err):
+            msg = f"Throttled checking fleet state, checking again in {default_throttle_callback_period} seconds"
+            LOG.info(f"...{msg}")
+            progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_throttle_callback_period, callbackContext=callback_context, resourceModel=model, message=msg)
+        else:
+            # get failed progress event
+            msg = f"Unexpected error checking fleet state: {type(err).__name__}: {str(err)}"
+            progress = ProgressEvent(status=OperationStatus.FAILED, resourceModel=model, message=msg)
+            LOG.exception(msg)
+
+    return progress
+
+
+def model_targets(model:ResourceModel):
+
+    # the tag filters as stored in the record, or None without any
+    if not model.Targets:
+        return None
+    return [{'Key': target.Key, 'Values': list(target.Values or [])} for target in model.Targets]
+
+
+def sync_targets(model:ResourceModel, session, callback_context:MutableMapping[str, any], records=(), group_members=()) -> ProgressEvent:
+    from .target_sync import check_target_syncs, start_target_syncs
+
+    # Starts syncing the targets of the given server records, or checks on the syncs already in the
+    # callback context. Each server's synced state is only stored once all of its instances applied the changes.
+    try:
+        if const_key_target_sync not in callback_context:
+            LOG.info(f"...Syncing targets to {', '.join(record[const_key_instance_id] for record in records)}")
+            started = start_target_syncs(session, records, group_members)
+            # syncs with nothing to send are done straight away
+            syncs, failures = check_target_syncs(session, [sync for sync in started if not sync['commands']])
+            syncs.extend(sync for sync in started if sync['commands'])
+        else:
+            syncs, failures = check_target_syncs(session, callback_context[const_key_target_sync])
+        callback_context[const_key_target_sync] = syncs
+
+        if failures:
+            msg = "Target sync failed: " + ', '.join(failures)
+            LOG.info(f"...{msg}")
+            progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.GeneralServiceException, resourceModel=model, message=msg)
+        elif not syncs:
+            callback_context.pop(const_key_target_sync)
+            LOG.info("...Targets synced")
+            progress = ProgressEvent(status=OperationStatus.SUCCESS, resourceModel=model)
+        else:
+            msg = f"Waiting for {sum(len(sync['commands']) for sync in syncs)} target sync commands"
+            LOG.info(f"...{msg}")
+            progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_sync_poll_delay, callbackContext=callback_context, resourceModel=model, message=msg)
+
+    except Exception as err:
+        if is_throttling_error(err):
+            msg = f"Throttled syncing targets, retrying in {default_throttle_callback_period} seconds"
+            LOG.info(f"...{msg}")
+            progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_throttle_callback_period, callbackContext=callback_context, resourceModel=model, message=msg)
+        else:
+            msg = f"Unexpected error syncing targets: {type(err).__name__}: {str(err)}"
+            LOG.exception(msg)
+            progress = ProgressEvent(status=OperationStatus.FAILED, resourceModel=model, message=msg)
+
+    return progress
+
+
+def finish_create_sync(model:ResourceModel, progress:ProgressEvent) -> ProgressEvent:
+
+    # The servers are running and their record is stored by the time create syncs, so a failed sync
+    # doesn't fail the create; the next update syncs the targets again.
+    if progress.status != OperationStatus.FAILED:
+        return progress
+    LOG.info(f"...Leaving the target sync to the next update: {progress.message}")
+    return ProgressEvent(status=OperationStatus.SUCCESS, resourceModel=model, message=progress.message)
+
+
+def update_targets(model:ResourceModel, session, callback_context:MutableMapping[str, any], record:MutableMapping[str, any], synced_before:bool) -> ProgressEvent:
+
+    # every update syncs the targets, which picks up instances started or stopped since the last one;
+    # removing Targets syncs once more to remove every host. The server joins its shard group again
+    # in case the create couldn't.
+    targets = record.get(const_key_targets)
+    if record.get(const_key_shard_group):
+        from .sharding import register_shard_member
+        register_shard_member(session, record[const_key_shard_group], record[const_key_instance_id])
+    if record.get(const_key_shard_group) and (targets or synced_before):
+        # a server gaining or losing targets changes how the group splits them
+        records, group_members = shard_group_records(session, record[const_key_shard_group])
+        if not targets:
+            records.append(record)
+        return sync_targets(model, session, callback_context, records, group_members)
+    if targets or synced_before:
+        return sync_targets(model, session, callback_context, [record])
+    return ProgressEvent(status=OperationStatus.SUCCESS, resourceModel=model)
+
+
+def check_resize_state(model:ResourceModel, session, callback_context:MutableMapping[str, any]) -> ProgressEvent:
+    from .resize import ResizeFailed, check_resize
+
+    try:
+        resize = callback_context[const_key_resize]
+        ips = check_resize(session, resize)
+        if ips is None and resize['polls'] >= default_resize_max_polls:
+            msg = f"Instances not back after resizing to {resize['type']}, still {resize['phase']} after {resize['polls']} checks"
+            LOG.info(f"...{msg}")
+            mark_resize_incomplete(session, model.Id)
+            progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.NotStabilized, resourceModel=model, message=msg)
+        elif ips is None:
+            msg = f"Resizing to {resize['type']}, instances {resize['phase']}"
+            LOG.info(f"...{msg}")
+            progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_resize_poll_delay, callbackContext=callback_context, resourceModel=model, message=msg)
+        else:
+            # the instances come back with new public IPs
+            LOG.info(f"...Resized to {resize['type']}, storing the new IPs")
+            record = get_record(session, model.Id)
+            members = record.get(const_key_members)
+            for member in members or []:
+                member[const_key_IP] = ips[member[const_key_instance_id]]
+                member[const_key_URL] = f"http://{member[const_key_IP]}/nagios"
+            record[const_key_IP] = ips[model.Id]
+            record[const_key_URL] = f"http://{record[const_key_IP]}/nagios"
+            record[const_key_instance_type] = resize['type']
+            record.pop(const_key_resize_incomplete, None)
+            put_record(session, model.Id, record)
+            callback_context.pop(const_key_resize)
+
+            model.IP = record[const_key_IP]
+            model.URL = record[const_key_URL]
+            if members:
+                model.Members = [Member(Id=member[const_key_instance_id], IP=member[const_key_IP], URL=member[const_key_URL], SubnetId=member[const_key_subnet])
+                                    for member in members]
+            progress = update_targets(model, session, callback_context, record, resize['synced_before'])
+
+    except ResizeFailed as err:
+        msg = f"Resize to {callback_context[const_key_resize]['type']} failed: {str(err)}"
+        LOG.info(f"...{msg}")
+        mark_resize_incomplete(session, model.Id)
+        progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.NotStabilized, resourceModel=model, message=msg)
+
+    except Exception as err:
+        if is_throttling_error(err):
+            msg = f"Throttled checking the resize, checking again in {default_throttle_callback_period} seconds"
+            LOG.info(f"...{msg}")
+            progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_throttle_callback_period, callbackContext=callback_context, resourceModel=model, message=msg)
         else:
-            ssm_value = (ssm_response['Parameter']['Value']).split(',')
+            msg = f"Unexpected error resizing nagios server: {type(err).__name__}: {str(err)}"
+            LOG.exception(msg)
+            mark_resize_incomplete(session, model.Id)
+            progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.InternalFailure, resourceModel=model, message=msg)
+
+    return progress
+
+
+def mark_resize_incomplete(session, instance_id:str) -> None:
+
+    # keeps the old type in the record, so the update CloudFormation rolls back with resizes again
+    try:
+        record = get_record(session, instance_id)
+        record[const_key_resize_incomplete] = True
+        put_record(session, instance_id, record)
+    except Exception as err:
+        LOG.exception(f"...Unable to record the failed resize of {instance_id}: {err}")
+
+
+def shard_group_records(session, group:str):
+    from .sharding import shard_members
+
+    # the records of the group's servers that have targets, which are the ones the targets are split over
+    records = [record for record in get_records(session, shard_members(session, group)) if record.get(const_key_targets)]
+    return records, [record[const_key_instance_id] for record in records]
+
+
+def rebalance_running(session, callback_context:MutableMapping[str, any]) -> bool:
+    from .target_sync import check_target_syncs
+
+    # A failed sync doesn't stop the delete: its server keeps its last synced state, and its next
+    # update or rebalance sends the difference again
+    syncs = callback_context.get(const_key_target_sync)
+    if not syncs:
+        return False
+    syncs, failures = check_target_syncs(session, syncs)
+    if failures:
+        LOG.info(f"...Shard group rebalance failed on {', '.join(failures)}")
+    callback_context[const_key_target_sync] = syncs
+    return bool(syncs)
+
+
+def teardown_server(model:ResourceModel, session, callback_context:MutableMapping[str, any], record:MutableMapping[str, any], remove_record:bool=True) -> ProgressEvent:
+    from .shared_role import release_shared_role
+    from .teardown import instance_terminated, run_teardown, teardown_steps, throttled_only
+
+    # One pass of removing the server in record: the teardown steps that are not done yet, a check
+    # whether its instances have terminated and, once they have, the shared role reference and the
+    # SSM record. SUCCESS means everything is gone. Used by delete, and by create to roll back.
+    instance_id = record.get(const_key_instance_id)
+    instance_ids = [member[const_key_instance_id] for member in record.get(const_key_members) or []] or ([instance_id] if instance_id else [])
+
+    # a shared role outlives the server, it is only released once the instance (and a drained warm pool) is gone
+    shared_member = record.get(const_key_shared_member)
+    teardown_record = {key: record.get(key) for key in (const_key_instance_id, const_key_members)} if shared_member else record
+    shared_members = [member_id for member_id in (shared_member, record.get(const_key_warm_pool_member)) if member_id]
+
+    LOG.info(f"...Tearing down instance {instance_id or '(none)'}, role, policy and instance profile")
+    done = set(callback_context[const_key_delete_done])
+    failures = run_teardown(teardown_steps(session, teardown_record), done)
+    callback_context[const_key_delete_done] = sorted(done)
+    if failures and not throttled_only(failures):
+        callback_context[const_key_delete_attempts] = callback_context.get(const_key_delete_attempts, 0) + 1
+
+    polls = callback_context.get(const_key_delete_polls, 0)
+    terminated = not instance_ids or ('terminate_instance' in done and instance_terminated(session, instance_ids))
+    if terminated and shared_member and not failures:
+        failures = release_shared_role(session, shared_members, record)
+        if failures and not throttled_only(failures):
+            callback_context[const_key_delete_attempts] = callback_context.get(const_key_delete_attempts, 0) + 1
+
+    if failures and callback_context.get(const_key_delete_attempts, 0) >= default_delete_max_attempts:
+        msg = "Unable to delete nagios server, failed steps: " + '; '.join(f"{name} ({reason})" for name, reason in sorted(failures.items()))
+        LOG.info(f"...{msg}")
+        progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.InternalFailure, message=msg)
+    elif not terminated and polls >= default_delete_max_polls:
+        msg = f"Instance {instance_id} did not terminate after {polls} checks"
+        LOG.info(f"...{msg}")
+        progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.NotStabilized, message=msg)
+    elif terminated and not failures and rebalance_running(session, callback_context):
+        msg = "Waiting for the shard group to take over the server's hosts"
+        LOG.info(f"...{msg}")
+        progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_sync_poll_delay, callbackContext=callback_context, resourceModel=model, message=msg)
+    elif terminated and not failures:
+        if remove_record:
+            LOG.info("...Deleting SSM record")
+            delete_record(session, instance_id, instance_ids)
+        progress = ProgressEvent(status=OperationStatus.SUCCESS)
     else:
-        ssm_client.delete_parameter(Name=ssm_name)
-        ssm_value = ''
+        callback_context[const_key_delete_polls] = polls + 1
+        delay = min(default_poll_max_delay, default_delete_poll_delay * 2 ** polls)
+        msg = f"Waiting for instance {instance_id} to terminate" if not failures else f"Retrying failed steps {', '.join(sorted(failures))}"
+        LOG.info(f"...{msg}, next check in {delay} seconds")
+        progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=delay, callbackContext=callback_context, resourceModel=model, message=msg)
 
-    return ssm_value
+
+    return progress
+
+
+def drain_warm_pool(session, record:MutableMapping[str, any]) -> MutableMapping[str, any]:
+    from .warm_pool import release_warm_pool_user, warm_pool_member_id
+
+    # The last server using a warm pool takes the pool with it: the remaining members are torn down
+    # with the server's own instance, and the pool's shared role reference is released with its own.
+    # Returns the record to tear down, without the pool so that it is only drained once.
+    pool_key = record.get(const_key_warm_pool)
+    if not pool_key or not record.get(const_key_shared_member):
+        return record
+    drained = release_warm_pool_user(session, pool_key, record[const_key_shared_member])
+    record = {key: value for key, value in record.items() if key != const_key_warm_pool}
+    if drained is None:
+        return record
+    instance_ids = [member[const_key_instance_id] for member in record.get(const_key_members) or []] or \
+                    [instance_id for instance_id in [record.get(const_key_instance_id)] if instance_id]
+    record[const_key_warm_pool_member] = warm_pool_member_id(pool_key)
+    if drained:
+        record[const_key_members] = [{const_key_instance_id: instance_id} for instance_id in dict.fromkeys(instance_ids + drained)]
+    return record
+
+
+def start_rollback(model:ResourceModel, session, callback_context:MutableMapping[str, any], failure:ProgressEvent) -> ProgressEvent:
+    from .provisioning import rollback_record
+
+    # A failed create removes what its finished steps made before reporting the failure, taking as
+    # many invocations as delete would; nothing made means nothing to wait for
+    record = rollback_record(callback_context, model.Id)
+    if record is None:
+        return failure
+    LOG.info(f"...Rolling back {', '.join(key for key, value in record.items() if value)}")
+    callback_context[const_key_create_rollback] = {'message': failure.message, 'error_code': failure.errorCode.value if failure.errorCode else None}
+    callback_context[const_key_delete_record] = record
+    callback_context[const_key_delete_done] = []
+    return continue_rollback(model, session, callback_context)
+
+
+def continue_rollback(model:ResourceModel, session, callback_context:MutableMapping[str, any]) -> ProgressEvent:
+
+    rollback = callback_context[const_key_create_rollback]
+    error_code = HandlerErrorCode(rollback['error_code']) if rollback['error_code'] else None
+    try:
+        if callback_context[const_key_delete_record].get(const_key_warm_pool):
+            callback_context[const_key_delete_record] = drain_warm_pool(session, callback_context[const_key_delete_record])
+        progress = teardown_server(model, session, callback_context, callback_context[const_key_delete_record], remove_record=False)
+    except Exception as err:
+        if is_throttling_error(err):
+            msg = f"Throttled rolling back nagios server, retrying in {default_throttle_callback_period} seconds"
+            LOG.info(f"...{msg}")
+            return ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_throttle_callback_period, callbackContext=callback_context, resourceModel=model, message=msg)
+        LOG.exception(f"...Unable to roll back: {err}")
+        progress = ProgressEvent(status=OperationStatus.FAILED, message=f"{type(err).__name__}: {str(err)}")
+
+    # the parameters the instances wrote, such as their stage timings, are kept to show why create failed
+    if progress.status == OperationStatus.SUCCESS:
+        return ProgressEvent(status=OperationStatus.FAILED, errorCode=error_code, message=f"{rollback['message']} (rolled back)")
+    if progress.status == OperationStatus.FAILED:
+        return ProgressEvent(status=OperationStatus.FAILED, errorCode=error_code, message=f"{rollback['message']} (rollback incomplete: {progress.message})")
+    return progress
+
+
+def record_to_model(record:MutableMapping[str, any], region:Optional[str]=None, stats:Optional[MutableMapping[str, int]]=None) -> ResourceModel:
+
+    members = record.get(const_key_members)
+    properties = {
+        'Name': record.get(const_key_name), 'Id': record.get(const_key_instance_id),
+        'IP': record.get(const_key_IP), 'URL': record.get(const_key_URL),
+        'Role': record.get(const_key_role), 'PolicyArn': record.get(const_key_policy_arn),
+        'InstanceProfile': record.get(const_key_instance_profile),
+        'SubnetId': record.get(const_key_subnet), 'SecurityGroupId': record.get(const_key_sg),
+        'SharedRole': True if record.get(const_key_shared_member) else None,
+        'Count': len(members) if members else None,
+        'SubnetIds': record.get(const_key_subnet_ids),
+        'Members': [{'Id': member.get(const_key_instance_id), 'IP': member.get(const_key_IP),
+                        'URL': member.get(const_key_URL), 'SubnetId': member.get(const_key_subnet)}
+                    for member in members] if members else None,
+        'Targets': record.get(const_key_targets),
+        'ShardGroup': record.get(const_key_shard_group),
+        'InstanceType': record.get(const_key_instance_type),
+        'Region': region,
+        'PerformanceProfile': record.get(const_key_performance_profile),
+        'NagiosStats': stats,
+        'MetricsExport': record.get(const_key_metrics_export),
+    }
+    # the generated deserializer rejects explicit nulls
+    return ResourceModel._deserialize({name: value for name, value in properties.items() if value is not None})
 
 
 # =====================================
 # Main Resource Handlers
 # =====================================
 @resource.handler(Action.CREATE)
+@instrument_handler(Action.CREATE)
 def create_handler(
     session: Optional[SessionProxy],
     request: ResourceHandlerRequest,
@@ -317,30 +860,97 @@ def create_handler(
 
     # initialize model
     model = request.desiredResourceState
+    model.Region = request.region
 
     # check whether this is the first call or a callback
     # first call, create instance, subsequently check instance state until ready
-    if model.Id is None:
+    # a create that fails before its record is stored rolls back what it made
+    if const_key_create_rollback in callback_context:
+        LOG.info(f"...rolling back failed create")
+        progress = continue_rollback(model, session, callback_context)
+    elif model.Id is None:
         LOG.info(f"...no model Id, creating instance")
-        progress = build_instance(model, session, callback_context)
+        progress = build_instance(model, session, callback_context, request.awsPartition or 'aws')
+        if progress.status == OperationStatus.FAILED:
+            progress = start_rollback(model, session, callback_context, progress)
+    elif const_key_target_sync in callback_context:
+        LOG.info(f"...model.Id is {model.Id}, checking target sync")
+        progress = finish_create_sync(model, sync_targets(model, session, callback_context))
     else:
         LOG.info(f"...model.Id is {model.Id}, checking instance state")
-        progress = check_instance_state(model, session, callback_context)
-        if progress.status == OperationStatus.SUCCESS:
-            id = model.Id
-            # Store server id information in SSM - needed for read after delete
+        if const_key_members in callback_context:
+            progress = check_fleet_state(model, session, callback_context)
+        else:
+            progress = check_instance_state(model, session, callback_context)
+        if progress.status == OperationStatus.FAILED:
+            progress = start_rollback(model, session, callback_context, progress)
+        elif progress.status == OperationStatus.SUCCESS:
+            from .image_cache import bake_image
+            from .polling import finish_polling
+
+            # Store server information in SSM as one record - needed for read after delete
             LOG.info(f"...instance is running, storing information in SSM")
             callback_context[const_key_instance_id] = model.Id
             callback_context[const_key_IP] = model.IP
             callback_context[const_key_URL] = model.URL
-            for key, value in callback_context.items():
-                ssm_parameter_action(ssm_action_put, session, id, key, value)
-
+            record = {key: value for key, value in callback_context.items() if key in record_key_list}
+            try:
+                put_record(session, model.Id, record)
+            except ClientError as err:
+                if is_throttling_error(err):
+                    # the servers are up, so come back and store the record rather than lose track of them
+                    msg = f"Throttled storing the record of {model.Id}, retrying in {default_throttle_callback_period} seconds"
+                    LOG.info(f"...{msg}")
+                    progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_throttle_callback_period, callbackContext=callback_context, resourceModel=model, message=msg)
+                else:
+                    # without a record nothing could delete the servers, so they are removed now
+                    msg = f"Unable to store the record of {model.Id}: {type(err).__name__}: {str(err)}"
+                    LOG.exception(msg)
+                    progress = start_rollback(model, session, callback_context, ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.InternalFailure, message=msg))
+            else:
+                # phase durations only tune later polling, so failing to save them doesn't fail the create
+                try:
+                    finish_polling(session, callback_context)
+                except ClientError as err:
+                    LOG.exception(f"...Unable to record poll phase durations: {err}")
+
+                # bake failures only cost the next server a build from source, so they don't fail the create
+                if const_key_image_base in callback_context:
+                    try:
+                        bake_image(session, model.Id, callback_context[const_key_image_base])
+                    except ClientError as err:
+                        LOG.exception(f"...Unable to bake image from {model.Id}: {err}")
+
+                # the servers start out monitoring their targets; joining a shard group takes a share of
+                # the group's hosts, so every server in it syncs
+                try:
+                    if record.get(const_key_shard_group):
+                        from .sharding import register_shard_member
+                        register_shard_member(session, record[const_key_shard_group], model.Id)
+                        records, group_members = shard_group_records(session, record[const_key_shard_group])
+                        if records:
+                            progress = sync_targets(model, session, callback_context, records, group_members)
+                    elif record.get(const_key_targets):
+                        progress = sync_targets(model, session, callback_context, [record])
+                except Exception as err:
+                    if is_throttling_error(err):
+                        # the record is stored, so the callback finds the servers running and starts over from here
+                        msg = f"Throttled joining the shard group, retrying in {default_throttle_callback_period} seconds"
+                        LOG.info(f"...{msg}")
+                        progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_throttle_callback_period, callbackContext=callback_context, resourceModel=model, message=msg)
+                    else:
+                        msg = f"Unable to join the shard group: {type(err).__name__}: {str(err)}"
+                        LOG.exception(msg)
+                        progress = ProgressEvent(status=OperationStatus.FAILED, resourceModel=model, message=msg)
+                progress = finish_create_sync(model, progress)
+
+    LOG.info(f"...{client_cache_summary()}")
     LOG.info(f"Exiting create_handler with code {progress.status}")
     return progress
 
 
 @resource.handler(Action.UPDATE)
+@instrument_handler(Action.UPDATE)
 def update_handler(
     session: Optional[SessionProxy],
     request: ResourceHandlerRequest,
@@ -355,180 +965,192 @@ def update_handler(
     desired_name = desired_state.Name
     current_name = current_state.Name
 
-    try:
-        # if instance_id is not in SSM, the resource doesn't exist and it will raise an exception
-        ssm_parameter_action(ssm_action_get, session, desired_state.Id, const_key_instance_id)
-
-        if desired_name != current_name:
-            LOG.info(f"...Updating instance name from {current_name} to {desired_name}")
-            # use ec2 resource to get the current state
-            instance_id = desired_state.Id
-            ec2_client = session.resource('ec2')
-            instance = ec2_client.Instance(instance_id)
-            instance.create_tags(Tags=[{'Key': 'Name', 'Value': desired_name}])
-        else:
-            LOG.info(f"...Nothing to update")
-
-        progress = ProgressEvent(status=OperationStatus.SUCCESS, resourceModel=desired_state)
+    # callbacks only check on the resize or target sync the first invocation started; a resize
+    # goes on to sync the targets once the instances are back
+    if const_key_target_sync in callback_context:
+        progress = sync_targets(desired_state, session, callback_context)
+    elif const_key_resize in callback_context:
+        progress = check_resize_state(desired_state, session, callback_context)
+    else:
+        try:
+            # if the record is not in SSM, the resource doesn't exist and it will raise an exception
+            record = get_record(session, desired_state.Id)
+
+            if desired_name != current_name:
+                LOG.info(f"...Updating instance name from {current_name} to {desired_name}")
+                # rename every server of a fleet in one call
+                instance_ids = [member[const_key_instance_id] for member in record.get(const_key_members) or []] or [desired_state.Id]
+                ec2_client = get_client(session, 'ec2')
+                ec2_client.create_tags(Resources=instance_ids, Tags=[{'Key': 'Name', 'Value': desired_name}])
+            else:
+                LOG.info(f"...Nothing to update")
+
+            targets = model_targets(desired_state)
+            synced_before = bool(record.get(const_key_targets))
+            targets_changed = targets != record.get(const_key_targets)
+            if targets_changed:
+                LOG.info(f"...Updating targets")
+                record[const_key_targets] = targets
+
+            # without InstanceType, a server runs its performance profile's type
+            profile_type = performance_profile(record.get(const_key_performance_profile)).instance_type
+            desired_type = desired_state.InstanceType or profile_type
+            current_type = record.get(const_key_instance_type) or profile_type
+            # the type is only stored once a resize succeeds; after a failed one the instances may be
+            # stopped or half resized, so any type is resized again, which also starts them
+            resize = desired_type != current_type or record.get(const_key_resize_incomplete)
+            if resize:
+                LOG.info(f"...Resizing from {current_type} to {desired_type}")
+
+            if targets_changed or resize:
+                put_record(session, desired_state.Id, record)
+
+            if resize:
+                from .resize import start_resize
+                instance_ids = [member[const_key_instance_id] for member in record.get(const_key_members) or []] or [desired_state.Id]
+                callback_context[const_key_resize] = dict(start_resize(session, instance_ids, desired_type), synced_before=synced_before)
+                msg = f"Resizing to {desired_type}, instances stopping"
+                progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_resize_poll_delay, callbackContext=callback_context, resourceModel=desired_state, message=msg)
+            else:
+                progress = update_targets(desired_state, session, callback_context, record, synced_before)
 
-    except:
-        msg = "Server does not exist"
-        progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.NotFound, message=msg)
+        except RecordNotFound:
+            msg = "Server does not exist"
+            LOG.info(f"...{msg}")
+            progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.NotFound, message=msg)
 
+        except Exception as err:
+            if is_throttling_error(err):
+                # CloudFormation retries a Throttling failure
+                msg = f"Throttled updating nagios server: {str(err)}"
+                LOG.info(f"...{msg}")
+                progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.Throttling, message=msg)
+            else:
+                msg = f"Unexpected error updating nagios server: {type(err).__name__}: {str(err)}"
+                LOG.exception(msg)
+                progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.InternalFailure, message=msg)
 
+    LOG.info(f"...{client_cache_summary()}")
     LOG.info(f"Exiting create_handler with code {progress.status}")
     return progress
 
 
 @resource.handler(Action.DELETE)
+@instrument_handler(Action.DELETE)
 def delete_handler(
     session: Optional[SessionProxy],
     request: ResourceHandlerRequest,
     callback_context: MutableMapping[str, Any],
 ) -> ProgressEvent:
 
-    # TODO:
-    #   wait for server to terminate
-    #   delete roles and policies
-
     LOG.info("Starting delete_handler")
 
+    # Delete runs over several invocations: each one retries the teardown steps that are not done yet,
+    # then checks whether the instance has terminated. The record and the finished steps are kept
+    # in the callback context, and the SSM record is removed last.
+    model = request.desiredResourceState
     try:
-        LOG.info("...Terminating ec2 instance")
-        model = request.desiredResourceState
-        instance_id = ssm_parameter_action(ssm_action_get, session, model.Id, const_key_instance_id)
-
-        ec2_client = session.client('ec2')
-        try:
-            ec2_client.terminate_instances(InstanceIds=[instance_id])
-        except:
-            pass
-
-        LOG.info("...Removing role, policy and instance profile")
-        try:
-            instance_profile = ssm_parameter_action(ssm_action_get, session, instance_id, const_key_instance_profile)
-        except:
-            pass
-
-        try:
-            role = ssm_parameter_action(ssm_action_get, session, instance_id, const_key_role)
-        except:
-            pass
-
-        try:
-            policy_arn = ssm_parameter_action(ssm_action_get, session, instance_id, const_key_policy_arn)
-        except:
-            pass
-
-
-        iam_client = session.client('iam')
-        try:
-            iam_client.remove_role_from_instance_profile(InstanceProfileName=instance_profile, RoleName=role)
-        except:
-            pass
-
-        try:
-            iam_client.delete_instance_profile(InstanceProfileName=instance_profile)
-        except:
-            pass
-
-        try:
-            iam_client.detach_role_policy(RoleName=role, PolicyArn=policy_arn)
-        except:
-            pass
-
-        try:
-            iam_client.detach_role_policy(RoleName=role, PolicyArn='arn:aws:iam::aws:policy/AmazonSSMManagedInstanceCore')
-        except:
-            pass
-
-        try:
-            iam_client.delete_policy(PolicyArn=policy_arn)
-        except:
-            pass
-
-        try:
-            iam_client.delete_role(RoleName=role)
-        except:
-            pass
-
-
-        LOG.info("...Deleting SSM parameters")
-        for key in model_key_list:
-            try:
-                ssm_parameter_action(ssm_action_delete, session, instance_id, key)
-            except:
-                pass
-
-        progress = ProgressEvent(status=OperationStatus.SUCCESS)
-
-    except Exception as err:
-        msg = f"...Unexpected error checking state: {type(err).__name__}: {str(err)}"
-        LOG.info(msg)
+        if const_key_delete_record not in callback_context:
+            callback_context[const_key_delete_record] = drain_warm_pool(session, get_record(session, model.Id))
+            callback_context[const_key_delete_done] = []
+        record = callback_context[const_key_delete_record]
+        instance_id = record[const_key_instance_id]
+
+        # leave the shard group first, so the other servers take over its hosts while it terminates
+        if record.get(const_key_shard_group) and const_key_target_sync not in callback_context:
+            from .sharding import deregister_shard_member
+            from .target_sync import start_target_syncs
+            deregister_shard_member(session, record[const_key_shard_group], instance_id)
+            records, group_members = shard_group_records(session, record[const_key_shard_group])
+            LOG.info(f"...Rebalancing shard group {record[const_key_shard_group]} over {len(group_members)} servers")
+            callback_context[const_key_target_sync] = start_target_syncs(session, records, group_members)
+
+        progress = teardown_server(model, session, callback_context, record)
+
+    except RecordNotFound:
+        msg = "Server does not exist"
+        LOG.info(f"...{msg}")
         progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.NotFound, message=msg)
 
+    except Exception as err:
+        if is_throttling_error(err):
+            # every step is safe to repeat, so a throttled delete just runs again later
+            msg = f"Throttled deleting nagios server, retrying in {default_throttle_callback_period} seconds"
+            LOG.info(f"...{msg}")
+            progress = ProgressEvent(status=OperationStatus.IN_PROGRESS, callbackDelaySeconds=default_throttle_callback_period, callbackContext=callback_context, resourceModel=model, message=msg)
+        else:
+            msg = f"Unexpected error deleting nagios server: {type(err).__name__}: {str(err)}"
+            LOG.exception(msg)
+            progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.InternalFailure, message=msg)
 
+    LOG.info(f"...{client_cache_summary()}")
     LOG.info(f"Exiting delete_handler with code {progress.status}")
     return progress
 
 
 @resource.handler(Action.READ)
+@instrument_handler(Action.READ)
 def read_handler(
     session: Optional[SessionProxy],
     request: ResourceHandlerRequest,
     callback_context: MutableMapping[str, Any],
 ) -> ProgressEvent:
-    
+
     LOG.info("Starting read_handler")
 
     model = request.desiredResourceState
     try:
-        ssm_parameter_action(ssm_action_get, session, model.Id, const_key_instance_id, model.Id)
-        model = request.desiredResourceState
-        model.IP = ssm_parameter_action(ssm_action_get, session, model.Id, const_key_IP)
-        model.URL = ssm_parameter_action(ssm_action_get, session, model.Id, const_key_URL)
+        # the statistics Nagios last published come with the record, in the same SSM call
+        stats_name = nagios_stats_parameter_name(model.Id)
+        record, parameters = get_record_with_parameters(session, model.Id, [stats_name])
+        model = record_to_model(record, request.region, parse_nagios_stats(parameters.get(stats_name, '')))
         progress = ProgressEvent(status=OperationStatus.SUCCESS, resourceModel=model)
-    except:
-        progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.NotFound)
-    
+    except Exception as err:
+        if is_throttling_error(err):
+            msg = f"Throttled reading nagios server: {str(err)}"
+            LOG.info(f"...{msg}")
+            progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.Throttling, message=msg)
+        else:
+            progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.NotFound)
+
+    LOG.info(f"...{client_cache_summary()}")
     LOG.info(f"Exiting read_handler with code {progress.status}")
     return progress
 
 
 @resource.handler(Action.LIST)
+@instrument_handler(Action.LIST)
 def list_handler(
     session: Optional[SessionProxy],
     request: ResourceHandlerRequest,
     callback_context: MutableMapping[str, Any],
 ) -> ProgressEvent:
 
+    from .regions import list_records_by_region, list_regions
+
     LOG.info("Starting list_handler")
-    
-    ssm = session.client('ssm')
-    ssm_response = ssm.get_parameters_by_path(Path='/Eq/Nagios/Monitor/Stack/instance_id')
-    parameters = ssm_response['Parameters']
-    models = []
-    for parameter in parameters:
-        try:
-            key = parameter['Name']
-            vals = key.split('/')
-            instance_id = vals[len(vals)-1]
-            name = ssm_parameter_action(ssm_action_get, session, instance_id, const_key_name)
-            ip = ssm_parameter_action(ssm_action_get, session, instance_id, const_key_IP)
-            url = ssm_parameter_action(ssm_action_get, session, instance_id, const_key_URL)
-            role = ssm_parameter_action(ssm_action_get, session, instance_id, const_key_role)
-            policy_arn = ssm_parameter_action(ssm_action_get, session, instance_id, const_key_policy_arn)
-            instance_profile = ssm_parameter_action(ssm_action_get, session, instance_id, const_key_instance_profile)
-            subnet = ssm_parameter_action(ssm_action_get, session, instance_id, const_key_subnet)
-            sg_id = ssm_parameter_action(ssm_action_get, session, instance_id, const_key_sg)
-            model = ResourceModel(Name=name, Id=instance_id, IP=ip, URL=url, 
-                                    Role=role, PolicyArn=policy_arn, InstanceProfile=instance_profile, 
-                                    SubnetId=subnet, SecurityGroupId=sg_id)
-            models.append(model)
-        except:
-            pass
-
-    progress = ProgressEvent(status=OperationStatus.SUCCESS,resourceModels=models)
 
+    # with regions configured, one inventory of the servers of all of them
+    regions = list_regions(request.typeConfiguration)
+    try:
+        if regions:
+            region_records, next_token = list_records_by_region(session, regions, request.nextToken)
+        else:
+            records, next_token = list_records(session, request.nextToken)
+            region_records = [(request.region, record) for record in records]
+        models = [record_to_model(record, region) for region, record in region_records]
+        progress = ProgressEvent(status=OperationStatus.SUCCESS, resourceModels=models, nextToken=next_token)
+    except ValueError as err:
+        msg = f"Invalid nextToken: {type(err).__name__}: {str(err)}"
+        LOG.info(f"...{msg}")
+        progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.InvalidRequest, message=msg)
+    except ClientError as err:
+        if not is_throttling_error(err):
+            raise
+        msg = f"Throttled listing nagios servers: {str(err)}"
+        LOG.info(f"...{msg}")
+        progress = ProgressEvent(status=OperationStatus.FAILED, errorCode=HandlerErrorCode.Throttling, message=msg)
+
+    LOG.info(f"...{client_cache_summary()}")
     LOG.info(f"Exiting list_handler with code {progress.status}")
     return progress
@@ -0,0 +1,102 @@
+# Cache of baked Nagios images
+#
+# Building Nagios core and plugins from source is most of the time a create spends polling.
+# With ImageCache set, the first server built for a given (Nagios version, plugins version,
+# base AMI) key is imaged once it is running, and the image id is recorded in SSM under
+# {default_ssm_path}/image_cache/{key}. Later servers with the same key launch from that image
+# and only need to start their services. A new base AMI or version gives a new key, so the
+# next server is built from source and baked again.
+import json
+import logging
+import time
+from typing import Optional
+
+from botocore.exceptions import ClientError
+
+from .clients import get_client
+from .constants import (
+    const_key_image_cache,
+    default_image_bake_timeout,
+    default_nagios_version,
+    default_plugins_version,
+    default_ssm_path,
+)
+
+LOG = logging.getLogger(__name__)
+
+
+def image_cache_key(base_image_id: str) -> str:
+    return f"nagios-{default_nagios_version}-plugins-{default_plugins_version}-{base_image_id}"
+
+
+def image_cache_parameter_name(base_image_id: str) -> str:
+    return f"{default_ssm_path}/{const_key_image_cache}/{image_cache_key(base_image_id)}"
+
+
+def find_cached_image(session, base_image_id: str) -> Optional[str]:
+    entry = _get_entry(session, base_image_id)
+    image_id = entry.get('image_id') if entry else None
+    if not image_id:
+        return None
+
+    state = _image_state(session, image_id)
+    if state != 'available':
+        LOG.info(f"...Cached image {image_id} is {state or 'missing'}")
+        return None
+
+    return image_id
+
+
+def bake_image(session, instance_id: str, base_image_id: str) -> Optional[str]:
+    # Claim the cache entry before imaging so concurrent creates with the same key bake only once.
+    # A claim that never produced an image is taken over after default_image_bake_timeout.
+    ssm_client = get_client(session, 'ssm')
+    name = image_cache_parameter_name(base_image_id)
+    entry = _get_entry(session, base_image_id)
+    if entry is not None:
+        if entry.get('image_id') and _image_state(session, entry['image_id']) in ('pending', 'available'):
+            LOG.info(f"...Image for {image_cache_key(base_image_id)} already baked as {entry['image_id']}")
+            return None
+        if not entry.get('image_id') and time.time() - entry['claimed_at'] < default_image_bake_timeout:
+            LOG.info(f"...Image for {image_cache_key(base_image_id)} is being baked from {entry['source_instance']}")
+            return None
+
+    claim = {'source_instance': instance_id, 'claimed_at': time.time()}
+    try:
+        ssm_client.put_parameter(Name=name, Value=json.dumps(claim), Type='String', Overwrite=entry is not None)
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ParameterAlreadyExists':
+            raise
+        LOG.info(f"...Another server is baking the image for {image_cache_key(base_image_id)}")
+        return None
+
+    LOG.info(f"...Baking image for {image_cache_key(base_image_id)} from {instance_id}")
+    ec2_client = get_client(session, 'ec2')
+    ec2_response = ec2_client.create_image(InstanceId=instance_id, NoReboot=True,
+                                            Name=f"{image_cache_key(base_image_id)}-{int(time.time())}",
+                                            Description='Nagios server image')
+    image_id = ec2_response['ImageId']
+    claim['image_id'] = image_id
+    ssm_client.put_parameter(Name=name, Value=json.dumps(claim), Type='String', Overwrite=True)
+
+    return image_id
+
+
+def _get_entry(session, base_image_id: str):
+    ssm_client = get_client(session, 'ssm')
+    ssm_response = ssm_client.get_parameters(Names=[image_cache_parameter_name(base_image_id)])
+    if not ssm_response['Parameters']:
+        return None
+    return json.loads(ssm_response['Parameters'][0]['Value'])
+
+
+def _image_state(session, image_id: str) -> Optional[str]:
+    ec2_client = get_client(session, 'ec2')
+    try:
+        images = ec2_client.describe_images(ImageIds=[image_id])['Images']
+    except ClientError as err:
+        # deregistered images are reported as not found
+        if not err.response['Error']['Code'].startswith('InvalidAMIID'):
+            raise
+        return None
+    return images[0]['State'] if images else None
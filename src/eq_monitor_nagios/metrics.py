@@ -0,0 +1,163 @@
+# AWS call metrics
+#
+# Every client from get_client gets botocore event hooks that time each API call
+# and count its retries and throttled attempts, per service and operation. instrument_handler wraps
+# a handler so the calls made during one invocation are collected together with the handler's
+# total time, and logged at the end as a single CloudWatch embedded metric format (EMF) record,
+# which CloudWatch Logs turns into metrics. Whether an invocation is measured is decided once when
+# it starts, from the type configuration's MetricsSampleRate; the hooks of an unsampled invocation
+# return straight away.
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import Any, MutableMapping, Optional
+
+from .constants import default_metrics_namespace, default_metrics_sample_rate, metrics_sample_rate_env
+
+LOG = logging.getLogger(__name__)
+
+# error codes botocore treats as throttling
+throttle_error_codes = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+    'TooManyRequestsException', 'RequestLimitExceeded', 'RequestThrottled', 'SlowDown',
+    'EC2ThrottledException', 'ProvisionedThroughputExceededException', 'BandwidthLimitExceeded',
+}
+
+# EMF accepts at most 100 values per metric, so longer latency series are cut off, and at most
+# 100 metrics per directive, so they are split over several
+metrics_max_values = 100
+metrics_per_directive = 100
+
+_context_key = 'eq_nagios_metrics'
+_lock = threading.Lock()
+_invocation: Optional[MutableMapping[str, Any]] = None
+
+
+def metrics_sample_rate(type_configuration=None) -> float:
+    # the type configuration's MetricsSampleRate, else the env var, else default_metrics_sample_rate
+    value = os.environ.get(metrics_sample_rate_env, default_metrics_sample_rate)
+    if type_configuration is not None and type_configuration.MetricsSampleRate is not None:
+        value = type_configuration.MetricsSampleRate
+    try:
+        return min(1.0, max(0.0, float(value)))
+    except ValueError:
+        return default_metrics_sample_rate
+
+
+def instrument_client(client) -> None:
+    events = client.meta.events
+    events.register('before-call.*.*', _before_call)
+    events.register('needs-retry.*.*', _needs_retry)
+    events.register('after-call.*.*', _after_call)
+    events.register('after-call-error.*.*', _after_call_error)
+
+
+def instrument_handler(action):
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(session, request, callback_context):
+            start_invocation(request.typeConfiguration)
+            started = time.perf_counter()
+            progress = None
+            try:
+                progress = handler(session, request, callback_context)
+                return progress
+            finally:
+                flush_invocation(action, time.perf_counter() - started, progress)
+        return wrapper
+    return decorator
+
+
+def start_invocation(type_configuration=None) -> None:
+    global _invocation
+    with _lock:
+        _invocation = {} if random.random() < metrics_sample_rate(type_configuration) else None
+
+
+def flush_invocation(action, handler_seconds: float, progress=None) -> None:
+    global _invocation
+    with _lock:
+        operations, _invocation = _invocation, None
+    if operations is None:
+        return
+    LOG.info(json.dumps(emf_record(action, handler_seconds, operations, progress)))
+
+
+def emf_record(action, handler_seconds: float, operations: MutableMapping[str, Any], progress=None) -> MutableMapping[str, Any]:
+    action_name = getattr(action, 'name', str(action))
+    metrics = [{'Name': 'HandlerTime', 'Unit': 'Milliseconds'},
+                {'Name': 'AwsCalls', 'Unit': 'Count'},
+                {'Name': 'AwsTime', 'Unit': 'Milliseconds'}]
+    record = {
+        'Action': action_name,
+        'HandlerTime': round(handler_seconds * 1000, 1),
+        'AwsCalls': sum(stats['calls'] for stats in operations.values()),
+        'AwsTime': round(sum(sum(stats['latency']) for stats in operations.values()), 1),
+    }
+    if progress is not None:
+        record['Status'] = progress.status.name
+    for operation, stats in sorted(operations.items()):
+        for metric, unit, value in ((f"{operation}.Latency", 'Milliseconds', stats['latency'][:metrics_max_values]),
+                                    (f"{operation}.Calls", 'Count', stats['calls']),
+                                    (f"{operation}.Retries", 'Count', stats['retries']),
+                                    (f"{operation}.Throttles", 'Count', stats['throttles']),
+                                    (f"{operation}.Errors", 'Count', stats['errors'])):
+            metrics.append({'Name': metric, 'Unit': unit})
+            record[metric] = value
+
+    record['_aws'] = {
+        'Timestamp': int(time.time() * 1000),
+        'CloudWatchMetrics': [{'Namespace': default_metrics_namespace, 'Dimensions': [['Action']],
+                                'Metrics': metrics[start:start + metrics_per_directive]}
+                                for start in range(0, len(metrics), metrics_per_directive)],
+    }
+    return record
+
+
+def _operation_stats(operation: str) -> MutableMapping[str, Any]:
+    # callers hold _lock
+    return _invocation.setdefault(operation, {'calls': 0, 'retries': 0, 'throttles': 0, 'errors': 0, 'latency': []})
+
+
+def _before_call(model, context, **kwargs):
+    if _invocation is None:
+        return
+    context[_context_key] = (f"{model.service_model.service_name}.{model.name}", time.perf_counter())
+
+
+def _needs_retry(response=None, operation=None, **kwargs):
+    if _invocation is None or response is None:
+        return
+    code = response[1].get('Error', {}).get('Code')
+    if code in throttle_error_codes:
+        with _lock:
+            if _invocation is not None:
+                _operation_stats(f"{operation.service_model.service_name}.{operation.name}")['throttles'] += 1
+
+
+def _after_call(parsed, context, **kwargs):
+    _record_call(context, parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0), 'Error' in parsed)
+
+
+def _after_call_error(context, **kwargs):
+    _record_call(context, 0, True)
+
+
+def _record_call(context, retries: int, failed: bool) -> None:
+    started = context.pop(_context_key, None)
+    if started is None:
+        return
+    operation, start = started
+    latency = round((time.perf_counter() - start) * 1000, 1)
+    with _lock:
+        if _invocation is None:
+            return
+        stats = _operation_stats(operation)
+        stats['calls'] += 1
+        stats['retries'] += retries
+        stats['errors'] += 1 if failed else 0
+        stats['latency'].append(latency)
@@ -0,0 +1,23 @@
+# Cached model class registry
+#
+# The generated ResourceModel._deserialize builds its table of model classes with
+# getmembers(sys.modules[__name__]) on every call, which walks every name in models.py each time
+# a request is deserialized. models.py is regenerated by the CloudFormation CLI and can't carry the
+# fix, so cache_model_registry swaps the getmembers it uses for one that returns the members of
+# models.py computed once, and passes every other call through unchanged.
+import inspect
+from types import ModuleType
+
+
+def cache_model_registry(models_module: ModuleType) -> None:
+    if getattr(models_module.getmembers, 'cached_module', None) is models_module:
+        return
+    members = inspect.getmembers(models_module)
+
+    def cached_getmembers(obj, predicate=None):
+        if obj is models_module:
+            return [member for member in members if predicate is None or predicate(member[1])]
+        return inspect.getmembers(obj, predicate)
+
+    cached_getmembers.cached_module = models_module
+    models_module.getmembers = cached_getmembers
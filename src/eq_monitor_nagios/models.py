@@ -35,6 +35,7 @@ class ResourceHandlerRequest(BaseResourceHandlerRequest):
     # pylint: disable=invalid-name
     desiredResourceState: Optional["ResourceModel"]
     previousResourceState: Optional["ResourceModel"]
+    typeConfiguration: Optional["TypeConfigurationModel"]
 
 
 @dataclass
@@ -48,6 +49,19 @@ class ResourceModel(BaseModel):
     InstanceProfile: Optional[str]
     SubnetId: Optional[str]
     SecurityGroupId: Optional[str]
+    ImageCache: Optional[bool]
+    SharedRole: Optional[bool]
+    WarmPoolSize: Optional[int]
+    Count: Optional[int]
+    SubnetIds: Optional[Sequence[str]]
+    Members: Optional[Sequence["_Member"]]
+    Targets: Optional[Sequence["_Target"]]
+    ShardGroup: Optional[str]
+    InstanceType: Optional[str]
+    Region: Optional[str]
+    PerformanceProfile: Optional[str]
+    NagiosStats: Optional["_NagiosStats"]
+    MetricsExport: Optional[bool]
 
     @classmethod
     def _deserialize(
@@ -68,6 +82,19 @@ class ResourceModel(BaseModel):
             InstanceProfile=json_data.get("InstanceProfile"),
             SubnetId=json_data.get("SubnetId"),
             SecurityGroupId=json_data.get("SecurityGroupId"),
+            ImageCache=json_data.get("ImageCache"),
+            SharedRole=json_data.get("SharedRole"),
+            WarmPoolSize=json_data.get("WarmPoolSize"),
+            Count=json_data.get("Count"),
+            SubnetIds=json_data.get("SubnetIds"),
+            Members=deserialize_list(json_data.get("Members"), Member),
+            Targets=deserialize_list(json_data.get("Targets"), Target),
+            ShardGroup=json_data.get("ShardGroup"),
+            InstanceType=json_data.get("InstanceType"),
+            Region=json_data.get("Region"),
+            PerformanceProfile=json_data.get("PerformanceProfile"),
+            NagiosStats=NagiosStats._deserialize(json_data.get("NagiosStats")),
+            MetricsExport=json_data.get("MetricsExport"),
         )
 
 
@@ -75,3 +102,104 @@ class ResourceModel(BaseModel):
 _ResourceModel = ResourceModel
 
 
+@dataclass
+class Member(BaseModel):
+    Id: Optional[str]
+    IP: Optional[str]
+    URL: Optional[str]
+    SubnetId: Optional[str]
+
+    @classmethod
+    def _deserialize(
+        cls: Type["_Member"],
+        json_data: Optional[Mapping[str, Any]],
+    ) -> Optional["_Member"]:
+        if not json_data:
+            return None
+        return cls(
+            Id=json_data.get("Id"),
+            IP=json_data.get("IP"),
+            URL=json_data.get("URL"),
+            SubnetId=json_data.get("SubnetId"),
+        )
+
+
+# work around possible type aliasing issues when variable has same name as a model
+_Member = Member
+
+
+
+@dataclass
+class Target(BaseModel):
+    Key: Optional[str]
+    Values: Optional[Sequence[str]]
+
+    @classmethod
+    def _deserialize(
+        cls: Type["_Target"],
+        json_data: Optional[Mapping[str, Any]],
+    ) -> Optional["_Target"]:
+        if not json_data:
+            return None
+        return cls(
+            Key=json_data.get("Key"),
+            Values=json_data.get("Values"),
+        )
+
+
+# work around possible type aliasing issues when variable has same name as a model
+_Target = Target
+
+
+@dataclass
+class NagiosStats(BaseModel):
+    UpdatedAt: Optional[int]
+    Services: Optional[int]
+    ServiceChecks5Min: Optional[int]
+    AvgServiceLatencyMs: Optional[int]
+    MaxServiceLatencyMs: Optional[int]
+    AvgServiceExecutionMs: Optional[int]
+    AvgHostLatencyMs: Optional[int]
+
+    @classmethod
+    def _deserialize(
+        cls: Type["_NagiosStats"],
+        json_data: Optional[Mapping[str, Any]],
+    ) -> Optional["_NagiosStats"]:
+        if not json_data:
+            return None
+        return cls(
+            UpdatedAt=json_data.get("UpdatedAt"),
+            Services=json_data.get("Services"),
+            ServiceChecks5Min=json_data.get("ServiceChecks5Min"),
+            AvgServiceLatencyMs=json_data.get("AvgServiceLatencyMs"),
+            MaxServiceLatencyMs=json_data.get("MaxServiceLatencyMs"),
+            AvgServiceExecutionMs=json_data.get("AvgServiceExecutionMs"),
+            AvgHostLatencyMs=json_data.get("AvgHostLatencyMs"),
+        )
+
+
+# work around possible type aliasing issues when variable has same name as a model
+_NagiosStats = NagiosStats
+
+
+@dataclass
+class TypeConfigurationModel(BaseModel):
+    ListRegions: Optional[Sequence[str]]
+    MetricsSampleRate: Optional[float]
+
+    @classmethod
+    def _deserialize(
+        cls: Type["_TypeConfigurationModel"],
+        json_data: Optional[Mapping[str, Any]],
+    ) -> Optional["_TypeConfigurationModel"]:
+        if not json_data:
+            return None
+        return cls(
+            ListRegions=json_data.get("ListRegions"),
+            MetricsSampleRate=json_data.get("MetricsSampleRate"),
+        )
+
+
+# work around possible type aliasing issues when variable has same name as a model
+_TypeConfigurationModel = TypeConfigurationModel
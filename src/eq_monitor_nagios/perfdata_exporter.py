@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# Nagios perfdata exporter
+#
+# Installed on the server by the user data when MetricsExport is set, and run as a systemd service.
+# Nagios appends one line per service check to its perfdata file (check time, host, service,
+# latency, execution time and the plugin's perfdata), and moves the file aside every minute. The
+# exporter follows the file like tail -F, parsing whatever was appended since its last read, and
+# folds every value into a CloudWatch statistic set (count, sum, minimum and maximum) per metric,
+# host and service. Every flush_seconds the statistic sets are sent in batches of max_batch_datums,
+# the most one PutMetricData call accepts. Nothing per check is kept, so memory is bounded by the
+# number of series, and by max_series, past which the window is sent early.
+#
+# It runs on the server's own python3 with only the standard library, and sends through the AWS
+# CLI, so it must not import anything from the rest of this package.
+import argparse
+import json
+import math
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# CloudWatch takes at most 1000 datums per PutMetricData call
+max_batch_datums = 1000
+max_series = 200000
+default_flush_seconds = 60
+default_poll_seconds = 1.0
+
+# bytes read from the file at a time, and the longest line kept; longer lines are dropped
+read_chunk_bytes = 65536
+max_line_bytes = 65536
+
+# CloudWatch's limits on names and dimension values
+max_metric_name_length = 255
+max_dimension_value_length = 1024
+
+# perfdata units of measure and the CloudWatch unit each becomes
+perfdata_units = {
+    '': 'None', 's': 'Seconds', 'ms': 'Milliseconds', 'us': 'Microseconds', '%': 'Percent',
+    'B': 'Bytes', 'KB': 'Kilobytes', 'MB': 'Megabytes', 'GB': 'Gigabytes', 'TB': 'Terabytes', 'c': 'Count',
+}
+
+
+def parse_perfdata(text):
+    # 'label'=value[UOM];[warn];[crit];[min];[max] pairs separated by spaces, where a quoted label
+    # may contain spaces; returns (label, value, unit) for every value CloudWatch can take
+    samples = []
+    position = 0
+    length = len(text)
+    while position < length:
+        while position < length and text[position] == ' ':
+            position += 1
+        if position >= length:
+            break
+        if text[position] == "'":
+            end = text.find("'=", position + 1)
+            if end < 0:
+                break
+            label = text[position + 1:end]
+            position = end + 2
+        else:
+            end = text.find('=', position)
+            if end < 0:
+                break
+            label = text[position:end]
+            position = end + 1
+        end = text.find(' ', position)
+        end = length if end < 0 else end
+        value = text[position:end].split(';', 1)[0]
+        position = end
+
+        number = value.rstrip('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ%')
+        unit = perfdata_units.get(value[len(number):])
+        try:
+            number = float(number)
+        except ValueError:
+            continue
+        if label and unit is not None and math.isfinite(number):
+            samples.append((label, number, unit))
+    return samples
+
+
+def parse_line(line):
+    # The fields of service_perfdata_file_template: time, host, service, latency, execution time and
+    # perfdata, separated by tabs. Returns (timestamp, host, service, samples) or None.
+    fields = line.rstrip('\r').split('\t')
+    if len(fields) != 6:
+        return None
+    timestamp, host, service, latency, execution, perfdata = fields
+    try:
+        samples = [('CheckLatency', float(latency), 'Seconds'), ('CheckExecutionTime', float(execution), 'Seconds')]
+        timestamp = int(timestamp)
+    except ValueError:
+        return None
+    return timestamp, host, service, samples + parse_perfdata(perfdata)
+
+
+class Aggregator:
+
+    def __init__(self, send, max_datums=max_batch_datums, flush_seconds=default_flush_seconds, clock=time.time):
+        self.send = send
+        self.max_datums = max_datums
+        self.max_series = max(max_series, max_datums)
+        self.flush_seconds = flush_seconds
+        self.clock = clock
+        # (metric, host, service, unit) -> [first timestamp, count, sum, minimum, maximum]
+        self.series = {}
+        self.started = None
+
+    def add(self, timestamp, host, service, samples):
+        for metric, value, unit in samples:
+            key = (metric[:max_metric_name_length], host[:max_dimension_value_length], service[:max_dimension_value_length], unit)
+            stats = self.series.get(key)
+            if stats is not None:
+                stats[1] += 1
+                stats[2] += value
+                stats[3] = min(stats[3], value)
+                stats[4] = max(stats[4], value)
+                continue
+            if len(self.series) >= self.max_series:
+                self.flush()
+            if self.started is None:
+                self.started = self.clock()
+            self.series[key] = [timestamp, 1, value, value, value]
+
+    def due(self):
+        return self.started is not None and self.clock() - self.started >= self.flush_seconds
+
+    def flush(self):
+        series, self.series, self.started = self.series, {}, None
+        datums = [{
+            'MetricName': metric,
+            'Dimensions': [{'Name': 'Host', 'Value': host}, {'Name': 'Service', 'Value': service}],
+            'Timestamp': datetime.fromtimestamp(first, timezone.utc).isoformat(),
+            'StatisticValues': {'SampleCount': count, 'Sum': total, 'Minimum': minimum, 'Maximum': maximum},
+            'Unit': unit,
+        } for (metric, host, service, unit), (first, count, total, minimum, maximum) in series.items()]
+        for start in range(0, len(datums), self.max_datums):
+            self.send(datums[start:start + self.max_datums])
+
+
+class FileTail:
+    # Lines appended to a file that is moved aside and recreated now and then. The old file is read
+    # to its end before switching to the new one. The first file is only read from its end, so a
+    # restarted exporter doesn't send what it already sent.
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.buffer = b''
+        self.from_end = True
+
+    def read_lines(self):
+        if self.file is None and not self._open():
+            return
+        while True:
+            chunk = self.file.read(read_chunk_bytes)
+            if chunk:
+                yield from self._split(chunk)
+                continue
+            if not self._rotated():
+                return
+            self.file.close()
+            self.file = None
+            self.buffer = b''
+            if not self._open():
+                return
+
+    def _open(self):
+        try:
+            self.file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return False
+        if self.from_end:
+            self.file.seek(0, os.SEEK_END)
+            self.from_end = False
+        return True
+
+    def _rotated(self):
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.file.fileno()).st_ino
+        except FileNotFoundError:
+            # moved aside and not recreated yet, keep the old one until it is
+            return False
+
+    def _split(self, chunk):
+        lines = (self.buffer + chunk).split(b'\n')
+        self.buffer = lines.pop()
+        if len(self.buffer) > max_line_bytes:
+            self.buffer = b''
+        for line in lines:
+            yield line.decode('utf-8', 'replace')
+
+
+def cli_sender(namespace, region):
+    # the CLI reads the batch from a file, it is too big for an argument
+    def send(datums):
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as batch:
+            json.dump(datums, batch)
+            batch.flush()
+            result = subprocess.run(['aws', 'cloudwatch', 'put-metric-data', '--region', region, '--namespace', namespace,
+                                        '--metric-data', f"file://{batch.name}"], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode:
+            print(f"put-metric-data failed, dropped {len(datums)} datums: {result.stderr.decode('utf-8', 'replace').strip()}", file=sys.stderr)
+    return send
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export Nagios perfdata to CloudWatch as statistic sets')
+    parser.add_argument('--file', required=True)
+    parser.add_argument('--namespace', required=True)
+    parser.add_argument('--region', required=True)
+    parser.add_argument('--flush-seconds', type=float, default=default_flush_seconds)
+    args = parser.parse_args(argv)
+
+    aggregator = Aggregator(cli_sender(args.namespace, args.region), flush_seconds=args.flush_seconds)
+    tail = FileTail(args.file)
+    # systemd stops the service with SIGTERM, send what has been collected first
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            for line in tail.read_lines():
+                parsed = parse_line(line)
+                if parsed is not None:
+                    aggregator.add(*parsed)
+            if aggregator.due():
+                aggregator.flush()
+            time.sleep(default_poll_seconds)
+    finally:
+        aggregator.flush()
+
+
+if __name__ == '__main__':
+    main()
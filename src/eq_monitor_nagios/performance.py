@@ -0,0 +1,73 @@
+# Performance profiles and Nagios scheduling statistics
+#
+# A PerformanceProfile picks the instance type a server gets when InstanceType isn't set, and the
+# nagios.cfg settings the user data applies before Nagios starts. HighVolume follows the Nagios
+# tuning advice for large installations: large_installation_tweaks, one check worker per vCPU,
+# status.dat, the temp file and the check result spool on tmpfs, and check results reaped every
+# second instead of every ten, with state retention and status updates written less often.
+#
+# Every server also publishes a few nagiostats values to {default_ssm_path}/nagios_stats/{instance_id}
+# every default_stats_interval_minutes, as comma separated integers after the time they were taken,
+# which read_handler returns as NagiosStats.
+from dataclasses import dataclass, field
+from typing import Mapping, Optional
+
+from .constants import (
+    const_key_nagios_stats,
+    default_instance_type,
+    default_performance_profile,
+    default_ssm_path,
+    nagios_ramdisk_dir,
+)
+
+
+@dataclass
+class Profile:
+    instance_type: str
+    nagios_cfg: Mapping[str, str] = field(default_factory=dict)
+    ramdisk: bool = False
+    # check_workers follows the vCPU count, set every time Nagios starts since the instance type can change
+    check_worker_per_vcpu: bool = False
+
+
+performance_profiles = {
+    'Default': Profile(default_instance_type),
+    'HighVolume': Profile('c5.xlarge', ramdisk=True, check_worker_per_vcpu=True, nagios_cfg={
+        'large_installation_tweaks': '1',
+        'status_file': f"{nagios_ramdisk_dir}/status.dat",
+        'temp_file': f"{nagios_ramdisk_dir}/nagios.tmp",
+        'check_result_path': f"{nagios_ramdisk_dir}/checkresults",
+        'check_result_reaper_frequency': '1',
+        'max_check_result_reaper_time': '10',
+        'status_update_interval': '15',
+        'retention_update_interval': '15',
+    }),
+}
+
+# NagiosStats properties and the nagiostats MRTG variables they come from, in published order
+nagios_stats_fields = [
+    ('Services', 'NUMSERVICES'),
+    ('ServiceChecks5Min', 'NUMSVCACTCHK5M'),
+    ('AvgServiceLatencyMs', 'AVGACTSVCLAT'),
+    ('MaxServiceLatencyMs', 'MAXACTSVCLAT'),
+    ('AvgServiceExecutionMs', 'AVGACTSVCEXT'),
+    ('AvgHostLatencyMs', 'AVGACTHSTLAT'),
+]
+
+
+def performance_profile(name: Optional[str]) -> Profile:
+    return performance_profiles[name or default_performance_profile]
+
+
+def nagios_stats_parameter_name(instance_id: str) -> str:
+    return f"{default_ssm_path}/{const_key_nagios_stats}/{instance_id}"
+
+
+def parse_nagios_stats(value: str) -> Optional[Mapping[str, int]]:
+    # None for anything that isn't a complete set of numbers, such as stats taken while Nagios was down
+    parts = value.split(',')
+    if len(parts) != len(nagios_stats_fields) + 1 or not all(part.strip().isdigit() for part in parts):
+        return None
+    stats = {'UpdatedAt': int(parts[0])}
+    stats.update((name, int(part)) for (name, _), part in zip(nagios_stats_fields, parts[1:]))
+    return stats
@@ -0,0 +1,166 @@
+# Callback delays for create polling
+#
+# The user data script reports its progress through the status parameter, one milestone at a time.
+# Rather than polling at a fixed period, the next callback is scheduled for when the server is
+# expected to be done, estimated from how long each remaining phase has taken before. Phase
+# durations observed during a create are kept in a rolling history in SSM, under
+# {default_ssm_path}/poll_history, which is read once per create and updated once at the end. A
+# server launched from a cached image skips the build milestones and one claimed from a warm pool is
+# already done once it is running, so each of those paths has its own phases and history.
+import json
+import logging
+import statistics
+import time
+from typing import Any, MutableMapping, Optional
+
+from .clients import get_client
+from .constants import (
+    const_key_image_cached,
+    const_key_poll_durations,
+    const_key_poll_history,
+    const_key_poll_phase,
+    const_key_poll_since,
+    const_key_warm_pool_claimed,
+    default_poll_history_size,
+    default_poll_max_delay,
+    default_poll_min_delay,
+    default_poll_overrun_fraction,
+    default_ssm_path,
+)
+
+LOG = logging.getLogger(__name__)
+
+poll_phase_pending = 'pending'
+poll_phase_not_started = 'NotStarted'
+poll_phase_done = 'Done'
+
+poll_path_build = 'build'
+poll_path_cached = 'cached'
+poll_path_claimed = 'claimed'
+
+# phases in the order a create goes through them, with the seconds each is expected to take
+# until there is history: EC2 pending, waiting for the script, then the script's milestones
+poll_phase_defaults = {
+    poll_phase_pending: 30,
+    poll_phase_not_started: 30,
+    'Starting': 5,
+    'StartingYumUpdates': 90,
+    'DeployingNagios': 120,
+    'DeployingPlugins': 30,
+    'StartingServices': 10,
+}
+poll_phases = list(poll_phase_defaults)
+
+# the phases of each create path; a cached image only starts its services, and a warm pool
+# instance only has to start, its script finished when the pool built it
+poll_path_phase_defaults = {
+    poll_path_build: poll_phase_defaults,
+    poll_path_cached: {phase: poll_phase_defaults[phase] for phase in (poll_phase_pending, poll_phase_not_started, 'Starting', 'StartingServices')},
+    poll_path_claimed: {poll_phase_pending: 15},
+}
+
+poll_context_keys = [const_key_poll_phase, const_key_poll_since, const_key_poll_durations, const_key_poll_history]
+
+
+def poll_history_parameter_name() -> str:
+    return f"{default_ssm_path}/{const_key_poll_history}"
+
+
+def poll_path(callback_context: MutableMapping[str, Any]) -> str:
+    if callback_context.get(const_key_warm_pool_claimed):
+        return poll_path_claimed
+    if callback_context.get(const_key_image_cached):
+        return poll_path_cached
+    return poll_path_build
+
+
+def schedule_next_poll(session, callback_context: MutableMapping[str, Any], phase: str,
+                        now: Optional[float] = None) -> int:
+    now = time.time() if now is None else now
+    path = poll_path(callback_context)
+    if const_key_poll_history not in callback_context:
+        callback_context[const_key_poll_history] = load_poll_history(session).get(path, {})
+    _track_phase(callback_context, path, phase, now)
+
+    delay = next_poll_delay(callback_context[const_key_poll_history], phase, now - callback_context[const_key_poll_since], path)
+    LOG.info(f"...Phase {phase} of a {path} create, next poll in {delay} seconds")
+    return delay
+
+
+def next_poll_delay(history: MutableMapping[str, list], phase: str, elapsed: float, path: str = poll_path_build) -> int:
+    defaults = poll_path_phase_defaults[path]
+    if phase not in defaults:
+        return default_poll_min_delay
+
+    # time left in the current phase plus the expected time of every phase after it
+    phases = list(defaults)
+    expected = _expected_duration(history, defaults, phase)
+    remaining = expected - elapsed
+    if remaining <= 0:
+        # running late, check back after a fraction of the usual phase time
+        remaining = expected * default_poll_overrun_fraction
+    for later_phase in phases[phases.index(phase) + 1:]:
+        remaining += _expected_duration(history, defaults, later_phase)
+
+    return int(min(default_poll_max_delay, max(default_poll_min_delay, remaining)))
+
+
+def finish_polling(session, callback_context: MutableMapping[str, Any], now: Optional[float] = None) -> None:
+    # record the phase that just ended, fold this create's durations into the shared history,
+    # and drop the polling state from the callback context
+    now = time.time() if now is None else now
+    path = poll_path(callback_context)
+    if const_key_poll_phase in callback_context:
+        _track_phase(callback_context, path, poll_phase_done, now)
+    durations = callback_context.get(const_key_poll_durations) or {}
+    for key in poll_context_keys:
+        callback_context.pop(key, None)
+    if not durations:
+        return
+
+    history = load_poll_history(session)
+    path_history = history.setdefault(path, {})
+    for phase, seconds in durations.items():
+        path_history[phase] = (path_history.get(phase, []) + [seconds])[-default_poll_history_size:]
+    ssm_client = get_client(session, 'ssm')
+    ssm_client.put_parameter(Name=poll_history_parameter_name(), Value=json.dumps(history, sort_keys=True),
+                                Type='String', Overwrite=True)
+    LOG.info(f"...Recorded phase durations {durations}")
+
+
+def load_poll_history(session) -> MutableMapping[str, MutableMapping[str, list]]:
+    # the history of every create path; one written before there were paths is the build history
+    ssm_client = get_client(session, 'ssm')
+    ssm_response = ssm_client.get_parameters(Names=[poll_history_parameter_name()])
+    if not ssm_response['Parameters']:
+        return {}
+    history = json.loads(ssm_response['Parameters'][0]['Value'])
+    if history and not any(path in history for path in poll_path_phase_defaults):
+        history = {poll_path_build: history}
+    return history
+
+
+def _expected_duration(history: MutableMapping[str, list], defaults: MutableMapping[str, int], phase: str) -> float:
+    samples = history.get(phase)
+    return statistics.median(samples) if samples else defaults[phase]
+
+
+def _track_phase(callback_context: MutableMapping[str, Any], path: str, phase: str, now: float) -> None:
+    previous = callback_context.get(const_key_poll_phase)
+    if previous == phase:
+        return
+
+    # a phase's duration is only known when the very next phase was seen, otherwise the time
+    # between polls covers several phases and can't be split between them
+    if previous in poll_path_phase_defaults[path] and _next_phase(path, previous) == phase:
+        durations = callback_context.setdefault(const_key_poll_durations, {})
+        durations[previous] = round(now - callback_context[const_key_poll_since], 1)
+
+    callback_context[const_key_poll_phase] = phase
+    callback_context[const_key_poll_since] = now
+
+
+def _next_phase(path: str, phase: str) -> str:
+    phases = list(poll_path_phase_defaults[path])
+    index = phases.index(phase) + 1
+    return phases[index] if index < len(phases) else poll_phase_done
@@ -0,0 +1,52 @@
+# Instance probe for create polling
+#
+# One poll needs each instance's EC2 state, its public IP and the status its user data script
+# last wrote. probe_instances gets all of them with one describe_instances call for every
+# instance and one get_parameters call per 10 running instances; instances that are not running
+# yet can't have written a status, so they cost no SSM call. get_parameters reports parameters
+# that don't exist in InvalidParameters instead of failing, which is how a script that hasn't
+# written its status yet is told apart from an SSM error, and any real error is raised.
+import logging
+from typing import Any, MutableMapping, Sequence
+
+from botocore.exceptions import ClientError
+
+from .clients import get_client
+from .constants import const_key_status, default_ssm_path, ssm_batch_size
+
+LOG = logging.getLogger(__name__)
+
+
+def status_parameter_name(instance_id: str) -> str:
+    return f"{default_ssm_path}/{const_key_status}/{instance_id}"
+
+
+def probe_instances(session, instance_ids: Sequence[str]) -> MutableMapping[str, MutableMapping[str, Any]]:
+    # Returns the state, public IP and user data status of every instance. A status of None means
+    # the script has not written one yet.
+    ec2_client = get_client(session, 'ec2')
+    ssm_client = get_client(session, 'ssm')
+    probes = {instance_id: {'state': 'pending', 'ip': None, 'status': None} for instance_id in instance_ids}
+
+    try:
+        ec2_response = ec2_client.describe_instances(InstanceIds=list(instance_ids))
+        for reservation in ec2_response['Reservations']:
+            for instance in reservation['Instances']:
+                probe = probes[instance['InstanceId']]
+                probe['state'] = instance['State']['Name']
+                probe['ip'] = instance.get('PublicIpAddress')
+    except ClientError as err:
+        # instances launched moments ago may not be visible yet, they count as pending
+        if err.response['Error']['Code'] != 'InvalidInstanceID.NotFound':
+            raise
+        LOG.info("...Instances not visible to EC2 yet")
+
+    names = {status_parameter_name(instance_id): instance_id
+                for instance_id, probe in probes.items() if probe['state'] == 'running'}
+    name_list = list(names)
+    for start in range(0, len(name_list), ssm_batch_size):
+        ssm_response = ssm_client.get_parameters(Names=name_list[start:start + ssm_batch_size])
+        for parameter in ssm_response['Parameters']:
+            probes[names[parameter['Name']]]['status'] = parameter['Value']
+
+    return probes
@@ -0,0 +1,125 @@
+# Checkpointed create
+#
+# build_instance provisions a server as a graph of steps: the image lookup, the IAM role, policy,
+# attachments and instance profile (or a reference to the shared ones), the warm pool claim and the
+# launch. run_create_steps runs every step whose prerequisites are done concurrently on a small
+# thread pool, wave by wave like the delete teardown, so create takes about as long as its longest
+# chain of calls rather than all of them added up; each step's time is kept with the checkpoints.
+# A step stores whatever it made in the callback context as soon as it is done, and
+# run_create_steps adds its name to the finished steps there, so an invocation that is throttled or
+# fails partway is followed by one that picks up at the first unfinished steps. Names are chosen
+# before the calls that create them and an object that already exists counts as made, so repeating
+# a step whose response was lost doesn't make a second one. When create fails, rollback_record
+# lists only what the finished steps made, for the delete teardown to remove.
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Mapping, MutableMapping, NamedTuple, Optional, Sequence
+
+from .constants import (
+    const_key_create_done,
+    const_key_create_timings,
+    const_key_fleet_launched,
+    const_key_instance_id,
+    const_key_instance_profile,
+    const_key_members,
+    const_key_policy_arn,
+    const_key_role,
+    const_key_shared_member,
+    const_key_warm_pool,
+    const_key_warm_pool_claimed,
+    default_create_workers,
+)
+from .rate_limit import is_throttling_error
+
+LOG = logging.getLogger(__name__)
+
+# the steps that made each IAM object of a server's own role, and the key it is stored under
+rollback_iam_steps = {
+    'create_role': const_key_role,
+    'create_policy': const_key_policy_arn,
+    'create_instance_profile': const_key_instance_profile,
+}
+
+
+class CreateStep(NamedTuple):
+    name: str
+    # returns None once the step is done, or why it has to be called again in a later invocation
+    call: Callable[[], Optional[str]]
+    depends_on: Sequence[str] = ()
+
+
+def run_create_steps(steps: Sequence[CreateStep], callback_context: MutableMapping[str, Any]) -> Optional[str]:
+    # Runs the steps that are not done yet as their prerequisites finish, stopping after the wave in
+    # which one has to wait and returning its reason. When steps fail, the ones that finished in the
+    # same wave are still checkpointed before the first failure is raised, picking one that isn't
+    # throttling if there is one, since that decides whether create retries or rolls back.
+    done = callback_context.setdefault(const_key_create_done, [])
+    timings = callback_context.setdefault(const_key_create_timings, {})
+    waiting = None
+    with ThreadPoolExecutor(max_workers=default_create_workers) as executor:
+        while waiting is None:
+            ready = [step for step in steps if step.name not in done and all(name in done for name in step.depends_on)]
+            if not ready:
+                break
+            futures = {step.name: executor.submit(_run_step, step) for step in ready}
+            errors = []
+            for name, future in futures.items():
+                try:
+                    step_waiting, timings[name] = future.result()
+                except Exception as err:
+                    errors.append(err)
+                    continue
+                if step_waiting is not None:
+                    LOG.info(f"...Create step {name} waiting: {step_waiting}")
+                    waiting = waiting or step_waiting
+                else:
+                    done.append(name)
+                    LOG.info(f"...Create step {name} done in {timings[name]}ms")
+            if errors:
+                raise next((err for err in errors if not is_throttling_error(err)), errors[0])
+
+    if waiting is None:
+        unfinished = [step.name for step in steps if step.name not in done]
+        if unfinished:
+            raise RuntimeError(f"create steps {', '.join(unfinished)} have unknown prerequisites")
+        LOG.info(f"...Create steps took {round(sum(timings.values()), 1)}ms, {critical_path_ms(steps, timings)}ms on the critical path")
+    return waiting
+
+
+def critical_path_ms(steps: Sequence[CreateStep], timings: Mapping[str, float]) -> float:
+    # the longest chain of dependent steps, which sets how long create takes when the rest run alongside it
+    finished = {}
+    for step in steps:
+        finished[step.name] = timings.get(step.name, 0) + max((finished.get(name, 0) for name in step.depends_on), default=0)
+    return round(max(finished.values(), default=0), 1)
+
+
+def _run_step(step: CreateStep):
+    started = time.perf_counter()
+    waiting = step.call()
+    return waiting, round((time.perf_counter() - started) * 1000, 1)
+
+
+def rollback_record(callback_context: MutableMapping[str, Any], model_id: Optional[str] = None) -> Optional[MutableMapping[str, Any]]:
+    # A record of what the finished create steps made, in the layout delete tears down, or None when nothing was
+    done = set(callback_context.get(const_key_create_done, []))
+    instance_ids = [member[const_key_instance_id] for member in callback_context.get(const_key_members) or []]
+    instance_ids.extend(instance_id for launched in (callback_context.get(const_key_fleet_launched) or {}).values() for instance_id in launched)
+    instance_ids.extend(instance_id for instance_id in (model_id, callback_context.get(const_key_warm_pool_claimed)) if instance_id)
+    instance_ids = list(dict.fromkeys(instance_ids))
+
+    record = {}
+    if instance_ids:
+        record[const_key_instance_id] = instance_ids[0]
+        if len(instance_ids) > 1:
+            record[const_key_members] = [{const_key_instance_id: instance_id} for instance_id in instance_ids]
+    # the shared role is only removed with its last reference, which delete releases, and a warm pool with its last user
+    if 'register_shared_role_member' in done:
+        record[const_key_shared_member] = callback_context[const_key_shared_member]
+        if callback_context.get(const_key_warm_pool):
+            record[const_key_warm_pool] = callback_context[const_key_warm_pool]
+        record.update((key, callback_context.get(key)) for key in (const_key_role, const_key_policy_arn, const_key_instance_profile))
+    else:
+        record.update((key, callback_context[key]) for name, key in rollback_iam_steps.items() if name in done)
+    return record or None
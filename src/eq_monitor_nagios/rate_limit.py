@@ -0,0 +1,134 @@
+# Client-side rate limits for AWS calls
+#
+# SSM, IAM and EC2 throttle each API per account, so a stack creating or deleting many servers at
+# once soon runs into them. Every client from get_client gets botocore hooks that take a token from
+# a bucket before each attempt is sent, one bucket per region, service and operation (AWS limits
+# each region separately), shared by all clients in the process and filled at the API's rate from
+# default_api_tps. When the API throttles anyway (other Lambdas share the account's limits), the
+# bucket's rate is halved, and it climbs back over the following successful calls. Callers wait for
+# a token instead of being throttled; botocore's adaptive retry mode, set in clients.py, retries
+# whatever still gets through.
+import functools
+import logging
+import threading
+import time
+from typing import Mapping, MutableMapping, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+from .constants import default_api_tps, default_rate_limit_min_tps, default_rate_limit_recovery_calls
+from .metrics import throttle_error_codes
+
+LOG = logging.getLogger(__name__)
+
+# waits longer than this are logged, in seconds
+rate_limit_log_wait = 1.0
+
+_rate_limits = dict(default_api_tps)
+_buckets: MutableMapping[Tuple[str, str, str], 'TokenBucket'] = {}
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket:
+    # holds up to one second of calls; a caller takes a token even when the bucket is empty, and then
+    # waits until the refill has paid it back, so concurrent callers queue in order
+
+    def __init__(self, name: str, tps: float):
+        self.name = name
+        self.max_tps = tps
+        self.tps = tps
+        self.tokens = max(1.0, tps)
+        self.updated = time.monotonic()
+        self.last_throttle = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(max(1.0, self.tps), self.tokens + (now - self.updated) * self.tps)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.tps if self.tokens < 0 else 0.0
+        if wait:
+            if wait > rate_limit_log_wait:
+                LOG.info(f"...Rate limiting {self.name} at {round(self.tps, 2)} calls per second, waiting {round(wait, 1)}s")
+            time.sleep(wait)
+        return wait
+
+    def throttled(self) -> None:
+        # several calls in flight are throttled together, so only slow down once per refill interval
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_throttle < 1 / self.tps:
+                return
+            self.last_throttle = now
+            self.tps = max(default_rate_limit_min_tps, self.tps / 2)
+            self.tokens = min(self.tokens, 0.0)
+            LOG.info(f"...{self.name} throttled, limiting it to {round(self.tps, 2)} calls per second")
+
+    def succeeded(self) -> None:
+        if self.tps < self.max_tps:
+            with self.lock:
+                self.tps = min(self.max_tps, self.tps + self.max_tps / default_rate_limit_recovery_calls)
+
+
+def set_rate_limits(tps: Mapping[str, float]) -> None:
+    # replaces default_api_tps, for tests and benchmarks; an empty mapping turns limiting off
+    with _buckets_lock:
+        _rate_limits.clear()
+        _rate_limits.update(tps)
+        _buckets.clear()
+
+
+def rate_limit_client(client) -> None:
+    meta = client.meta
+    events = meta.events
+    events.register('before-send.*.*', functools.partial(_before_send, meta.region_name))
+    events.register('needs-retry.*.*', functools.partial(_needs_retry, meta.region_name))
+    events.register('after-call.*.*', functools.partial(_after_call, meta.region_name))
+
+
+def is_throttling_error(err: Exception) -> bool:
+    return isinstance(err, ClientError) and err.response.get('Error', {}).get('Code') in throttle_error_codes
+
+
+def get_bucket(region: str, service: str, operation: str) -> Optional[TokenBucket]:
+    key = (region, service, operation)
+    bucket = _buckets.get(key)
+    if bucket is None:
+        with _buckets_lock:
+            tps = _rate_limits.get(f"{service}:{operation}", _rate_limits.get(service))
+            if tps is None:
+                return None
+            bucket = _buckets.setdefault(key, TokenBucket(f"{service}:{operation} in {region}", tps))
+    return bucket
+
+
+def _event_bucket(region: str, event_name: str) -> Optional[TokenBucket]:
+    # botocore names events {event}.{service}.{operation}
+    parts = event_name.split('.')
+    if len(parts) < 3:
+        return None
+    return get_bucket(region, parts[1], parts[2])
+
+
+def _before_send(region, event_name, **kwargs):
+    bucket = _event_bucket(region, event_name)
+    if bucket is not None:
+        bucket.acquire()
+
+
+def _needs_retry(region, event_name, response=None, **kwargs):
+    if response is None or response[1].get('Error', {}).get('Code') not in throttle_error_codes:
+        return
+    bucket = _event_bucket(region, event_name)
+    if bucket is not None:
+        bucket.throttled()
+
+
+def _after_call(region, event_name, parsed, **kwargs):
+    if 'Error' in parsed:
+        return
+    bucket = _event_bucket(region, event_name)
+    if bucket is not None:
+        bucket.succeeded()
@@ -0,0 +1,62 @@
+# Multi-region listing
+#
+# Every region keeps its own servers' records in its own SSM, so list_handler normally only sees
+# the region it runs in. With regions configured, list_records_by_region sweeps each of them with
+# list_records, all at once on a bounded thread pool, so a page takes about as long as the slowest
+# region rather than all of them added up. Each region gets its share of the page size, and the
+# next token holds the position of every region that has more to list, under the 'regions' key so
+# it can't be mistaken for a single-region token. The regions come from the type configuration's
+# ListRegions, set with cloudformation set-type-configuration.
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Mapping, MutableMapping, Optional, Sequence, Tuple
+
+from .constants import default_list_page_size, default_list_region_workers, default_list_regions, list_regions_env
+from .storage import list_records
+
+LOG = logging.getLogger(__name__)
+
+
+def list_regions(type_configuration=None) -> List[str]:
+    # the type configuration's ListRegions, else the env var, else default_list_regions
+    value = os.environ.get(list_regions_env)
+    if type_configuration is not None and type_configuration.ListRegions is not None:
+        regions = type_configuration.ListRegions
+    elif value is not None:
+        regions = [region.strip() for region in value.split(',')]
+    else:
+        regions = default_list_regions
+    return list(dict.fromkeys(region for region in regions if region))
+
+
+def list_records_by_region(session, regions: Sequence[str], next_token: Optional[str] = None,
+                            page_size: int = default_list_page_size) -> Tuple[List[Tuple[str, MutableMapping[str, Any]]], Optional[str]]:
+    # Returns (region, record) pairs in the order of regions, and the token of the next page
+    positions = _decode_region_token(regions, next_token)
+    region_page_size = -(-page_size // len(positions))
+    LOG.info(f"...Listing {', '.join(positions)}")
+    with ThreadPoolExecutor(max_workers=min(default_list_region_workers, len(positions))) as executor:
+        futures = {region: executor.submit(list_records, session, token, region_page_size, region)
+                    for region, token in positions.items()}
+
+    records = []
+    next_positions = {}
+    for region, future in futures.items():
+        region_records, region_token = future.result()
+        records.extend((region, record) for record in region_records)
+        if region_token:
+            next_positions[region] = region_token
+
+    return records, json.dumps({'regions': next_positions}) if next_positions else None
+
+
+def _decode_region_token(regions: Sequence[str], next_token: Optional[str]) -> Mapping[str, Optional[str]]:
+    if not next_token:
+        return {region: None for region in regions}
+    position = json.loads(next_token)
+    region_positions = position.get('regions') if isinstance(position, dict) else None
+    if not isinstance(region_positions, dict) or not region_positions or set(region_positions) - set(regions):
+        raise ValueError(f"unknown list position {next_token}")
+    return {region: region_positions[region] for region in regions if region in region_positions}
@@ -0,0 +1,72 @@
+# In-place resize
+#
+# EC2 only changes an instance's type while it is stopped, so update resizes a server over several
+# invocations instead of replacing it: start_resize stops every instance of the server, and each
+# check_resize moves it one step on, changing the type of each instance once all are stopped,
+# starting them again, and waiting until they are running and pass their EC2 status checks. The
+# instances keep their ids, volumes, role and SSM state; only their public IPs change, so those are
+# returned once the server is healthy. The resize is a plain dict kept in the callback context.
+import logging
+from typing import Any, MutableMapping, Optional, Sequence
+
+from .clients import get_client
+
+LOG = logging.getLogger(__name__)
+
+resize_phase_stopping = 'stopping'
+resize_phase_starting = 'starting'
+
+# states an instance can pass through in each phase without the resize having gone wrong
+resize_phase_states = {
+    resize_phase_stopping: ['pending', 'running', 'stopping', 'stopped'],
+    resize_phase_starting: ['stopped', 'pending', 'running'],
+}
+
+
+class ResizeFailed(Exception):
+    pass
+
+
+def start_resize(session, instance_ids: Sequence[str], instance_type: str) -> MutableMapping[str, Any]:
+    ec2_client = get_client(session, 'ec2')
+    LOG.info(f"...Stopping {', '.join(instance_ids)} to resize to {instance_type}")
+    ec2_client.stop_instances(InstanceIds=list(instance_ids))
+    return {'type': instance_type, 'instances': list(instance_ids), 'phase': resize_phase_stopping, 'polls': 0}
+
+
+def check_resize(session, resize: MutableMapping[str, Any]) -> Optional[MutableMapping[str, str]]:
+    # Returns the public IP of every instance once the server is back and healthy, otherwise None,
+    # updating the resize in place. Raises ResizeFailed when an instance ends up in a state the
+    # resize can't recover from.
+    ec2_client = get_client(session, 'ec2')
+    instance_ids = resize['instances']
+    resize['polls'] += 1
+    ec2_response = ec2_client.describe_instances(InstanceIds=instance_ids)
+    instances = {instance['InstanceId']: instance for reservation in ec2_response['Reservations'] for instance in reservation['Instances']}
+
+    unexpected = [f"{instance_id} is {instances[instance_id]['State']['Name']}" for instance_id in instance_ids
+                    if instances[instance_id]['State']['Name'] not in resize_phase_states[resize['phase']]]
+    if unexpected:
+        raise ResizeFailed(', '.join(unexpected))
+
+    if resize['phase'] == resize_phase_stopping:
+        if any(instance['State']['Name'] != 'stopped' for instance in instances.values()):
+            return None
+        for instance_id in instance_ids:
+            if instances[instance_id].get('InstanceType') != resize['type']:
+                LOG.info(f"...Changing {instance_id} from {instances[instance_id].get('InstanceType')} to {resize['type']}")
+                ec2_client.modify_instance_attribute(InstanceId=instance_id, InstanceType={'Value': resize['type']})
+        LOG.info(f"...Starting {', '.join(instance_ids)}")
+        ec2_client.start_instances(InstanceIds=instance_ids)
+        resize['phase'] = resize_phase_starting
+        return None
+
+    if any(instance['State']['Name'] != 'running' for instance in instances.values()):
+        return None
+    ec2_response = ec2_client.describe_instance_status(InstanceIds=instance_ids)
+    healthy = [status['InstanceId'] for status in ec2_response['InstanceStatuses']
+                if status['InstanceStatus']['Status'] == 'ok' and status['SystemStatus']['Status'] == 'ok']
+    if len(healthy) < len(instance_ids):
+        LOG.info(f"...{len(healthy)} of {len(instance_ids)} instances pass their status checks")
+        return None
+    return {instance_id: instances[instance_id].get('PublicIpAddress') for instance_id in instance_ids}
@@ -0,0 +1,59 @@
+# Shard groups
+#
+# Servers with the same ShardGroup split their targets between them. Each server in a group is a
+# parameter under {default_ssm_path}/shard_groups/{group}, and a target host belongs to the server
+# that follows it on a consistent hash ring built from the group's members, where every server
+# has default_shard_ring_points points. When a server joins or leaves, only the hosts between its
+# points and the ones before them move, about 1/N of them, so the target sync that rebalances the
+# group only sends those hosts to their new servers and removes them from the old ones.
+import bisect
+import hashlib
+import logging
+from typing import List, Sequence, Tuple
+
+from .clients import get_client
+from .constants import const_key_shard_groups, default_shard_ring_points, default_ssm_path, ssm_batch_size
+
+LOG = logging.getLogger(__name__)
+
+
+def shard_group_path(group: str) -> str:
+    return f"{default_ssm_path}/{const_key_shard_groups}/{group}"
+
+
+def register_shard_member(session, group: str, server_id: str) -> None:
+    ssm_client = get_client(session, 'ssm')
+    ssm_client.put_parameter(Name=f"{shard_group_path(group)}/{server_id}", Value=server_id, Type='String', Overwrite=True)
+
+
+def deregister_shard_member(session, group: str, server_id: str) -> None:
+    ssm_client = get_client(session, 'ssm')
+    ssm_client.delete_parameters(Names=[f"{shard_group_path(group)}/{server_id}"])
+
+
+def shard_members(session, group: str) -> List[str]:
+    ssm_client = get_client(session, 'ssm')
+    members = []
+    kwargs = {'Path': shard_group_path(group), 'MaxResults': ssm_batch_size}
+    while True:
+        ssm_response = ssm_client.get_parameters_by_path(**kwargs)
+        members.extend(p['Value'] for p in ssm_response['Parameters'])
+        if not ssm_response.get('NextToken'):
+            break
+        kwargs['NextToken'] = ssm_response['NextToken']
+    return sorted(members)
+
+
+def shard_ring(server_ids: Sequence[str]) -> List[Tuple[int, str]]:
+    return sorted((_ring_hash(f"{server_id}#{point}"), server_id)
+                    for server_id in server_ids for point in range(default_shard_ring_points))
+
+
+def shard_owner(ring: Sequence[Tuple[int, str]], host_id: str) -> str:
+    # the first server point at or after the host's hash, wrapping around
+    index = bisect.bisect_left(ring, (_ring_hash(host_id), ''))
+    return ring[index % len(ring)][1]
+
+
+def _ring_hash(value: str) -> int:
+    return int(hashlib.md5(value.encode('utf-8')).hexdigest()[:16], 16)
@@ -0,0 +1,127 @@
+# Shared role and instance profile
+#
+# With SharedRole set, every Nagios server in the account and region uses one role, policy and
+# instance profile instead of creating its own. Each server holding a reference is a parameter
+# under {default_ssm_path}/shared_role_members, named by a member id the server keeps in its record.
+# Counting those parameters gives the reference count, and unlike a counter in a single parameter
+# it can't lose updates when creates and deletes run at the same time. Create skips IAM entirely
+# when the instance profile exists, and the IAM objects are removed with the last reference.
+import logging
+from typing import Any, Mapping, MutableMapping, Optional, Sequence, Tuple
+
+from botocore.exceptions import ClientError
+
+from .clients import get_client
+from .constants import (
+    const_key_instance_profile,
+    const_key_policy_arn,
+    const_key_role,
+    const_key_shared_role_members,
+    default_ssm_path,
+    ssm_managed_instance_policy_arn,
+)
+from .teardown import run_teardown, teardown_steps
+
+LOG = logging.getLogger(__name__)
+
+
+def shared_role_names(session) -> Tuple[str, str, str]:
+    # IAM names are global to the account, so the region keeps each region's servers separate
+    region = get_client(session, 'ec2').meta.region_name.replace('-', '_')
+    return f"nagios_shared_role_{region}", f"nagios_shared_instance_profile_{region}", f"nagios_shared_policy_{region}"
+
+
+def shared_role_member_name(member_id: str) -> str:
+    return f"{default_ssm_path}/{const_key_shared_role_members}/{member_id}"
+
+
+def register_shared_role_member(session, member_id: str) -> None:
+    ssm_client = get_client(session, 'ssm')
+    ssm_client.put_parameter(Name=shared_role_member_name(member_id), Value=member_id, Type='String', Overwrite=True)
+
+
+def ensure_shared_role(session, assume_role_document: str, policy_document: str, partition: str) -> Tuple[str, str, str, bool]:
+    # Returns the role, instance profile and policy ARN, and whether any of them had to be created
+    # (in which case the instance profile may not be usable by EC2 yet). The partition is the
+    # request's, for the policy ARN.
+    iam_client = get_client(session, 'iam')
+    role_name, instance_profile_name, policy_name = shared_role_names(session)
+
+    try:
+        iam_response = iam_client.get_instance_profile(InstanceProfileName=instance_profile_name)
+        roles = iam_response['InstanceProfile']['Roles']
+        if roles:
+            account = iam_response['InstanceProfile']['Arn'].split(':')[4]
+            LOG.info(f"...Using shared instance profile {instance_profile_name}")
+            return role_name, instance_profile_name, f"arn:{partition}:iam::{account}:policy/{policy_name}", False
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'NoSuchEntity':
+            raise
+
+    # every call tolerates the object already existing, so concurrent creates can both run this
+    LOG.info(f"...Creating shared role {role_name} and instance profile {instance_profile_name}")
+    try:
+        iam_response = iam_client.create_role(RoleName=role_name, AssumeRolePolicyDocument=assume_role_document, Description='Shared role for nagios servers')
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'EntityAlreadyExists':
+            raise
+        iam_response = iam_client.get_role(RoleName=role_name)
+    account = iam_response['Role']['Arn'].split(':')[4]
+    policy_arn = f"arn:{partition}:iam::{account}:policy/{policy_name}"
+
+    ignore_exists(lambda: iam_client.create_policy(PolicyName=policy_name, PolicyDocument=policy_document, Description='Shared policy for nagios servers'))
+    iam_client.attach_role_policy(RoleName=role_name, PolicyArn=ssm_managed_instance_policy_arn)
+    iam_client.attach_role_policy(RoleName=role_name, PolicyArn=policy_arn)
+    ignore_exists(lambda: iam_client.create_instance_profile(InstanceProfileName=instance_profile_name))
+    add_role_once(iam_client, instance_profile_name, role_name)
+
+    return role_name, instance_profile_name, policy_arn, True
+
+
+def release_shared_role(session, member_ids: Sequence[str], record: Mapping[str, Any]) -> MutableMapping[str, str]:
+    # Drops this server's references (its own, and a drained warm pool's) and removes the shared IAM
+    # objects if they were the last ones. Returns the teardown failures, if any; calling it again retries them.
+    ssm_client = get_client(session, 'ssm')
+    for member_id in member_ids:
+        try:
+            ssm_client.delete_parameter(Name=shared_role_member_name(member_id))
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ParameterNotFound':
+                raise
+
+    ssm_response = ssm_client.get_parameters_by_path(Path=f"{default_ssm_path}/{const_key_shared_role_members}", MaxResults=1)
+    if ssm_response['Parameters']:
+        LOG.info("...Shared role still in use by other servers")
+        return {}
+
+    LOG.info("...Last server using the shared role, removing it")
+    iam_record = {key: record.get(key) for key in (const_key_role, const_key_instance_profile, const_key_policy_arn)}
+    return run_teardown(teardown_steps(session, iam_record), set())
+
+
+def find_local_policy_arn(iam_client, policy_name: str) -> Optional[str]:
+    # also used by create, for a policy an earlier invocation made but didn't get to checkpoint
+    paginator = iam_client.get_paginator('list_policies')
+    for page in paginator.paginate(Scope='Local'):
+        for policy in page['Policies']:
+            if policy['PolicyName'] == policy_name:
+                return policy['Arn']
+    return None
+
+
+def ignore_exists(call) -> None:
+    # also used by create for its own role, whose names are fixed before the calls that make them
+    try:
+        call()
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'EntityAlreadyExists':
+            raise
+
+
+def add_role_once(iam_client, instance_profile_name: str, role_name: str) -> None:
+    # also used by create; an instance profile holds one role, so adding it again reports LimitExceeded
+    try:
+        iam_client.add_role_to_instance_profile(InstanceProfileName=instance_profile_name, RoleName=role_name)
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'LimitExceeded':
+            raise
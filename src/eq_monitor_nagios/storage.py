@@ -0,0 +1,206 @@
+# Server records in SSM
+#
+# Each server is stored as one JSON document at {default_ssm_path}/record/{instance_id},
+# so a handler needs a single SSM call to read or write it. Servers created before the
+# document layout used one parameter per key at {default_ssm_path}/{key}/{instance_id};
+# those are still readable and are migrated to a document the first time they are read.
+import json
+import logging
+from typing import Any, List, Mapping, MutableMapping, Optional, Sequence, Tuple
+
+from .clients import get_client
+from .constants import (
+    const_key_instance_id,
+    const_key_nagios_stats,
+    const_key_record,
+    const_key_record_version,
+    const_key_stage_timing,
+    const_key_target_state,
+    const_key_warm_pool_claims,
+    const_key_status,
+    default_list_page_size,
+    default_ssm_path,
+    model_key_list,
+    record_version,
+    ssm_batch_size,
+)
+
+LOG = logging.getLogger(__name__)
+
+# subtrees of default_ssm_path swept by list_records, in order
+list_sweep_keys = [const_key_record, const_key_instance_id]
+
+
+class RecordNotFound(Exception):
+    pass
+
+
+def record_parameter_name(instance_id: str) -> str:
+    return f"{default_ssm_path}/{const_key_record}/{instance_id}"
+
+
+def legacy_parameter_name(instance_id: str, key: str) -> str:
+    return f"{default_ssm_path}/{key}/{instance_id}"
+
+
+def parse_record(value: str) -> MutableMapping[str, Any]:
+    record = json.loads(value)
+    record.pop(const_key_record_version, None)
+    return record
+
+
+def put_record(session, instance_id: str, record: Mapping[str, Any]) -> None:
+    _put_document(get_client(session, 'ssm'), instance_id, record)
+
+
+def get_record(session, instance_id: str) -> MutableMapping[str, Any]:
+    if not instance_id:
+        raise RecordNotFound(instance_id)
+
+    ssm_client = get_client(session, 'ssm')
+    ssm_response = ssm_client.get_parameters(Names=[record_parameter_name(instance_id)])
+    if ssm_response['Parameters']:
+        return parse_record(ssm_response['Parameters'][0]['Value'])
+
+    return _migrate_legacy_record(ssm_client, instance_id)
+
+
+def get_record_with_parameters(session, instance_id: str, names: Sequence[str]) -> Tuple[MutableMapping[str, Any], Mapping[str, str]]:
+    # the record and up to 9 other parameters of the server in one get_parameters call, with the
+    # values of those that exist by name
+    if not instance_id:
+        raise RecordNotFound(instance_id)
+
+    ssm_client = get_client(session, 'ssm')
+    record_name = record_parameter_name(instance_id)
+    ssm_response = ssm_client.get_parameters(Names=[record_name, *names])
+    values = {p['Name']: p['Value'] for p in ssm_response['Parameters']}
+    record = parse_record(values.pop(record_name)) if record_name in values else _migrate_legacy_record(ssm_client, instance_id)
+    return record, values
+
+
+def get_records(session, instance_ids: Sequence[str]) -> List[MutableMapping[str, Any]]:
+    # the document records of several servers, skipping any that don't have one
+    ssm_client = get_client(session, 'ssm')
+    names = [record_parameter_name(instance_id) for instance_id in instance_ids]
+    records = []
+    for start in range(0, len(names), ssm_batch_size):
+        ssm_response = ssm_client.get_parameters(Names=names[start:start + ssm_batch_size])
+        records.extend(parse_record(p['Value']) for p in ssm_response['Parameters'])
+    return records
+
+
+def delete_record(session, instance_id: str, member_ids: Sequence[str] = ()) -> None:
+    # the status, stage timing and nagios stats parameters are written by the instance itself, the warm pool
+    # claim by the create that took the instance from the pool, and the target sync state once a
+    # sync succeeds, so they are never part of the document; a fleet has all but the sync state for every member
+    ssm_client = get_client(session, 'ssm')
+    names = [record_parameter_name(instance_id)]
+    paths = [f"{default_ssm_path}/{const_key_target_state}/{instance_id}"]
+    for server_id in dict.fromkeys([instance_id, *member_ids]):
+        names.extend([legacy_parameter_name(server_id, key) for key in (const_key_status, const_key_warm_pool_claims, const_key_nagios_stats)])
+        paths.append(f"{default_ssm_path}/{const_key_stage_timing}/{server_id}")
+    for path in paths:
+        kwargs = {'Path': path, 'MaxResults': ssm_batch_size}
+        while True:
+            ssm_response = ssm_client.get_parameters_by_path(**kwargs)
+            names.extend(p['Name'] for p in ssm_response['Parameters'])
+            if not ssm_response.get('NextToken'):
+                break
+            kwargs['NextToken'] = ssm_response['NextToken']
+
+    for start in range(0, len(names), ssm_batch_size):
+        ssm_client.delete_parameters(Names=names[start:start + ssm_batch_size])
+
+
+def list_records(session, next_token: Optional[str] = None, page_size: int = default_list_page_size,
+                    region: Optional[str] = None) -> Tuple[List[MutableMapping[str, Any]], Optional[str]]:
+    # Sweeps the record subtree and then the legacy instance_id index, one SSM page at a time,
+    # and stops once page_size records are collected. The returned token is the position to resume
+    # from: the subtree being swept and the SSM NextToken within it. Legacy records are assembled
+    # in memory and are not migrated, so listing never writes to SSM. Without a region, it lists
+    # the session's region.
+    position = _decode_list_token(next_token)
+    ssm_token = position.get('token')
+    ssm_client = get_client(session, 'ssm', region)
+    records = []
+
+    sweep_start = list_sweep_keys.index(position['key'])
+    for index, key in enumerate(list_sweep_keys[sweep_start:], start=sweep_start):
+        while True:
+            kwargs = {'Path': f"{default_ssm_path}/{key}", 'Recursive': True, 'MaxResults': ssm_batch_size}
+            if ssm_token:
+                kwargs['NextToken'] = ssm_token
+            ssm_response = ssm_client.get_parameters_by_path(**kwargs)
+            parameters = ssm_response['Parameters']
+            if key == const_key_record:
+                records.extend(parse_record(p['Value']) for p in parameters)
+            else:
+                records.extend(_get_legacy_records(ssm_client, [legacy_value(p) for p in parameters]))
+
+            ssm_token = ssm_response.get('NextToken')
+            if not ssm_token:
+                break
+            if len(records) >= page_size:
+                return records, json.dumps({'key': key, 'token': ssm_token})
+
+        if len(records) >= page_size and index + 1 < len(list_sweep_keys):
+            return records, json.dumps({'key': list_sweep_keys[index + 1]})
+
+    return records, None
+
+
+def legacy_value(parameter: Mapping[str, Any]):
+    if parameter['Type'] == 'StringList':
+        return parameter['Value'].split(',')
+    return parameter['Value']
+
+
+def _migrate_legacy_record(ssm_client, instance_id: str) -> MutableMapping[str, Any]:
+    # model_key_list has 10 keys, which is the most get_parameters accepts in one call
+    names = {legacy_parameter_name(instance_id, key): key for key in model_key_list}
+    ssm_response = ssm_client.get_parameters(Names=list(names))
+    record = {names[p['Name']]: legacy_value(p) for p in ssm_response['Parameters']}
+    if const_key_instance_id not in record:
+        raise RecordNotFound(instance_id)
+
+    LOG.info(f"...Migrating legacy SSM parameters for {instance_id} to a single record")
+    record.pop(const_key_status, None)
+    _put_document(ssm_client, instance_id, record)
+    legacy_names = [name for name, key in names.items() if key != const_key_status]
+    ssm_client.delete_parameters(Names=legacy_names)
+
+    return record
+
+
+def _decode_list_token(next_token: Optional[str]) -> Mapping[str, Any]:
+    if not next_token:
+        return {'key': list_sweep_keys[0]}
+    position = json.loads(next_token)
+    if not isinstance(position, dict) or position.get('key') not in list_sweep_keys:
+        raise ValueError(f"unknown list position {next_token}")
+    return position
+
+
+def _get_legacy_records(ssm_client, instance_ids: List[str]) -> List[MutableMapping[str, Any]]:
+    names = {legacy_parameter_name(instance_id, key): (instance_id, key)
+                for instance_id in instance_ids for key in model_key_list if key != const_key_status}
+    name_list = list(names)
+    records = {instance_id: {} for instance_id in instance_ids}
+    for start in range(0, len(name_list), ssm_batch_size):
+        ssm_response = ssm_client.get_parameters(Names=name_list[start:start + ssm_batch_size])
+        for parameter in ssm_response['Parameters']:
+            instance_id, key = names[parameter['Name']]
+            records[instance_id][key] = legacy_value(parameter)
+
+    return [record for record in records.values() if const_key_instance_id in record]
+
+
+def _put_document(ssm_client, instance_id: str, record: Mapping[str, Any]) -> None:
+    # a fleet's record outgrows the 4 KB of a standard parameter; intelligent tiering stores those as
+    # advanced parameters, which hold 8 KB, and every other record as a standard one
+    document = dict(record)
+    document[const_key_instance_id] = instance_id
+    document[const_key_record_version] = record_version
+    ssm_client.put_parameter(Name=record_parameter_name(instance_id), Value=json.dumps(document, sort_keys=True),
+                                Type='String', Overwrite=True, Tier='Intelligent-Tiering')
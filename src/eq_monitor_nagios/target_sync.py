@@ -0,0 +1,327 @@
+# Nagios host config sync from EC2 tags
+#
+# Targets selects the instances a server monitors with tag filters. A sync discovers the running
+# instances that match, renders one config file per host (its host definition and services), and
+# compares each file's digest with the digests stored after the last successful sync, so only
+# new, changed and removed hosts are sent to the server. They go out through SSM Run Command as a
+# gzipped tarball, split over several commands when large, and each command checks the config and
+# reloads Nagios. Nothing is sent, and Nagios isn't reloaded, when nothing changed. The digests
+# are stored once the commands succeed, in {default_ssm_path}/target_state/{server_id}/{bucket},
+# hashed into buckets so a sync only rewrites the buckets holding hosts that changed. A server in a
+# shard group only syncs its share of the targets, see sharding.py.
+import base64
+import hashlib
+import io
+import json
+import logging
+import tarfile
+import zlib
+from typing import Any, Iterable, List, Mapping, MutableMapping, Sequence, Tuple
+
+from .clients import get_client
+from .constants import (
+    const_key_instance_id,
+    const_key_members,
+    const_key_target_state,
+    const_key_targets,
+    default_ssm_path,
+    default_sync_command_max_bytes,
+    default_sync_state_chunk_entries,
+    nagios_config_file,
+    nagios_target_config_dir,
+    ssm_batch_size,
+    ssm_parameter_max_chars,
+)
+from .sharding import shard_owner, shard_ring
+
+LOG = logging.getLogger(__name__)
+
+# services checked on every target host
+target_services = [
+    ('PING', 'check_ping!100.0,20%!500.0,60%'),
+]
+
+# describe_instances page size
+discovery_page_size = 1000
+
+# Run Command invocation states that are final
+sync_success_states = {'Success'}
+sync_failure_states = {'Cancelled', 'Cancelling', 'TimedOut', 'Failed'}
+
+
+def target_filters(targets: Sequence[Mapping[str, Any]]) -> List[Mapping[str, Any]]:
+    filters = [{'Name': f"tag:{target['Key']}", 'Values': list(target['Values'])} for target in targets]
+    return filters + [{'Name': 'instance-state-name', 'Values': ['running']}]
+
+
+def discover_targets(session, targets: Sequence[Mapping[str, Any]]) -> MutableMapping[str, Mapping[str, str]]:
+    # the name and private address of every running instance matching all the filters
+    ec2_client = get_client(session, 'ec2')
+    hosts = {}
+    pages = ec2_client.get_paginator('describe_instances').paginate(Filters=target_filters(targets),
+                                                                    PaginationConfig={'PageSize': discovery_page_size})
+    for page in pages:
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                if not instance.get('PrivateIpAddress'):
+                    continue
+                tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+                hosts[instance['InstanceId']] = {'name': tags.get('Name', instance['InstanceId']),
+                                                    'address': instance['PrivateIpAddress']}
+    return hosts
+
+
+def render_host_config(host_id: str, host: Mapping[str, str]) -> str:
+    lines = [
+        'define host {',
+        '    use                     linux-server',
+        f"    host_name               {host_id}",
+        f"    alias                   {host['name']}",
+        f"    address                 {host['address']}",
+        '}',
+    ]
+    for description, check_command in target_services:
+        lines.extend([
+            '',
+            'define service {',
+            '    use                     generic-service',
+            f"    host_name               {host_id}",
+            f"    service_description     {description}",
+            f"    check_command           {check_command}",
+            '}',
+        ])
+    return '\n'.join(lines) + '\n'
+
+
+def config_digest(config: str) -> str:
+    return hashlib.sha256(config.encode('utf-8')).hexdigest()[:16]
+
+
+def diff_configs(configs: Mapping[str, str], synced: Mapping[str, str]) -> Tuple[MutableMapping[str, str], List[str]]:
+    # the configs that are new or differ from the synced digests, and the hosts no longer targeted
+    changed = {host_id: config for host_id, config in configs.items() if synced.get(host_id) != config_digest(config)}
+    removed = sorted(host_id for host_id in synced if host_id not in configs)
+    return changed, removed
+
+
+def sync_scripts(changed: Mapping[str, str], removed: Sequence[str]) -> List[List[str]]:
+    # shell commands for AWS-RunShellScript, one list per Run Command, each one complete on its own
+    # so the commands can run in any order
+    scripts = []
+    for tarball in _tarballs(sorted(changed.items())):
+        scripts.append([f"echo {tarball} | base64 -d | tar xz -C {nagios_target_config_dir}"])
+    removes = [f"rm -f {nagios_target_config_dir}/{host_id}.cfg" for host_id in removed]
+    remove_lines = max(1, default_sync_command_max_bytes // 64)
+    for start in range(0, len(removes), remove_lines):
+        scripts.append(removes[start:start + remove_lines])
+
+    prologue = [
+        'set -e',
+        'exec 9>/var/lock/eq-nagios-target-sync',
+        'flock 9',
+        f"mkdir -p {nagios_target_config_dir}",
+        f"grep -qx 'cfg_dir={nagios_target_config_dir}' {nagios_config_file} || echo 'cfg_dir={nagios_target_config_dir}' >> {nagios_config_file}",
+    ]
+    epilogue = [
+        f"/usr/local/nagios/bin/nagios -v {nagios_config_file}",
+        'systemctl reload nagios.service',
+    ]
+    return [prologue + script + epilogue for script in scripts]
+
+
+def start_target_sync(session, server_id: str, instance_ids: Sequence[str], targets: Sequence[Mapping[str, Any]],
+                        group_members: Sequence[str] = (), discovered: MutableMapping[str, Any] = None) -> MutableMapping[str, Any]:
+    # Sends the changes to every server of the resource. Returns the pending sync to check on and
+    # commit; it has no commands when nothing changed. Without targets, every synced host is removed.
+    # In a shard group, the server only gets the hosts the group's hash ring assigns to it.
+    # discovered caches the hosts found for each set of targets, for syncing several servers.
+    discovered = {} if discovered is None else discovered
+    hosts = {}
+    if targets:
+        key = json.dumps(targets, sort_keys=True)
+        if key not in discovered:
+            discovered[key] = discover_targets(session, targets)
+        hosts = discovered[key]
+    if group_members:
+        ring = shard_ring(group_members)
+        hosts = {host_id: host for host_id, host in hosts.items() if shard_owner(ring, host_id) == server_id}
+    synced, buckets = load_sync_state(session, server_id)
+    configs = {host_id: render_host_config(host_id, host) for host_id, host in hosts.items()}
+    changed, removed = diff_configs(configs, synced)
+    LOG.info(f"...{len(hosts)} target hosts for {server_id}, {len(changed)} new or changed and {len(removed)} removed since the last sync")
+
+    commands = []
+    if changed or removed:
+        ssm_client = get_client(session, 'ssm')
+        for script in sync_scripts(changed, removed):
+            ssm_response = ssm_client.send_command(InstanceIds=list(instance_ids), DocumentName='AWS-RunShellScript',
+                                                    Parameters={'commands': script}, Comment=f"Nagios target sync for {server_id}")
+            commands.append(ssm_response['Command']['CommandId'])
+
+    return {
+        'server': server_id,
+        'commands': commands,
+        'changed': {host_id: config_digest(config) for host_id, config in changed.items()},
+        'removed': removed,
+        'hosts': len(configs),
+        'buckets': buckets,
+    }
+
+
+def start_target_syncs(session, records: Sequence[Mapping[str, Any]], group_members: Sequence[str] = ()) -> List[MutableMapping[str, Any]]:
+    # one sync for each server record, all of them sent before any is checked; servers with the
+    # same targets share one discovery
+    syncs = []
+    discovered = {}
+    for record in records:
+        instance_ids = [member[const_key_instance_id] for member in record.get(const_key_members) or []] or [record[const_key_instance_id]]
+        syncs.append(start_target_sync(session, record[const_key_instance_id], instance_ids, record.get(const_key_targets),
+                                        group_members, discovered))
+    return syncs
+
+
+def check_target_sync(session, sync: Mapping[str, Any]) -> Tuple[bool, List[str]]:
+    # Returns whether every command has finished, and the failed invocations
+    ssm_client = get_client(session, 'ssm')
+    finished = True
+    failures = []
+    for command_id in sync['commands']:
+        invocations = ssm_client.list_command_invocations(CommandId=command_id)['CommandInvocations']
+        if not invocations:
+            finished = False
+        for invocation in invocations:
+            if invocation['Status'] in sync_failure_states:
+                failures.append(f"{invocation['InstanceId']} {invocation['Status']} ({command_id})")
+            elif invocation['Status'] not in sync_success_states:
+                finished = False
+    return finished or bool(failures), failures
+
+
+def check_target_syncs(session, syncs: Sequence[Mapping[str, Any]]) -> Tuple[List[Mapping[str, Any]], List[str]]:
+    # Commits every sync that finished, and returns the ones still running and the failures
+    running = []
+    failures = []
+    for sync in syncs:
+        finished, sync_failures = check_target_sync(session, sync) if sync['commands'] else (True, [])
+        if sync_failures:
+            failures.extend(sync_failures)
+        elif finished:
+            commit_target_sync(session, sync)
+        else:
+            running.append(sync)
+    return running, failures
+
+
+def commit_target_sync(session, sync: Mapping[str, Any]) -> None:
+    # Stores the digests of a sync whose commands all succeeded. While the number of buckets stays
+    # the same, only the buckets holding changed or removed hosts are read and written. A bucket
+    # that would still outgrow its parameter (rare, see default_sync_state_chunk_entries) has every
+    # host spread over twice as many buckets instead.
+    if not sync['changed'] and not sync['removed']:
+        return
+    ssm_client = get_client(session, 'ssm')
+    bucket_count = sync_bucket_count(sync['hosts'])
+    complete = bucket_count != sync['buckets']
+    if not complete:
+        touched = sorted({sync_bucket(host_id, bucket_count) for host_id in [*sync['changed'], *sync['removed']]})
+        synced = {}
+        names = [sync_state_parameter_name(sync['server'], bucket) for bucket in touched]
+        for start in range(0, len(names), ssm_batch_size):
+            ssm_response = ssm_client.get_parameters(Names=names[start:start + ssm_batch_size])
+            for parameter in ssm_response['Parameters']:
+                synced.update(json.loads(parameter['Value']))
+    else:
+        touched = range(bucket_count)
+        synced, _ = load_sync_state(session, sync['server'])
+    _apply_sync(synced, sync)
+
+    values = _bucket_values(synced, bucket_count, touched)
+    while any(len(value) > ssm_parameter_max_chars for value in values.values()):
+        if not complete:
+            synced, _ = load_sync_state(session, sync['server'])
+            _apply_sync(synced, sync)
+            complete = True
+        bucket_count *= 2
+        LOG.info(f"...Target state of {sync['server']} outgrew a parameter, spreading it over {bucket_count}")
+        values = _bucket_values(synced, bucket_count, range(bucket_count))
+    for bucket, value in values.items():
+        ssm_client.put_parameter(Name=sync_state_parameter_name(sync['server'], bucket), Value=value,
+                                    Type='String', Overwrite=True)
+    stale = [sync_state_parameter_name(sync['server'], bucket) for bucket in range(bucket_count, sync['buckets'])]
+    for start in range(0, len(stale), ssm_batch_size):
+        ssm_client.delete_parameters(Names=stale[start:start + ssm_batch_size])
+
+
+def load_sync_state(session, server_id: str) -> Tuple[MutableMapping[str, str], int]:
+    # the digest of every synced host, and how many buckets hold them
+    ssm_client = get_client(session, 'ssm')
+    synced = {}
+    buckets = 0
+    kwargs = {'Path': sync_state_path(server_id), 'MaxResults': ssm_batch_size}
+    while True:
+        ssm_response = ssm_client.get_parameters_by_path(**kwargs)
+        for parameter in ssm_response['Parameters']:
+            synced.update(json.loads(parameter['Value']))
+            buckets += 1
+        if not ssm_response.get('NextToken'):
+            break
+        kwargs['NextToken'] = ssm_response['NextToken']
+    return synced, buckets
+
+
+def sync_state_path(server_id: str) -> str:
+    return f"{default_ssm_path}/{const_key_target_state}/{server_id}"
+
+
+def sync_state_parameter_name(server_id: str, bucket: int) -> str:
+    return f"{sync_state_path(server_id)}/{bucket:04d}"
+
+
+def sync_bucket_count(hosts: int) -> int:
+    # a power of two, so the count only changes when the number of hosts doubles or halves
+    count = 1
+    while count * default_sync_state_chunk_entries < hosts:
+        count *= 2
+    return count
+
+
+def sync_bucket(host_id: str, bucket_count: int) -> int:
+    return zlib.crc32(host_id.encode('utf-8')) % bucket_count
+
+
+def _tarball(configs: Iterable[Tuple[str, str]]) -> str:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        for host_id, config in configs:
+            data = config.encode('utf-8')
+            info = tarfile.TarInfo(f"{host_id}.cfg")
+            info.size = len(data)
+            info.mode = 0o644
+            tar.addfile(info, io.BytesIO(data))
+    return base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def _tarballs(configs: List[Tuple[str, str]]) -> List[str]:
+    # halves a batch until its tarball fits in one command
+    if not configs:
+        return []
+    tarball = _tarball(configs)
+    if len(configs) == 1 or len(tarball) <= default_sync_command_max_bytes:
+        return [tarball]
+    middle = len(configs) // 2
+    return _tarballs(configs[:middle]) + _tarballs(configs[middle:])
+
+
+def _apply_sync(synced: MutableMapping[str, str], sync: Mapping[str, Any]) -> None:
+    synced.update(sync['changed'])
+    for host_id in sync['removed']:
+        synced.pop(host_id, None)
+
+
+def _bucket_values(synced: Mapping[str, str], bucket_count: int, buckets: Iterable[int]) -> MutableMapping[int, str]:
+    entries = {bucket: {} for bucket in buckets}
+    for host_id, digest in synced.items():
+        bucket = sync_bucket(host_id, bucket_count)
+        if bucket in entries:
+            entries[bucket][host_id] = digest
+    return {bucket: json.dumps(bucket_entries, sort_keys=True) for bucket, bucket_entries in entries.items()}
@@ -0,0 +1,144 @@
+# Server teardown
+#
+# Deleting a server is a set of independent EC2 and IAM calls with a few ordering constraints:
+# an instance profile can only be deleted once its role is removed, a policy once it is detached,
+# and a role once it is out of the profile and has no policies. run_teardown runs every step whose
+# prerequisites are done concurrently on a small thread pool, and keeps going wave by wave until
+# nothing else can run. Steps that are already done (from an earlier invocation) are skipped, and
+# a missing resource counts as done, so a delete can be re-run until it succeeds.
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Mapping, MutableMapping, NamedTuple, Sequence, Set
+
+from botocore.exceptions import ClientError
+
+from .clients import get_client
+from .constants import (
+    const_key_instance_id,
+    const_key_instance_profile,
+    const_key_members,
+    const_key_policy_arn,
+    const_key_role,
+    default_teardown_workers,
+    ssm_managed_instance_policy_arn,
+)
+from .metrics import throttle_error_codes
+
+LOG = logging.getLogger(__name__)
+
+# error codes meaning the thing being removed is already gone
+teardown_gone_error_codes = ['NoSuchEntity', 'InvalidInstanceID.NotFound']
+
+# reason given for a step that could not run because a prerequisite failed
+teardown_blocked_prefix = 'blocked by '
+
+
+class TeardownStep(NamedTuple):
+    name: str
+    call: Callable[[], Any]
+    depends_on: Sequence[str] = ()
+
+
+def teardown_steps(session, record: Mapping[str, Any]) -> List[TeardownStep]:
+    ec2_client = get_client(session, 'ec2')
+    iam_client = get_client(session, 'iam')
+    instance_id = record.get(const_key_instance_id)
+    # a fleet terminates all of its servers that still exist in one call
+    instance_ids = [member[const_key_instance_id] for member in record.get(const_key_members) or []] or [instance_id]
+    role = record.get(const_key_role)
+    instance_profile = record.get(const_key_instance_profile)
+    policy_arn = record.get(const_key_policy_arn)
+
+    steps = []
+    if instance_id:
+        steps.append(TeardownStep('terminate_instance', lambda: _terminate_live(ec2_client, instance_ids)))
+    if role and instance_profile:
+        steps.append(TeardownStep('remove_role_from_instance_profile',
+                                    lambda: iam_client.remove_role_from_instance_profile(InstanceProfileName=instance_profile, RoleName=role)))
+    if instance_profile:
+        steps.append(TeardownStep('delete_instance_profile',
+                                    lambda: iam_client.delete_instance_profile(InstanceProfileName=instance_profile),
+                                    ['remove_role_from_instance_profile'] if role else []))
+    if role and policy_arn:
+        steps.append(TeardownStep('detach_policy', lambda: iam_client.detach_role_policy(RoleName=role, PolicyArn=policy_arn)))
+    if policy_arn:
+        steps.append(TeardownStep('delete_policy', lambda: iam_client.delete_policy(PolicyArn=policy_arn),
+                                    ['detach_policy'] if role else []))
+    if role:
+        steps.append(TeardownStep('detach_ssm_policy',
+                                    lambda: iam_client.detach_role_policy(RoleName=role, PolicyArn=ssm_managed_instance_policy_arn)))
+        role_prerequisites = [step.name for step in steps
+                                if step.name in ('remove_role_from_instance_profile', 'detach_policy', 'detach_ssm_policy')]
+        steps.append(TeardownStep('delete_role', lambda: iam_client.delete_role(RoleName=role), role_prerequisites))
+
+    return steps
+
+
+def run_teardown(steps: Sequence[TeardownStep], done: Set[str]) -> MutableMapping[str, str]:
+    # Runs the steps that are not done yet, adding each one that succeeds to done.
+    # Returns the reason for every step that failed or could not run because a prerequisite failed.
+    failures = {}
+    with ThreadPoolExecutor(max_workers=default_teardown_workers) as executor:
+        while True:
+            ready = [step for step in steps if step.name not in done and step.name not in failures
+                        and all(name in done for name in step.depends_on)]
+            if not ready:
+                break
+            futures = {step.name: executor.submit(_run_step, step) for step in ready}
+            for name, future in futures.items():
+                error = future.result()
+                if error is None:
+                    done.add(name)
+                else:
+                    failures[name] = error
+
+    for step in steps:
+        if step.name not in done and step.name not in failures:
+            blocked_by = [name for name in step.depends_on if name not in done]
+            failures[step.name] = f"{teardown_blocked_prefix}{', '.join(blocked_by)}"
+
+    return failures
+
+
+def throttled_only(failures: Mapping[str, str]) -> bool:
+    # steps that were throttled, or blocked behind one that was, only need another try later
+    codes = [reason.split(':')[0] for reason in failures.values() if not reason.startswith(teardown_blocked_prefix)]
+    return bool(codes) and all(code in throttle_error_codes for code in codes)
+
+
+def instance_terminated(session, instance_ids: Sequence[str]) -> bool:
+    return not live_instance_ids(get_client(session, 'ec2'), instance_ids)
+
+
+def live_instance_ids(ec2_client, instance_ids: Sequence[str]) -> List[str]:
+    # The instances that exist and are not terminated. EC2 rejects a whole describe_instances call
+    # when one of its InstanceIds is unknown, such as a member purged after it was terminated by
+    # hand, so they are matched with a filter instead, which leaves the unknown ones out.
+    paginator = ec2_client.get_paginator('describe_instances')
+    pages = paginator.paginate(Filters=[{'Name': 'instance-id', 'Values': list(instance_ids)}])
+    return [instance['InstanceId'] for page in pages for reservation in page['Reservations']
+            for instance in reservation['Instances'] if instance['State']['Name'] != 'terminated']
+
+
+def _terminate_live(ec2_client, instance_ids: Sequence[str]) -> None:
+    # terminate_instances fails the same way on an unknown id
+    live = live_instance_ids(ec2_client, instance_ids)
+    if live:
+        ec2_client.terminate_instances(InstanceIds=live)
+
+
+def _run_step(step: TeardownStep):
+    try:
+        step.call()
+        LOG.info(f"...Teardown step {step.name} done")
+    except ClientError as err:
+        code = err.response['Error']['Code']
+        if code in teardown_gone_error_codes:
+            LOG.info(f"...Teardown step {step.name} found nothing to remove")
+            return None
+        LOG.info(f"...Teardown step {step.name} failed: {code}")
+        return f"{code}: {err.response['Error'].get('Message', '')}"
+    except Exception as err:
+        LOG.info(f"...Teardown step {step.name} failed: {type(err).__name__}")
+        return f"{type(err).__name__}: {str(err)}"
+    return None
@@ -0,0 +1,300 @@
+# User data builder
+#
+# The user data script is composed from named stages that declare which stages they depend on.
+# plan_stages turns them into a fixed schedule of start and wait steps, so a stage is started in
+# the background as soon as the stages it needs have finished, and independent stages overlap
+# (the downloads run while yum is busy, the plugins compile while Nagios core builds).
+# render_user_data turns the schedule into the bash script. Each stage reports its start and end
+# time to {default_ssm_path}/stage_timing/{instance_id}/{stage}, and stages on the critical path
+# set the status milestone that create polls on. The timings are only informational, so a write
+# that still fails after the CLI's retries doesn't trip the ERR trap and fail the server.
+import base64
+import gzip
+import os
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Tuple
+
+from .constants import (
+    const_key_stage_timing,
+    const_key_status,
+    default_instance_cli_max_attempts,
+    default_nagios_version,
+    default_plugins_version,
+    default_perfdata_namespace,
+    default_perfdata_rotate_seconds,
+    default_ssm_path,
+    default_stats_interval_minutes,
+    nagios_config_file,
+    nagios_perfdata_file,
+    nagios_ramdisk_dir,
+    nagios_ramdisk_size,
+)
+from .performance import Profile, nagios_stats_fields, nagios_stats_parameter_name
+
+nagios_stats_script = '/usr/local/bin/nagios-stats'
+nagios_check_workers_script = '/usr/local/bin/nagios-check-workers'
+nagios_service_dropin = '/etc/systemd/system/nagios.service.d/ramdisk.conf'
+perfdata_exporter_source = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'perfdata_exporter.py')
+perfdata_exporter_script = '/usr/local/bin/nagios-perfdata-exporter'
+perfdata_exporter_unit = '/etc/systemd/system/nagios-perfdata-exporter.service'
+perfdata_command_file = '/usr/local/nagios/etc/objects/eq_perfdata.cfg'
+
+# nagios.cfg settings that write one tab separated line per service check for the exporter, and
+# move the file aside with the command in perfdata_command_file
+perfdata_nagios_cfg = {
+    'process_performance_data': '1',
+    'service_perfdata_file': nagios_perfdata_file,
+    'service_perfdata_file_template': '$TIMET$\\t$HOSTNAME$\\t$SERVICEDESC$\\t$SERVICELATENCY$\\t$SERVICEEXECUTIONTIME$\\t$SERVICEPERFDATA$',
+    'service_perfdata_file_mode': 'a',
+    'service_perfdata_file_processing_interval': str(default_perfdata_rotate_seconds),
+    'service_perfdata_file_processing_command': 'eq-rotate-perfdata',
+}
+
+stage_step_start = 'start'
+stage_step_wait = 'wait'
+
+
+@dataclass
+class Stage:
+    name: str
+    commands: List[str]
+    depends_on: Sequence[str] = field(default_factory=list)
+    status: Optional[str] = None
+
+
+def plan_stages(stages: Sequence[Stage]) -> List[Tuple[str, str]]:
+    # Orders the stages so every stage comes after its dependencies, keeping the given order
+    # otherwise, and waits for each dependency only once, right before it is first needed.
+    by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        unknown = [name for name in stage.depends_on if name not in by_name]
+        if unknown:
+            raise ValueError(f"stage {stage.name} depends on unknown stages {unknown}")
+
+    plan = []
+    started = set()
+    waited = set()
+    while len(started) < len(stages):
+        ready = [stage for stage in stages
+                    if stage.name not in started and all(name in started for name in stage.depends_on)]
+        if not ready:
+            raise ValueError(f"stage dependencies have a cycle among {sorted(set(by_name) - started)}")
+        stage = ready[0]
+        for name in stage.depends_on:
+            if name not in waited:
+                plan.append((stage_step_wait, name))
+                waited.add(name)
+        plan.append((stage_step_start, stage.name))
+        started.add(stage.name)
+
+    for stage in stages:
+        if stage.name not in waited:
+            plan.append((stage_step_wait, stage.name))
+
+    return plan
+
+
+def render_user_data(stages: Sequence[Stage], after_done: Sequence[str] = ()) -> str:
+    lines = [
+        '#!/bin/bash -xeE',
+        'region=$(curl -k http://169.254.169.254/latest/meta-data/placement/region)',
+        'instance_id=$(curl -k http://169.254.169.254/latest/meta-data/instance-id)',
+        'jobs=$(nproc)',
+        'export AWS_RETRY_MODE=adaptive',
+        f'export AWS_MAX_ATTEMPTS={default_instance_cli_max_attempts}',
+        '',
+        'put_status() {',
+        f'  aws ssm put-parameter --name {default_ssm_path}/{const_key_status}/$instance_id --region $region --type String --value $1 --overwrite',
+        '}',
+        'put_timing() {',
+        f'  aws ssm put-parameter --name {default_ssm_path}/{const_key_stage_timing}/$instance_id/$1 --region $region --type String --value $2,$3 --overwrite || true',
+        '}',
+        'run_stage() {',
+        '  local start=$(date +%s)',
+        '  stage_$1',
+        '  put_timing $1 $start $(date +%s)',
+        '}',
+        "trap 'put_status Failed' ERR",
+        '',
+    ]
+    for stage in stages:
+        lines.append(f'stage_{stage.name}() {{')
+        if stage.status:
+            lines.append(f'  put_status {stage.status}')
+        lines.extend(f'  {command}' for command in stage.commands)
+        lines.append('}')
+        lines.append('')
+
+    lines.append('put_status Starting')
+    for step, name in plan_stages(stages):
+        if step == stage_step_start:
+            lines.append(f'run_stage {name} &')
+            lines.append(f'pid_{name}=$!')
+        else:
+            lines.append(f'wait $pid_{name}')
+    lines.append('put_status Done')
+    lines.extend(after_done)
+
+    return '\n'.join(lines) + '\n'
+
+
+def nagios_build_stages(profile: Profile, metrics_export: bool = False) -> List[Stage]:
+    nagios_dir = f"/tmp/nagioscore-nagios-{default_nagios_version}"
+    plugins_dir = f"/tmp/nagios-plugins-release-{default_plugins_version}"
+    return [
+        Stage('yum_core', status='StartingYumUpdates', commands=[
+            'yum install -y gcc glibc glibc-common wget unzip httpd php gd gd-devel perl postfix make',
+        ]),
+        Stage('download_nagios', commands=[
+            'cd /tmp',
+            f'curl -sSL -o nagioscore.tar.gz https://github.com/NagiosEnterprises/nagioscore/archive/nagios-{default_nagios_version}.tar.gz',
+            'tar xzf nagioscore.tar.gz',
+        ]),
+        Stage('download_plugins', commands=[
+            'cd /tmp',
+            f'curl -sSkL -o nagios-plugins.tar.gz https://github.com/nagios-plugins/nagios-plugins/archive/release-{default_plugins_version}.tar.gz',
+            'tar zxf nagios-plugins.tar.gz',
+        ]),
+        # yum holds a lock, so the plugin dependencies wait for the core packages
+        Stage('yum_plugins', depends_on=['yum_core'], commands=[
+            'cd /tmp',
+            'curl -sSL -o epel-release-latest-7.noarch.rpm https://dl.fedoraproject.org/pub/epel/epel-release-latest-7.noarch.rpm',
+            'rpm -ihv epel-release-latest-7.noarch.rpm',
+            'yum install -y gettext automake autoconf openssl-devel net-snmp net-snmp-utils perl-Net-SNMP',
+        ]),
+        Stage('build_nagios', depends_on=['yum_core', 'download_nagios'], status='DeployingNagios', commands=[
+            f'cd {nagios_dir}',
+            './configure',
+            'make -j$jobs all',
+            'make install-groups-users',
+            'usermod -a -G nagios apache',
+            'make install',
+            'make install-daemoninit',
+            'chkconfig --level 2345 httpd on',
+            'systemctl enable httpd.service',
+            'make install-commandmode',
+            'make install-config',
+            'make install-webconf',
+            'htpasswd -c -b /usr/local/nagios/etc/htpasswd.users nagiosadmin nagiosadmin',
+        ]),
+        Stage('compile_plugins', depends_on=['yum_plugins', 'download_plugins'], commands=[
+            f'cd {plugins_dir}',
+            './tools/setup',
+            './configure',
+            'make -j$jobs',
+        ]),
+        # installing the plugins needs the nagios user created by the core install
+        Stage('install_plugins', depends_on=['compile_plugins', 'build_nagios'], status='DeployingPlugins', commands=[
+            f'cd {plugins_dir}',
+            'make install',
+        ]),
+        tune_nagios_stage(profile, metrics_export, depends_on=['build_nagios']),
+        publish_stats_stage(),
+        # the exporter may need python3 from yum, which holds a lock
+        *([export_metrics_stage(depends_on=['tune_nagios', 'yum_plugins'])] if metrics_export else []),
+        start_services_stage(metrics_export, depends_on=['install_plugins', 'tune_nagios']),
+    ]
+
+
+def nagios_cached_stages(profile: Profile, metrics_export: bool = False) -> List[Stage]:
+    # Nagios is already installed on a cached image, it only needs its tuning and services started
+    return [
+        tune_nagios_stage(profile, metrics_export),
+        publish_stats_stage(),
+        *([export_metrics_stage(depends_on=['tune_nagios'])] if metrics_export else []),
+        start_services_stage(metrics_export, depends_on=['tune_nagios']),
+    ]
+
+
+def start_services_stage(metrics_export: bool, depends_on: Sequence[str]) -> Stage:
+    commands = [
+        'systemctl restart httpd.service',
+        'systemctl restart nagios.service',
+    ]
+    if metrics_export:
+        commands.append('systemctl restart nagios-perfdata-exporter.service')
+    return Stage('start_services', depends_on=[*depends_on, *(['export_metrics'] if metrics_export else [])],
+                    status='StartingServices', commands=commands)
+
+
+def tune_nagios_stage(profile: Profile, metrics_export: bool = False, depends_on: Sequence[str] = ()) -> Stage:
+    # Starts over from the stock nagios.cfg, kept the first time this runs, so a server built from an
+    # image baked with another profile or with the exporter ends up with this one's settings only.
+    # Nagios may already be running from such an image, holding files on the tmpfs.
+    commands = [
+        'systemctl stop nagios.service',
+        'systemctl disable --now nagios-perfdata-exporter.service 2>/dev/null || true',
+        f'[ -f {nagios_config_file}.stock ] || cp {nagios_config_file} {nagios_config_file}.stock',
+        f'cp {nagios_config_file}.stock {nagios_config_file}',
+        f"sed -i '\\#{nagios_ramdisk_dir}#d' /etc/fstab",
+        f'rm -f {nagios_service_dropin}',
+        f'if mountpoint -q {nagios_ramdisk_dir}; then umount {nagios_ramdisk_dir}; fi',
+    ]
+    if profile.nagios_cfg:
+        deletes = ' '.join(f"-e '/^{key}=/d'" for key in profile.nagios_cfg)
+        commands.append(f'sed -i {deletes} {nagios_config_file}')
+        commands.extend(f'echo "{key}={value}" >> {nagios_config_file}' for key, value in profile.nagios_cfg.items())
+    service_pre = []
+    if profile.ramdisk:
+        # tmpfs is empty after every boot, so the service recreates the check result spool before Nagios starts
+        commands.extend([
+            f'mkdir -p {nagios_ramdisk_dir}',
+            f"echo 'tmpfs {nagios_ramdisk_dir} tmpfs size={nagios_ramdisk_size},mode=0775 0 0' >> /etc/fstab",
+            f'mount {nagios_ramdisk_dir}',
+            f'mkdir -p {nagios_ramdisk_dir}/checkresults',
+            f'chown -R nagios:nagios {nagios_ramdisk_dir}',
+        ])
+        service_pre.extend([f'/bin/mkdir -p {nagios_ramdisk_dir}/checkresults', f'/bin/chown -R nagios:nagios {nagios_ramdisk_dir}'])
+    if profile.check_worker_per_vcpu:
+        # a server resized to another instance type gets its new vCPU count the next time Nagios starts
+        commands.extend([
+            f"printf '%s\\n' '#!/bin/sh' 'sed -i /^check_workers=/d {nagios_config_file}' "
+            f"'echo check_workers=$(nproc) >> {nagios_config_file}' > {nagios_check_workers_script}",
+            f'chmod 755 {nagios_check_workers_script}',
+        ])
+        service_pre.append(nagios_check_workers_script)
+    if service_pre:
+        settings = ' '.join(f"'ExecStartPre={command}'" for command in service_pre)
+        commands.extend([
+            f'mkdir -p {nagios_service_dropin.rsplit("/", 1)[0]}',
+            f"printf '%s\\n' '[Service]' {settings} > {nagios_service_dropin}",
+        ])
+    if metrics_export:
+        deletes = ' '.join(f"-e '/^{key}=/d'" for key in perfdata_nagios_cfg)
+        settings = ' '.join(f"'{key}={value}'" for key, value in perfdata_nagios_cfg.items())
+        commands.extend([
+            f'sed -i {deletes} {nagios_config_file}',
+            f"printf '%s\\n' {settings} 'cfg_file={perfdata_command_file}' >> {nagios_config_file}",
+            f"printf '%s\\n' 'define command {{' '    command_name eq-rotate-perfdata' "
+            f"'    command_line /bin/mv -f {nagios_perfdata_file} {nagios_perfdata_file}.rotated' '}}' > {perfdata_command_file}",
+        ])
+    commands.append('systemctl daemon-reload')
+    return Stage('tune_nagios', depends_on=list(depends_on), commands=commands)
+
+
+def export_metrics_stage(depends_on: Sequence[str]) -> Stage:
+    # the exporter ships inside the user data, gzipped; see perfdata_exporter.py
+    with open(perfdata_exporter_source, 'rb') as source:
+        script = base64.b64encode(gzip.compress(source.read(), mtime=0)).decode('ascii')
+    return Stage('export_metrics', depends_on=list(depends_on), commands=[
+        'command -v python3 || yum install -y python3',
+        f'echo {script} | base64 -d | gunzip > {perfdata_exporter_script}',
+        f'chmod 755 {perfdata_exporter_script}',
+        f"printf '%s\\n' '[Unit]' 'Description=Nagios perfdata exporter' 'After=nagios.service' '[Service]' "
+        f'"ExecStart=/usr/bin/python3 {perfdata_exporter_script} --file {nagios_perfdata_file} --namespace {default_perfdata_namespace} --region $region" '
+        f"'Restart=always' '[Install]' 'WantedBy=multi-user.target' > {perfdata_exporter_unit}",
+        'systemctl daemon-reload',
+        'systemctl enable nagios-perfdata-exporter.service',
+    ])
+
+
+def publish_stats_stage() -> Stage:
+    # a cron job publishing nagiostats to SSM; the region and instance id are filled in now, the rest when it runs
+    variables = ','.join(variable for _, variable in nagios_stats_fields)
+    return Stage('publish_stats', commands=[
+        f"printf '%s\\n' '#!/bin/bash' 'export AWS_RETRY_MODE=adaptive AWS_MAX_ATTEMPTS={default_instance_cli_max_attempts}' 'stats=$(/usr/local/nagios/bin/nagiostats --mrtg --data={variables} | paste -sd, -)' "
+        f'"aws ssm put-parameter --region $region --name {nagios_stats_parameter_name("$instance_id")} --type String --overwrite --value \\"\\$(date +%s),\\$stats\\"" '
+        f'> {nagios_stats_script}',
+        f'chmod 755 {nagios_stats_script}',
+        f"echo '*/{default_stats_interval_minutes} * * * * root {nagios_stats_script}' > /etc/cron.d/nagios-stats",
+    ])
@@ -0,0 +1,148 @@
+# Warm pool of stopped Nagios servers
+#
+# With WarmPoolSize set, each subnet, security group and performance profile keeps that many fully
+# built servers stopped and ready, in separate pools for servers with and without MetricsExport. They are ordinary instances tagged with the pool they belong to, launched
+# with user data that stops the instance once Nagios is installed. Create claims one by taking an
+# SSM claim parameter for it (put_parameter without overwrite, so only one create can win), then
+# retags it like update_handler does for Name and starts it, which takes seconds; a member built
+# for another instance type is resized while it is still stopped. Taking and starting are separate
+# so create can checkpoint the claimed instance in between, and start it again if starting failed. Refilling only
+# calls run_instances; the new members build themselves in the background and stop when done.
+# Pool members use the shared role, and the pool holds its own reference to it. Each server created
+# with a pool registers as one of its users, and the last one to be deleted terminates the remaining
+# members and releases the pool's reference along with its own.
+import logging
+from typing import Any, List, Mapping, Optional, Sequence, Tuple
+
+from botocore.exceptions import ClientError
+
+from .clients import get_client
+from .constants import (
+    const_key_warm_pool_claims,
+    const_key_warm_pool_users,
+    const_tag_warm_pool,
+    const_tag_warm_pool_claim,
+    default_performance_profile,
+    default_ssm_path,
+    default_warm_pool_name,
+)
+from .shared_role import register_shared_role_member
+
+LOG = logging.getLogger(__name__)
+
+# states of instances that are, or will become, ready pool members
+warm_pool_live_states = ['pending', 'running', 'stopping', 'stopped']
+
+
+def warm_pool_key(subnet_id: str, sg_id: str, profile: Optional[str] = None, metrics_export: bool = False) -> str:
+    # pools of the default profile without the exporter keep the key they had before either existed
+    key = f"{subnet_id}/{sg_id}"
+    if profile and profile != default_performance_profile:
+        key = f"{key}/{profile}"
+    if metrics_export:
+        key = f"{key}/metrics"
+    return key
+
+
+def warm_pool_member_id(pool_key: str) -> str:
+    # the pool's reference to the shared role; a default pool keeps the one it had before profiles
+    return f"warm_pool_{pool_key.replace('/', '_')}"
+
+
+def warm_pool_users_path(pool_key: str) -> str:
+    return f"{default_ssm_path}/{const_key_warm_pool_users}/{pool_key.replace('/', '_')}"
+
+
+def register_warm_pool_user(session, pool_key: str, user_id: str) -> None:
+    ssm_client = get_client(session, 'ssm')
+    ssm_client.put_parameter(Name=f"{warm_pool_users_path(pool_key)}/{user_id}", Value=user_id, Type='String', Overwrite=True)
+
+
+def release_warm_pool_user(session, pool_key: str, user_id: str) -> Optional[List[str]]:
+    # Drops this server's use of the pool. Returns None while other servers still use it, otherwise
+    # the members left in the pool, for the delete to terminate. Calling it again gives the same answer.
+    ssm_client = get_client(session, 'ssm')
+    try:
+        ssm_client.delete_parameter(Name=f"{warm_pool_users_path(pool_key)}/{user_id}")
+    except ClientError as err:
+        if err.response['Error']['Code'] != 'ParameterNotFound':
+            raise
+
+    ssm_response = ssm_client.get_parameters_by_path(Path=warm_pool_users_path(pool_key), MaxResults=1)
+    if ssm_response['Parameters']:
+        LOG.info(f"...Warm pool {pool_key} still in use by other servers")
+        return None
+    members = _pool_members(get_client(session, 'ec2'), pool_key, warm_pool_live_states)
+    LOG.info(f"...Last server using warm pool {pool_key}, draining its {len(members)} instances")
+    return [instance['InstanceId'] for instance in members]
+
+
+def warm_pool_claim_name(instance_id: str) -> str:
+    return f"{default_ssm_path}/{const_key_warm_pool_claims}/{instance_id}"
+
+
+def take_pool_instance(session, subnet_id: str, sg_id: str, profile: Optional[str], claim_id: str,
+                        metrics_export: bool = False) -> Optional[Tuple[str, str]]:
+    # Returns the id and instance type of the pool member this create now owns, or None when the pool is empty
+    ec2_client = get_client(session, 'ec2')
+    ssm_client = get_client(session, 'ssm')
+    pool_key = warm_pool_key(subnet_id, sg_id, profile, metrics_export)
+    for instance in _pool_members(ec2_client, pool_key, ['stopped']):
+        instance_id = instance['InstanceId']
+        try:
+            ssm_client.put_parameter(Name=warm_pool_claim_name(instance_id), Value=claim_id, Type='String', Overwrite=False)
+        except ClientError as err:
+            if err.response['Error']['Code'] != 'ParameterAlreadyExists':
+                raise
+            LOG.info(f"...Warm pool instance {instance_id} already claimed")
+            continue
+        LOG.info(f"...Claimed warm pool instance {instance_id}")
+        return instance_id, instance.get('InstanceType')
+
+    LOG.info(f"...No ready instance in warm pool {pool_key}")
+    return None
+
+
+def start_pool_instance(session, instance_id: str, instance_name: str, claim_id: str, instance_type: str,
+                        current_type: Optional[str] = None) -> None:
+    # Every call is safe to repeat; without current_type, the instance is looked up for it
+    ec2_client = get_client(session, 'ec2')
+    if current_type is None:
+        ec2_response = ec2_client.describe_instances(InstanceIds=[instance_id])
+        current_type = ec2_response['Reservations'][0]['Instances'][0].get('InstanceType')
+    ec2_client.delete_tags(Resources=[instance_id], Tags=[{'Key': const_tag_warm_pool}])
+    ec2_client.create_tags(Resources=[instance_id], Tags=[{'Key': 'Name', 'Value': instance_name},
+                                                            {'Key': const_tag_warm_pool_claim, 'Value': claim_id}])
+    if current_type != instance_type:
+        LOG.info(f"...Changing warm pool instance {instance_id} from {current_type} to {instance_type}")
+        ec2_client.modify_instance_attribute(InstanceId=instance_id, InstanceType={'Value': instance_type})
+    ec2_client.start_instances(InstanceIds=[instance_id])
+
+
+def refill_warm_pool(session, size: int, subnet_id: str, sg_id: str, profile: Optional[str],
+                        launch_args: Mapping[str, Any], user_data: str, metrics_export: bool = False) -> Sequence[str]:
+    ec2_client = get_client(session, 'ec2')
+    pool_key = warm_pool_key(subnet_id, sg_id, profile, metrics_export)
+    members = _pool_members(ec2_client, pool_key, warm_pool_live_states)
+    missing = size - len(members)
+    if missing <= 0:
+        return []
+
+    register_shared_role_member(session, warm_pool_member_id(pool_key))
+    LOG.info(f"...Adding {missing} instances to warm pool {pool_key}")
+    ec2_response = ec2_client.run_instances(**launch_args,
+                                            MinCount=1,
+                                            MaxCount=missing,
+                                            UserData=user_data,
+                                            InstanceInitiatedShutdownBehavior='stop',
+                                            TagSpecifications=[{'ResourceType': 'instance', 'Tags': [
+                                                {'Key': 'Name', 'Value': default_warm_pool_name},
+                                                {'Key': const_tag_warm_pool, 'Value': pool_key}]}])
+    return [instance['InstanceId'] for instance in ec2_response['Instances']]
+
+
+def _pool_members(ec2_client, pool_key: str, states: Sequence[str]) -> Sequence[Mapping[str, Any]]:
+    paginator = ec2_client.get_paginator('describe_instances')
+    pages = paginator.paginate(Filters=[{'Name': f"tag:{const_tag_warm_pool}", 'Values': [pool_key]},
+                                        {'Name': 'instance-state-name', 'Values': list(states)}])
+    return [instance for page in pages for reservation in page['Reservations'] for instance in reservation['Instances']]